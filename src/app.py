@@ -1,8 +1,48 @@
+import asyncio
+import inspect
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
 from fastapi import FastAPI
 
-from endpoints import api_router
+from configuration import AppConfiguration, get_app_configuration
+from endpoints import api_router, health_router, metrics_router
+from metrics import MetricsMiddleware
+
+
+async def get_configuration(app: FastAPI) -> AppConfiguration:
+    # the configuration may be overridden (by the tests)
+    get_configuration = app.dependency_overrides.get(
+        get_app_configuration, get_app_configuration
+    )
+    configuration = get_configuration()
+    if inspect.isawaitable(configuration):
+        configuration = await configuration
+    assert isinstance(configuration, AppConfiguration)
+    return configuration
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    configuration = await get_configuration(app)
+    warm_up = None
+    if configuration.settings.WARM_UP == "startup":
+        await configuration.warm_up()
+    elif configuration.settings.WARM_UP == "background":
+        warm_up = asyncio.create_task(configuration.warm_up())
+    else:
+        configuration.warm_up_state.status = "ready"
+    yield
+    if warm_up is not None:
+        await warm_up
+    # waits for the flusher and saves the ratings: don't block the event loop
+    await asyncio.get_running_loop().run_in_executor(None, configuration.close)
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 app.include_router(api_router, prefix="/api")
+app.include_router(metrics_router)
+app.include_router(health_router)
+app.add_middleware(MetricsMiddleware)
@@ -0,0 +1,61 @@
+"""Compare the memory used by the song repositories.
+
+Run with: `PYTHONPATH=src python -m benchmarks.catalog_memory --sizes 10000,100000`
+"""
+
+from __future__ import annotations
+
+import gc
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+import typer
+
+from benchmarks.synthetic import write_metadata
+from columnar import ColumnarSongRepository
+from songs import InMemorySongRepository, SongRepository
+
+REPOSITORIES: dict[str, Callable[[Path], SongRepository]] = {
+    "memory": InMemorySongRepository.from_file,
+    "columnar": ColumnarSongRepository.from_file,
+}
+
+
+def measure(load: Callable[[Path], SongRepository], file: Path) -> dict[str, Any]:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    repository = load(file)
+    duration = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del repository
+    return dict(retained_bytes=current, peak_bytes=peak, load_seconds=duration)
+
+
+def main(
+    sizes: str = typer.Option("10000,100000,1000000", help="numbers of songs"),
+    repositories: str = typer.Option(",".join(REPOSITORIES), help="to compare"),
+) -> None:
+    results = []
+    with tempfile.TemporaryDirectory() as dir_name:
+        for size in map(int, sizes.split(",")):
+            file = Path(dir_name) / f"{size}" / "metadata.json"
+            write_metadata(file, size)
+            for name in repositories.split(","):
+                result = measure(REPOSITORIES[name], file)
+                result.update(
+                    repository=name,
+                    songs=size,
+                    retained_bytes_per_song=result["retained_bytes"] // size,
+                )
+                results.append(result)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,70 @@
+"""Compare the time to load the catalog, with and without the binary snapshot.
+
+Run with: `PYTHONPATH=src python -m benchmarks.catalog_startup --sizes 10000,100000`
+"""
+
+from __future__ import annotations
+
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import typer
+
+from benchmarks.synthetic import write_metadata
+from columnar import ColumnarSongRepository, get_snapshot_file, load_song_columns
+from songs import InMemorySongRepository, SongRepository
+
+
+def load_in_memory_snapshot(file: Path) -> SongRepository:
+    columns = load_song_columns(file, snapshot=True)
+    return InMemorySongRepository(songs=columns.to_songs(file.parent))
+
+
+LOADERS: dict[str, Callable[[Path], SongRepository]] = {
+    "memory": InMemorySongRepository.from_file,
+    "memory+snapshot": load_in_memory_snapshot,
+    "columnar": ColumnarSongRepository.from_file,
+    "columnar+snapshot": lambda file: ColumnarSongRepository.from_file(
+        file, snapshot=True
+    ),
+}
+
+
+def timeit(function: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(
+    sizes: str = typer.Option("10000,100000", help="numbers of songs"),
+    repeat: int = typer.Option(3, help="the best time of `repeat` runs is kept"),
+) -> None:
+    results = []
+    with tempfile.TemporaryDirectory() as dir_name:
+        for size in map(int, sizes.split(",")):
+            file = Path(dir_name) / f"{size}" / "metadata.json"
+            write_metadata(file, size)
+            build_seconds = timeit(lambda: load_song_columns(file, snapshot=True), 1)
+            results.append(
+                dict(
+                    songs=size,
+                    loader="snapshot build",
+                    seconds=build_seconds,
+                    snapshot_bytes=get_snapshot_file(file).stat().st_size,
+                )
+            )
+            for name, load in LOADERS.items():
+                seconds = timeit(lambda: load(file), repeat)
+                results.append(dict(songs=size, loader=name, seconds=seconds))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,131 @@
+"""Measure the latencies of the endpoints under a mixed concurrent load.
+
+Random picks, file downloads and plays are requested at the same time by
+concurrent clients, for a given duration, through the ASGI app.
+
+Run with: `PYTHONPATH=src python -m benchmarks.concurrency`
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import httpx
+import typer
+
+from app import app
+from benchmarks.synthetic import Environment, make_environment
+from configuration import AppConfiguration, AppSettings, get_app_configuration
+
+
+def summarize(latencies: list[float], duration: float) -> dict[str, Any]:
+    if not latencies:
+        return dict(requests=0)
+    latencies = sorted(latencies)
+    return dict(
+        requests=len(latencies),
+        requests_per_second=len(latencies) / duration,
+        p50_ms=1000 * statistics.median(latencies),
+        p99_ms=1000 * latencies[int(0.99 * (len(latencies) - 1))],
+        max_ms=1000 * latencies[-1],
+    )
+
+
+async def run_load(
+    environment: Environment,
+    duration: float,
+    concurrency: dict[str, int],
+) -> dict[str, list[float]]:
+    authorization = base64.b64encode(
+        f"{Environment.USERNAME}:{Environment.PASSWORD}".encode()
+    ).decode()
+    headers = {"Authorization": f"Basic {authorization}"}
+    song_ids = environment.song_ids_with_file
+    requests: dict[str, Callable[[httpx.AsyncClient, int], Any]] = {
+        "random": lambda client, i: client.get("/api/songs/random/?min_duration=60"),
+        "file": lambda client, i: client.get(
+            f"/api/songs/{song_ids[i % len(song_ids)]}/file/"
+        ),
+        "play": lambda client, i: client.post(
+            f"/api/songs/{song_ids[i % len(song_ids)]}/play/",
+            json=dict(timestamp=i, rating=i % 6),
+        ),
+    }
+    latencies: dict[str, list[float]] = {name: [] for name in requests}
+    end = float("inf")
+
+    async def worker(name: str, client: httpx.AsyncClient) -> None:
+        i = 0
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            res = await requests[name](client, i)
+            res.raise_for_status()
+            latencies[name].append(time.perf_counter() - start)
+            i += 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://test", headers=headers
+    ) as client:
+        # load everything before measuring
+        await requests["random"](client, 0)
+        end = time.perf_counter() + duration
+        await asyncio.gather(
+            *(worker(name, client) for name, n in concurrency.items() for _ in range(n))
+        )
+    return latencies
+
+
+def run_end_to_end(
+    environment: Environment, duration: float, concurrency: dict[str, int]
+) -> dict[str, dict[str, Any]]:
+    """Run the load through the app, and summarize the latencies by endpoint."""
+    configuration = AppConfiguration(
+        settings=AppSettings(
+            METADATA_PATH=environment.metadata_path,
+            USER_PATH=environment.user_path,
+            RATING_DIR_PATH=environment.rating_dir_path,
+        )
+    )
+    app.dependency_overrides[get_app_configuration] = lambda: configuration
+    try:
+        latencies = asyncio.run(run_load(environment, duration, concurrency))
+    finally:
+        app.dependency_overrides = {}
+    return {name: summarize(values, duration) for name, values in latencies.items()}
+
+
+def main(
+    songs: int = typer.Option(20_000, help="the number of songs"),
+    plays: int = typer.Option(5_000, help="the number of plays of the user"),
+    file_size: int = typer.Option(2_000_000, help="the size of the song files"),
+    duration: float = typer.Option(10.0, help="the duration of the load (seconds)"),
+    random_clients: int = typer.Option(20),
+    file_clients: int = typer.Option(10),
+    play_clients: int = typer.Option(2),
+) -> None:
+    concurrency = dict(random=random_clients, file=file_clients, play=play_clients)
+    with tempfile.TemporaryDirectory() as dir_name:
+        environment = make_environment(
+            Path(dir_name), songs, plays, file_size=file_size
+        )
+        endpoints = run_end_to_end(environment, duration, concurrency)
+    results = dict(
+        songs=songs,
+        plays=plays,
+        file_size=file_size,
+        concurrency=concurrency,
+        endpoints=endpoints,
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,157 @@
+"""Micro-benchmarks of the request path.
+
+Loading the catalog and the ratings, drawing songs with each filter, saving
+plays and checking the credentials, on a synthetic catalog.
+
+Run with: `PYTHONPATH=src python -m benchmarks.micro --songs 100000 --plays 50000`
+"""
+
+from __future__ import annotations
+
+import functools
+import json
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from random import Random
+from typing import Any, Callable
+
+import typer
+
+from benchmarks.synthetic import Environment, make_environment
+from columnar import ColumnarSongRepository
+from ratings import InMemoryRatingRepository, PlayLogOptions, convert_ratings_file
+from songs import InMemorySongRepository
+from users import CredentialCache, InMemoryUserRepository
+from util import _compute_remote_id
+
+# the filters of `get_random_song`, matching the synthetic catalog
+FILTERS: dict[str, dict[str, Any]] = {
+    "none": dict(),
+    "min_duration": dict(min_duration=120),
+    "title_contains": dict(title_contains="castle"),
+    "game_title_contains": dict(game_title_contains="game 12"),
+    "min_rating": dict(min_rating=4),
+    "only_has_rating": dict(only_has_rating=True),
+    "only_has_no_rating": dict(only_has_no_rating=True),
+    "weighting=rating": dict(weighting="rating"),
+    "weighting=last_played": dict(weighting="last_played"),
+}
+
+
+def measure(
+    function: Callable[[], Any], repeat: int, number: int = 1, warmup: bool = False
+) -> dict[str, Any]:
+    """Time `number` calls of `function`, `repeat` times (seconds per call).
+
+    With `warmup`, `function` is called once before, to fill the caches.
+    """
+    if warmup:
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return dict(
+        calls=repeat * number,
+        best_ms=1000 * min(times),
+        median_ms=1000 * statistics.median(times),
+    )
+
+
+def run_micro_benchmarks(
+    environment: Environment, dir: Path, repeat: int
+) -> dict[str, dict[str, Any]]:
+    """Run the micro-benchmarks, using `dir` for the files they write."""
+    results: dict[str, dict[str, Any]] = {}
+    metadata_path = environment.metadata_path
+    ratings_path = environment.rating_dir_path / Environment.USERNAME / "ratings.json"
+
+    results["songs.from_file[memory]"] = measure(
+        lambda: InMemorySongRepository.from_file(metadata_path), repeat
+    )
+    results["songs.from_file[columnar]"] = measure(
+        lambda: ColumnarSongRepository.from_file(metadata_path), repeat
+    )
+    results["ratings.from_file"] = measure(
+        lambda: InMemoryRatingRepository.from_file(ratings_path), repeat
+    )
+    binary_ratings_path = dir / "binary" / "ratings.bin"
+    binary_ratings_path.parent.mkdir(parents=True)
+    convert_ratings_file(ratings_path, binary_ratings_path, "binary")
+    results["ratings.from_file[binary]"] = measure(
+        lambda: InMemoryRatingRepository.from_file(binary_ratings_path), repeat
+    )
+
+    songs = InMemorySongRepository.from_file(metadata_path, random=Random(0))
+    ratings = InMemoryRatingRepository.from_file(ratings_path)
+    for name, filters in FILTERS.items():
+        results[f"get_random_song[{name}]"] = measure(
+            functools.partial(songs.get_random_song, ratings=ratings, **filters),
+            repeat,
+            number=100,
+            warmup=True,
+        )
+    results["get_random_songs[count=20]"] = measure(
+        lambda: songs.get_random_songs(ratings=ratings, count=20),
+        repeat,
+        number=100,
+        warmup=True,
+    )
+
+    path = Path(environment.metadata[0]["path"])
+    song_id = _compute_remote_id(path)
+    for storage, play_log, number in (
+        ("snapshot", None, 1),
+        ("log", PlayLogOptions(compaction_threshold=10**9), 100),
+    ):
+        file = dir / storage / "ratings.json"
+        file.parent.mkdir(parents=True)
+        shutil.copy2(ratings_path, file)
+        repository = InMemoryRatingRepository.from_file(file, play_log=play_log)
+
+        def add_play(repository: InMemoryRatingRepository = repository) -> None:
+            repository.add_play(song_id, path, timestamp=0, rating=5)
+            repository.save()
+
+        results[f"ratings.add_play+save[{storage}]"] = measure(
+            add_play, repeat, number=number
+        )
+
+    username = Environment.USERNAME.encode()
+    password = Environment.PASSWORD.encode()
+    # the credentials are always checked with bcrypt if they are not cached
+    uncached = InMemoryUserRepository.from_file(
+        environment.user_path, credential_cache=CredentialCache(ttl=0)
+    )
+    results["get_user[bcrypt]"] = measure(
+        lambda: uncached.get_user(username, password), repeat
+    )
+    cached = InMemoryUserRepository.from_file(environment.user_path)
+    results["get_user[cached]"] = measure(
+        lambda: cached.get_user(username, password),
+        repeat,
+        number=1000,
+        warmup=True,
+    )
+    return results
+
+
+def main(
+    songs: int = typer.Option(100_000, help="the number of songs"),
+    plays: int = typer.Option(50_000, help="the number of plays of the user"),
+    repeat: int = typer.Option(5, help="the number of measures of each benchmark"),
+) -> None:
+    with tempfile.TemporaryDirectory() as dir_name:
+        dir = Path(dir_name)
+        environment = make_environment(dir / "data", songs, plays)
+        results = run_micro_benchmarks(environment, dir / "work", repeat)
+    print(json.dumps(dict(songs=songs, plays=plays, benchmarks=results), indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(main)
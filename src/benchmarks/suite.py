@@ -0,0 +1,72 @@
+"""Run the micro-benchmarks and the end-to-end load on the same synthetic data.
+
+The results are printed as JSON, with the current git commit, to compare them
+across commits.
+
+Run with: `PYTHONPATH=src python -m benchmarks.suite --output results.json`
+"""
+
+from __future__ import annotations
+
+import json
+import platform
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import typer
+
+from benchmarks.concurrency import run_end_to_end
+from benchmarks.micro import run_micro_benchmarks
+from benchmarks.synthetic import make_environment
+
+
+def get_commit() -> Optional[str]:
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def main(
+    songs: int = typer.Option(100_000, help="the number of songs"),
+    plays: int = typer.Option(50_000, help="the number of plays of the user"),
+    repeat: int = typer.Option(5, help="the number of measures of each benchmark"),
+    duration: float = typer.Option(10.0, help="the duration of the load (seconds)"),
+    random_clients: int = typer.Option(20),
+    file_clients: int = typer.Option(10),
+    play_clients: int = typer.Option(2),
+    output: Optional[Path] = typer.Option(None, help="also write the results here"),
+) -> None:
+    concurrency = dict(random=random_clients, file=file_clients, play=play_clients)
+    with tempfile.TemporaryDirectory() as dir_name:
+        dir = Path(dir_name)
+        environment = make_environment(dir / "data", songs, plays)
+        micro = run_micro_benchmarks(environment, dir / "work", repeat)
+        end_to_end = run_end_to_end(environment, duration, concurrency)
+    results = dict(
+        commit=get_commit(),
+        python=platform.python_version(),
+        songs=songs,
+        plays=plays,
+        repeat=repeat,
+        concurrency=concurrency,
+        micro=micro,
+        end_to_end=end_to_end,
+    )
+    content = json.dumps(results, indent=2)
+    if output is not None:
+        output.write_text(content)
+    print(content)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,115 @@
+"""Generate synthetic catalogs, to benchmark at a realistic scale."""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from random import Random
+from typing import Any
+
+from users import UserData, hash_password
+from util import _compute_remote_id
+
+WORDS = (
+    "battle theme field castle boss town overworld dungeon final ending "
+    "title forest cave ocean sky night morning victory ice fire"
+).split()
+
+
+def make_metadata(number_of_songs: int, seed: int = 0) -> list[dict[str, Any]]:
+    """Make the entries of a `metadata.json`, with ~20 songs per game."""
+    random = Random(seed)
+    entries = []
+    for i in range(number_of_songs):
+        game = i // 20
+        title = " ".join(random.choices(WORDS, k=random.randint(1, 4)))
+        entries.append(
+            dict(
+                path=f"game{game:06d}/{i:07d} {title}.brstm",
+                timestamp=1_600_000_000 + i,
+                loop_start=random.randint(0, 10_000_000),
+                loop_end=random.randint(10_000_000, 100_000_000),
+                duration=round(random.uniform(5, 300), 3),
+                size=random.randint(100_000, 10_000_000),
+                title=title.title() if random.random() > 0.01 else None,
+                game_title=f"Game {game} {WORDS[game % len(WORDS)]}",
+                error=random.random() < 0.001,
+            )
+        )
+    return entries
+
+
+def write_metadata(file: Path, number_of_songs: int, seed: int = 0) -> None:
+    file.parent.mkdir(exist_ok=True, parents=True)
+    with file.open("w") as fh:
+        json.dump(make_metadata(number_of_songs, seed=seed), fh)
+
+
+def make_ratings(
+    metadata: list[dict[str, Any]], number_of_plays: int, seed: int = 0
+) -> list[dict[str, Any]]:
+    """Make the content of a `ratings.json`, for songs of `metadata`."""
+    random = Random(seed)
+    played_songs: dict[str, list[dict[str, int]]] = dict()
+    for i in range(number_of_plays):
+        path = random.choice(metadata)["path"]
+        played_songs.setdefault(path, []).append(
+            dict(timestamp=1_700_000_000 + i, rating=random.randint(0, 5))
+        )
+    return [dict(path=path, plays=plays) for path, plays in played_songs.items()]
+
+
+@dataclass
+class Environment:
+    """Files for an `AppSettings`, with a user `user` (password `password`)."""
+
+    metadata_path: Path
+    user_path: Path
+    rating_dir_path: Path
+    metadata: list[dict[str, Any]]
+    # the ids of the songs that have an audio file
+    song_ids_with_file: list[str]
+
+    USERNAME = "user"
+    PASSWORD = "password"
+
+
+def make_environment(
+    dir: Path,
+    number_of_songs: int,
+    number_of_plays: int,
+    number_of_files: int = 10,
+    file_size: int = 1_000_000,
+    seed: int = 0,
+) -> Environment:
+    metadata = make_metadata(number_of_songs, seed=seed)
+    metadata_path = dir / "songs" / "metadata.json"
+    write_metadata(metadata_path, number_of_songs, seed=seed)
+    for entry in metadata[:number_of_files]:
+        file = metadata_path.parent / entry["path"]
+        file.parent.mkdir(exist_ok=True, parents=True)
+        file.write_bytes(Random(entry["path"]).randbytes(file_size))
+
+    user_path = dir / "users.json"
+    user = UserData(
+        username=Environment.USERNAME.encode(),
+        password_hash=hash_password(Environment.PASSWORD.encode()),
+    )
+    user_path.write_text(f"[{user.model_dump_json()}]")
+
+    rating_dir_path = dir / "ratings"
+    ratings_file = rating_dir_path / Environment.USERNAME / "ratings.json"
+    ratings_file.parent.mkdir(exist_ok=True, parents=True)
+    with ratings_file.open("w") as fh:
+        json.dump(make_ratings(metadata, number_of_plays, seed=seed), fh)
+
+    return Environment(
+        metadata_path=metadata_path,
+        user_path=user_path,
+        rating_dir_path=rating_dir_path,
+        metadata=metadata,
+        song_ids_with_file=[
+            _compute_remote_id(Path(e["path"])) for e in metadata[:number_of_files]
+        ],
+    )
@@ -0,0 +1,120 @@
+"""Compare the memory of the catalog and the time to the first request, when
+several worker processes load it (like `uvicorn --workers 8`).
+
+Each worker is a new process (spawned, like the uvicorn workers) that loads the
+catalog and draws a song. The memory is measured once all the workers are
+ready: the RSS counts the shared pages in each worker, the PSS divides them by
+the number of processes sharing them, and the USS only counts the private ones
+(Linux only). The `none` loader gives the memory of a worker without catalog.
+
+Run with: `PYTHONPATH=src python -m benchmarks.workers --songs 100000 --workers 1,8`
+"""
+
+from __future__ import annotations
+
+import json
+import multiprocessing
+import statistics
+import tempfile
+import time
+from multiprocessing.synchronize import Barrier
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import typer
+
+from benchmarks.synthetic import write_metadata
+from columnar import ColumnarSongRepository, load_song_columns
+from ratings import InMemoryRatingRepository
+from songs import InMemorySongRepository, SongRepository
+
+LOADERS: dict[str, Callable[[Path], Optional[SongRepository]]] = {
+    "none": lambda file: None,
+    "memory": InMemorySongRepository.from_file,
+    "columnar": ColumnarSongRepository.from_file,
+    "columnar+snapshot": lambda file: ColumnarSongRepository.from_file(
+        file, snapshot=True
+    ),
+}
+
+
+def get_memory() -> dict[str, int]:
+    """Return the RSS, PSS and USS of the current process, in bytes."""
+    values: dict[str, int] = dict()
+    try:
+        with open("/proc/self/smaps_rollup") as fh:
+            for line in fh:
+                name, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    values[name] = int(value.split()[0]) * 1024
+    except OSError:
+        return dict()
+    return dict(
+        rss_bytes=values["Rss"],
+        pss_bytes=values["Pss"],
+        uss_bytes=values["Private_Clean"] + values["Private_Dirty"],
+    )
+
+
+def run_worker(
+    loader: str,
+    file: Path,
+    started_at: float,
+    barrier: Barrier,
+    results: "multiprocessing.Queue[dict[str, Any]]",
+) -> None:
+    repository = LOADERS[loader](file)
+    if repository is not None:
+        repository.get_random_song(ratings=InMemoryRatingRepository(ratings=dict()))
+    # `time.monotonic` is the same clock in all the processes
+    first_request_seconds = time.monotonic() - started_at
+    # measure once all the workers have loaded the catalog, and keep it loaded
+    # until all of them are measured
+    barrier.wait()
+    memory = get_memory()
+    barrier.wait()
+    results.put(dict(first_request_seconds=first_request_seconds, **memory))
+
+
+def run_workers(loader: str, file: Path, workers: int) -> dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    results: "multiprocessing.Queue[dict[str, Any]]" = context.Queue()
+    processes = []
+    for _ in range(workers):
+        process = context.Process(
+            target=run_worker,
+            args=(loader, file, time.monotonic(), barrier, results),
+        )
+        process.start()
+        processes.append(process)
+    measures = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    summary: dict[str, Any] = dict(loader=loader, workers=workers)
+    for name in measures[0]:
+        summary[f"mean_{name}"] = statistics.mean(m[name] for m in measures)
+    summary["max_first_request_seconds"] = max(
+        m["first_request_seconds"] for m in measures
+    )
+    return summary
+
+
+def main(
+    songs: int = typer.Option(100_000, help="the number of songs"),
+    workers: str = typer.Option("1,8", help="numbers of worker processes"),
+) -> None:
+    results = []
+    with tempfile.TemporaryDirectory() as dir_name:
+        file = Path(dir_name) / "metadata.json"
+        write_metadata(file, songs)
+        # built once, before starting the workers (see `cli.py build-snapshot`)
+        load_song_columns(file, snapshot=True)
+        for loader in LOADERS:
+            for count in map(int, workers.split(",")):
+                results.append(run_workers(loader, file, count))
+    print(json.dumps(dict(songs=songs, results=results), indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,7 +1,14 @@
 import getpass
+from pathlib import Path
+from typing import Optional
 
 import typer
 
+from columnar import get_snapshot_file, load_song_columns
+from configuration import AppSettings
+from database import Database, migrate_from_files
+from ratings import RATING_FILE_NAMES, RatingFileFormat, convert_ratings_file
+from scanner import load_metadata, scan_library, write_metadata
 from users import UserData, hash_password
 
 app = typer.Typer(add_completion=False)
@@ -24,6 +31,111 @@ def make_user(
     print(user_data.model_dump_json(indent=2))
 
 
+@app.command()
+def build_snapshot(
+    metadata_path: Optional[Path] = typer.Option(
+        None, help="the metadata file (default: the setting)"
+    ),
+) -> None:
+    """Build the catalog snapshot, that the workers map instead of building it.
+
+    Run it before starting the server, with `VGSSERVER_SONG_SNAPSHOT=true`.
+    """
+    file = metadata_path or AppSettings().METADATA_PATH
+    columns = load_song_columns(file, snapshot=True)
+    snapshot_file = get_snapshot_file(file)
+    print(
+        f"{snapshot_file}: {len(columns)} songs, "
+        f"{snapshot_file.stat().st_size} bytes"
+    )
+
+
+@app.command()
+def migrate(
+    metadata_path: Optional[Path] = typer.Option(
+        None, help="the metadata file (default: the setting)"
+    ),
+    rating_dir: Optional[Path] = typer.Option(
+        None, help="the directory of the ratings of the users (default: the setting)"
+    ),
+    database_path: Optional[Path] = typer.Option(
+        None, help="the SQLite database (default: the setting)"
+    ),
+) -> None:
+    """Import the metadata file and the ratings files into the SQLite database."""
+    settings = AppSettings()
+    database = Database(database_path or settings.DATABASE_PATH)
+    diff, users = migrate_from_files(
+        database,
+        metadata_file=metadata_path or settings.METADATA_PATH,
+        rating_dir=rating_dir or settings.RATING_DIR_PATH,
+        rating_file_name=RATING_FILE_NAMES[settings.RATING_FORMAT],
+    )
+    print(
+        f"Songs: {diff.added} added, {diff.changed} changed, {diff.removed} removed, "
+        f"{diff.unchanged} unchanged. Ratings of {users} users imported."
+    )
+
+
+@app.command()
+def convert_ratings(
+    to: str = typer.Option(..., help='the new format: "json" or "binary"'),
+    rating_dir: Optional[Path] = typer.Option(
+        None, help="the directory of the ratings of the users (default: the setting)"
+    ),
+) -> None:
+    """Convert the ratings files of all the users to another format.
+
+    The files in the previous format are kept. Set `VGSSERVER_RATING_FORMAT`
+    to the new format before restarting the server.
+    """
+    file_format: RatingFileFormat
+    source_format: RatingFileFormat
+    if to == "binary":
+        file_format, source_format = "binary", "json"
+    elif to == "json":
+        file_format, source_format = "json", "binary"
+    else:
+        raise typer.BadParameter(f"Unknown format: {to}")
+    directory = rating_dir or AppSettings().RATING_DIR_PATH
+    for source in sorted(directory.glob(f"*/{RATING_FILE_NAMES[source_format]}")):
+        target = source.with_name(RATING_FILE_NAMES[file_format])
+        convert_ratings_file(source, target, file_format)
+        print(
+            f"{source.parent.name}: {source.stat().st_size} bytes -> "
+            f"{target.stat().st_size} bytes"
+        )
+
+
+@app.command()
+def scan(
+    metadata_path: Optional[Path] = typer.Option(
+        None,
+        help="the metadata file, in the directory of the songs (default: the setting)",
+    ),
+    workers: Optional[int] = typer.Option(
+        None,
+        help="the number of processes reading the songs "
+        "(default: the number of CPUs, 0: no process)",
+    ),
+) -> None:
+    """Read the songs of the directory of the metadata file, and write it.
+
+    Only the songs added or modified (other timestamp or size) since the
+    previous scan are read.
+    """
+    file = metadata_path or AppSettings().METADATA_PATH
+    previous = load_metadata(file) if file.exists() else []
+    entries, report = scan_library(file.parent, previous, workers=workers)
+    write_metadata(file, entries)
+    print(
+        f"{report.songs} songs: {report.read} read, {report.unchanged} unchanged, "
+        f"{report.removed} removed, {report.errors} errors, "
+        f"in {report.seconds:.2f} s ({report.songs_per_second:.0f} files/s, "
+        f"{report.read_per_second:.0f} read files/s)"
+    )
+
+
 @app.callback()
 def callback() -> None:
     """To make it ask a command if there is only one.
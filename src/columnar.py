@@ -0,0 +1,664 @@
+"""A song repository storing the catalog in columns, to use less memory.
+
+Instead of one pydantic `Song` per track, the metadata are stored in arrays
+(one per field), the strings in a single interned table and the remote ids as
+binary md5 digests. `Song` objects are only built when they are returned.
+
+The columns can be saved in a snapshot file, that is memory-mapped read-only:
+the processes that map it (like the workers of uvicorn) share its pages.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from random import Random
+from typing import (
+    Any,
+    Collection,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Union,
+    overload,
+)
+
+import pydantic
+
+from ratings import RatingRepository, create_temp_file
+from sampling import SamplerKeys, Weighting
+from songs import (
+    DurationIndex,
+    MetadataEntry,
+    Song,
+    SongRepository,
+    iter_random_permutation,
+    make_rating_filter,
+)
+from util import _compute_remote_id
+
+DIGEST_SIZE = 16  # md5
+
+# arrays when the catalog is built, views of the snapshot when it is loaded
+IntColumn = Union["array[int]", "memoryview[int]"]
+FloatColumn = Union["array[float]", "memoryview[float]"]
+
+SNAPSHOT_MAGIC = b"VGSCAT\x00\x01"
+SNAPSHOT_VERSION = 1
+# the type codes of the columns in the snapshot, in this order
+SNAPSHOT_COLUMNS = dict(
+    paths="i",
+    titles="i",
+    game_titles="i",
+    timestamps="q",
+    loop_starts="q",
+    loop_ends="q",
+    durations="d",
+    sizes="q",
+    errors="b",
+    remote_ids="B",
+    remote_id_order="i",
+    duration_order="i",
+    sorted_durations="d",
+    string_data="B",
+    string_offsets="q",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StringTable:
+    """Strings stored in a single UTF-8 buffer, and decoded when accessed."""
+
+    def __init__(self, data: memoryview, offsets: IntColumn) -> None:
+        self.data = data
+        self.offsets = offsets  # the string `i` is `data[offsets[i]:offsets[i+1]]`
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return str(self.data[self.offsets[index] : self.offsets[index + 1]], "utf-8")
+
+    def get(self, index: int) -> Optional[str]:
+        """Return the string `index`, or `None` if `index` is -1."""
+        return None if index < 0 else self[index]
+
+
+class StringTableBuilder:
+    def __init__(self) -> None:
+        self.ids: dict[str, int] = dict()
+        self.data = bytearray()
+        self.offsets = array("q", [0])
+
+    def add(self, string: Optional[str]) -> int:
+        """Add a string (if not already there) and return its index (-1 for `None`)."""
+        if string is None:
+            return -1
+        id = self.ids.get(string)
+        if id is None:
+            id = self.ids[string] = len(self.offsets) - 1
+            self.data += string.encode()
+            self.offsets.append(len(self.data))
+        return id
+
+    def build(self) -> StringTable:
+        return StringTable(data=memoryview(bytes(self.data)), offsets=self.offsets)
+
+
+@dataclass
+class SongColumns:
+    # indices in `strings`
+    paths: IntColumn
+    titles: IntColumn
+    game_titles: IntColumn
+    timestamps: IntColumn
+    loop_starts: IntColumn
+    loop_ends: IntColumn
+    durations: FloatColumn
+    sizes: IntColumn
+    errors: IntColumn
+    # the md5 digests of the songs, one after the other
+    remote_ids: memoryview
+    # the positions of the songs, sorted by remote id
+    remote_id_order: IntColumn
+    # the positions of the songs sorted by duration, and the sorted durations
+    duration_order: IntColumn
+    sorted_durations: FloatColumn
+    strings: StringTable
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def get_remote_id(self, position: int) -> str:
+        start = position * DIGEST_SIZE
+        return self.remote_ids[start : start + DIGEST_SIZE].hex()
+
+    def find(self, song_id: str) -> Optional[int]:
+        """Return the position of a song, by binary search on the remote ids."""
+        try:
+            digest = bytes.fromhex(song_id)
+        except ValueError:
+            return None
+
+        def get_digest(position: int) -> bytes:
+            start = position * DIGEST_SIZE
+            return bytes(self.remote_ids[start : start + DIGEST_SIZE])
+
+        i = bisect_left(self.remote_id_order, digest, key=get_digest)
+        if i < len(self) and get_digest(self.remote_id_order[i]) == digest:
+            return self.remote_id_order[i]
+        return None
+
+    def get_entry(self, position: int) -> MetadataEntry:
+        return MetadataEntry(
+            path=Path(self.strings[self.paths[position]]),
+            timestamp=self.timestamps[position],
+            loop_start=self.loop_starts[position],
+            loop_end=self.loop_ends[position],
+            duration=self.durations[position],
+            size=self.sizes[position],
+            title=self.strings.get(self.titles[position]),
+            game_title=self.strings.get(self.game_titles[position]),
+            error=bool(self.errors[position]),
+        )
+
+    @staticmethod
+    def from_entries(entries: Iterable[MetadataEntry]) -> SongColumns:
+        strings = StringTableBuilder()
+        paths, titles, game_titles = array("i"), array("i"), array("i")
+        timestamps, loop_starts, loop_ends = array("q"), array("q"), array("q")
+        durations, sizes, errors = array("d"), array("q"), array("b")
+        remote_ids = bytearray()
+        for e in entries:
+            paths.append(strings.add(str(e.path)))
+            titles.append(strings.add(e.title))
+            game_titles.append(strings.add(e.game_title))
+            timestamps.append(e.timestamp)
+            loop_starts.append(e.loop_start)
+            loop_ends.append(e.loop_end)
+            durations.append(e.duration)
+            sizes.append(e.size)
+            errors.append(e.error)
+            remote_ids += bytes.fromhex(_compute_remote_id(e.path))
+        remote_id_order = array(
+            "i",
+            sorted(
+                range(len(paths)),
+                key=lambda i: remote_ids[i * DIGEST_SIZE : (i + 1) * DIGEST_SIZE],
+            ),
+        )
+        duration_order = array(
+            "i", sorted(range(len(paths)), key=durations.__getitem__)
+        )
+        return SongColumns(
+            paths=paths,
+            titles=titles,
+            game_titles=game_titles,
+            timestamps=timestamps,
+            loop_starts=loop_starts,
+            loop_ends=loop_ends,
+            durations=durations,
+            sizes=sizes,
+            errors=errors,
+            remote_ids=memoryview(bytes(remote_ids)),
+            remote_id_order=remote_id_order,
+            duration_order=duration_order,
+            sorted_durations=array("d", (durations[i] for i in duration_order)),
+            strings=strings.build(),
+        )
+
+    def to_songs(self, root: Path) -> dict[str, Song]:
+        """Build the songs of an `InMemorySongRepository`."""
+        songs = dict()
+        for position in range(len(self)):
+            path = Path(self.strings[self.paths[position]])
+            remote_id = self.get_remote_id(position)
+            # the values were validated when the columns were built
+            songs[remote_id] = Song.model_construct(
+                path=path,
+                timestamp=self.timestamps[position],
+                loop_start=self.loop_starts[position],
+                loop_end=self.loop_ends[position],
+                duration=self.durations[position],
+                size=self.sizes[position],
+                title=self.strings.get(self.titles[position]),
+                game_title=self.strings.get(self.game_titles[position]),
+                error=bool(self.errors[position]),
+                absolute_path=root / path,
+                remote_id=remote_id,
+            )
+        return songs
+
+    def get_buffers(self) -> dict[str, memoryview]:
+        buffers = {
+            name: memoryview(getattr(self, name))
+            for name in SNAPSHOT_COLUMNS
+            if not name.startswith("string_")
+        }
+        buffers["string_data"] = self.strings.data
+        buffers["string_offsets"] = memoryview(self.strings.offsets)
+        return buffers
+
+    def write_snapshot(self, file: Path, source: SnapshotSource) -> None:
+        """Write the columns to a binary file, that can be memory-mapped.
+
+        The file starts with a magic number, the size of a JSON header (that
+        gives the version, the source of the columns and the position of each
+        column), the header, and the columns, aligned on 8 bytes.
+        """
+        buffers = self.get_buffers()
+        layout = dict()
+        offset = 0
+        for name, buffer in buffers.items():
+            layout[name] = (offset, buffer.nbytes)
+            offset += -(-buffer.nbytes // 8) * 8
+        header = json.dumps(
+            dict(
+                version=SNAPSHOT_VERSION,
+                byteorder=sys.byteorder,
+                itemsizes={
+                    c: array(c).itemsize for c in set(SNAPSHOT_COLUMNS.values())
+                },
+                source=dataclasses.asdict(source),
+                layout=layout,
+            )
+        ).encode()
+        header += b" " * (-len(header) % 8)
+        # unique, so that concurrent writers don't write in the same file
+        temp_file = create_temp_file(file)
+        try:
+            with temp_file.open("wb") as fh:
+                fh.write(SNAPSHOT_MAGIC)
+                fh.write(len(header).to_bytes(8, "little"))
+                fh.write(header)
+                for buffer in buffers.values():
+                    fh.write(buffer)
+                    fh.write(b"\x00" * (-buffer.nbytes % 8))
+            os.replace(temp_file, file)
+        except BaseException:
+            temp_file.unlink(missing_ok=True)
+            raise
+
+    @staticmethod
+    def load_snapshot(file: Path, source_file: Path) -> Optional[SongColumns]:
+        """Map the columns of a snapshot in memory, without copying them.
+
+        Return `None` if the snapshot doesn't exist, can't be read, or was
+        not built from the current version of `source_file`.
+        """
+        try:
+            with file.open("rb") as fh:
+                data = memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError):
+            return None
+        try:
+            if data[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                return None
+            start = len(SNAPSHOT_MAGIC) + 8
+            header_size = int.from_bytes(data[len(SNAPSHOT_MAGIC) : start], "little")
+            header = json.loads(bytes(data[start : start + header_size]))
+            if (
+                header["version"] != SNAPSHOT_VERSION
+                or header["byteorder"] != sys.byteorder
+                or header["itemsizes"]
+                != {c: array(c).itemsize for c in header["itemsizes"]}
+                or not SnapshotSource(**header["source"]).matches(source_file)
+            ):
+                return None
+            start += header_size
+            buffers: dict[str, Any] = dict()
+            for name, (offset, size) in header["layout"].items():
+                buffer: Any = data[start + offset : start + offset + size]
+                buffers[name] = buffer.cast(SNAPSHOT_COLUMNS[name])
+            strings = StringTable(
+                data=buffers.pop("string_data"),
+                offsets=buffers.pop("string_offsets"),
+            )
+            return SongColumns(**buffers, strings=strings)
+        except (ValueError, TypeError, KeyError):
+            return None
+
+
+@dataclass(frozen=True)
+class SnapshotSource:
+    """The version of the metadata file a snapshot was built from."""
+
+    mtime_ns: int
+    size: int
+    sha256: str
+
+    def matches(self, file: Path) -> bool:
+        """Tell whether `file` is the same as the one of the snapshot.
+
+        The file is only hashed if it was modified (e.g. touched or copied).
+        """
+        try:
+            stat = file.stat()
+            if stat.st_size != self.size:
+                return False
+            if stat.st_mtime_ns == self.mtime_ns:
+                return True
+            return hashlib.sha256(file.read_bytes()).hexdigest() == self.sha256
+        except OSError:
+            return False
+
+
+def get_snapshot_file(file: Path) -> Path:
+    return Path(str(file) + ".snapshot")
+
+
+@contextmanager
+def locked_snapshot(file: Path) -> Iterator[None]:
+    """Prevent the other processes from building the snapshot of `file`.
+
+    If the lock file can't be created, the snapshot is not locked.
+    """
+    try:
+        fh = open(str(get_snapshot_file(file)) + ".lock", "a")
+    except OSError:
+        yield
+        return
+    with fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        yield
+
+
+def load_song_columns(file: Path, snapshot: bool = False) -> SongColumns:
+    """Load the columns from the metadata file.
+
+    With `snapshot`, the columns are mapped from the snapshot next to the
+    metadata file if it is up to date. Otherwise, the snapshot is (re)built by
+    one process (the others wait for it), and mapped.
+    """
+    if not snapshot:
+        return build_song_columns(file)
+    snapshot_file = get_snapshot_file(file)
+    columns = SongColumns.load_snapshot(snapshot_file, file)
+    if columns is not None:
+        return columns
+    with locked_snapshot(file):
+        # built by another process meanwhile
+        columns = SongColumns.load_snapshot(snapshot_file, file)
+        if columns is not None:
+            return columns
+        columns = build_song_columns(file, snapshot=True)
+    # share the pages of the snapshot with the other processes
+    return SongColumns.load_snapshot(snapshot_file, file) or columns
+
+
+def build_song_columns(file: Path, snapshot: bool = False) -> SongColumns:
+    """Build the columns from the metadata file (and write their snapshot)."""
+    snapshot_file = get_snapshot_file(file)
+    stat = file.stat()
+    content = file.read_bytes()
+    adapter = pydantic.TypeAdapter(MetadataEntry)
+    columns = SongColumns.from_entries(
+        adapter.validate_python(d) for d in json.loads(content)
+    )
+    if snapshot:
+        source = SnapshotSource(
+            mtime_ns=stat.st_mtime_ns,
+            size=stat.st_size,
+            sha256=hashlib.sha256(content).hexdigest(),
+        )
+        try:
+            columns.write_snapshot(snapshot_file, source)
+        except OSError as e:
+            logger.warning("Can't write the catalog snapshot %s: %s", snapshot_file, e)
+    return columns
+
+
+@dataclass
+class CompactSubstringIndex:
+    """A trigram index like `SubstringIndex`, with the postings in arrays.
+
+    The texts are not kept: the candidates of the smallest posting are checked
+    against the texts of the columns.
+    """
+
+    columns: SongColumns
+    text_column: Sequence[int]
+    trigrams: dict[str, array[int]] = field(default_factory=dict)
+    short_positions: array[int] = field(default_factory=lambda: array("i"))
+    positions_without_text: set[int] = field(default_factory=set)
+
+    def __post_init__(self) -> None:
+        for position, string_id in enumerate(self.text_column):
+            if string_id < 0:
+                self.positions_without_text.add(position)
+                continue
+            text = self.columns.strings[string_id].casefold()
+            if len(text) < 3:
+                self.short_positions.append(position)
+            for trigram in {text[i : i + 3] for i in range(len(text) - 2)}:
+                posting = self.trigrams.get(trigram)
+                if posting is None:
+                    posting = self.trigrams[trigram] = array("i")
+                posting.append(position)
+
+    def get_text(self, position: int) -> str:
+        return self.columns.strings[self.text_column[position]].casefold()
+
+    def search(self, needle: Optional[str]) -> Optional[set[int]]:
+        if needle is None:
+            return None
+        needle = needle.casefold()
+        if not needle:
+            return None
+        if len(needle) < 3:
+            matches = {p for p in self.short_positions if needle in self.get_text(p)}
+            for trigram, positions in self.trigrams.items():
+                if needle in trigram:
+                    matches.update(positions)
+        else:
+            postings = [
+                self.trigrams.get(needle[i : i + 3], array("i"))
+                for i in range(len(needle) - 2)
+            ]
+            smallest = min(postings, key=len)
+            matches = {p for p in smallest if needle in self.get_text(p)}
+        return matches | self.positions_without_text
+
+
+class RemoteIdSequence(Sequence[str]):
+    """The remote ids of songs given by position, computed when accessed."""
+
+    def __init__(self, columns: SongColumns, positions: Sequence[int]) -> None:
+        self.columns = columns
+        self.positions = positions
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    @overload
+    def __getitem__(self, index: int) -> str:
+        ...  # pragma:nocover
+
+    @overload
+    def __getitem__(self, index: slice) -> Sequence[str]:
+        ...  # pragma:nocover
+
+    def __getitem__(self, index: int | slice) -> str | Sequence[str]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.columns.get_remote_id(self.positions[index])
+
+
+@dataclass
+class ColumnarSongRepository(SongRepository):
+    columns: SongColumns
+    root: Path  # the directory of the songs
+    random: Random = field(default_factory=Random)
+    duration_index: DurationIndex[int] = field(init=False, repr=False)
+    # built when first needed, to save memory if the filters are not used
+    title_index: Optional[CompactSubstringIndex] = field(default=None, repr=False)
+    game_title_index: Optional[CompactSubstringIndex] = field(default=None, repr=False)
+    # the keys of the weighted samplers of the ratings (the remote ids in the
+    # order of the durations), found by position without building a dictionary
+    sampler_keys: SamplerKeys = field(init=False, repr=False)
+    # the rank of each song in `columns.duration_order`, built when first needed
+    duration_ranks: Optional[array[int]] = field(default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        self.duration_index = DurationIndex(
+            keys=self.columns.duration_order,
+            durations=self.columns.sorted_durations,
+        )
+        self.sampler_keys = SamplerKeys(
+            RemoteIdSequence(self.columns, self.columns.duration_order),
+            find=self.find_duration_rank,
+        )
+
+    def find_duration_rank(self, song_id: str) -> Optional[int]:
+        position = self.columns.find(song_id)
+        if position is None:
+            return None
+        if self.duration_ranks is None:
+            ranks = array("i", [0]) * len(self.columns)
+            for rank, p in enumerate(self.columns.duration_order):
+                ranks[p] = rank
+            self.duration_ranks = ranks
+        return self.duration_ranks[position]
+
+    def get_random_songs(
+        self,
+        ratings: RatingRepository,
+        count: int,
+        min_duration: Optional[int] = None,
+        title_contains: Optional[str] = None,
+        game_title_contains: Optional[str] = None,
+        min_rating: Optional[int] = None,
+        only_has_rating: Optional[bool] = None,
+        only_has_no_rating: Optional[bool] = None,
+        excluded_ids: Collection[str] = (),
+        weighting: Optional[Weighting] = None,
+    ) -> list[Song]:
+        if count <= 0:
+            return []
+        title_matches = None
+        if title_contains:
+            if self.title_index is None:
+                self.title_index = CompactSubstringIndex(
+                    self.columns, self.columns.titles
+                )
+            title_matches = self.title_index.search(title_contains)
+        game_title_matches = None
+        if game_title_contains:
+            if self.game_title_index is None:
+                self.game_title_index = CompactSubstringIndex(
+                    self.columns, self.columns.game_titles
+                )
+            game_title_matches = self.game_title_index.search(game_title_contains)
+        rated_positions = None
+        if only_has_rating:
+            rated_positions = {
+                p
+                for p in map(self.columns.find, ratings.get_rated_song_ids(min_rating))
+                if p is not None
+            }
+
+        candidates: Sequence[int] = self.duration_index.get_keys(min_duration)
+        narrowed = False
+        for positions in (title_matches, game_title_matches, rated_positions):
+            if positions is not None and len(positions) < len(candidates):
+                # sorted, so that the draws only depend on `random`
+                candidates = sorted(positions)
+                narrowed = True
+
+        rating_filter = make_rating_filter(
+            ratings=ratings,
+            min_rating=min_rating,
+            only_has_rating=only_has_rating,
+            only_has_no_rating=only_has_no_rating,
+        )
+
+        def accept(position: int) -> bool:
+            if (
+                min_duration is not None
+                and self.columns.durations[position] < min_duration
+            ):
+                return False
+            if title_matches is not None and position not in title_matches:
+                return False
+            if game_title_matches is not None and position not in game_title_matches:
+                return False
+            remote_id = self.columns.get_remote_id(position)
+            if remote_id in excluded_ids:
+                return False
+            return rating_filter(remote_id)
+
+        if weighting is not None:
+            order = self.duration_index.keys
+            sampler = ratings.get_sampler(weighting, self.sampler_keys)
+            if narrowed:
+                chosen = sampler.sample_from(
+                    self.random,
+                    filter(accept, candidates),
+                    count,
+                    self.columns.get_remote_id,
+                )
+            else:
+                chosen = [
+                    order[i]
+                    for i in sampler.sample(
+                        self.random,
+                        count,
+                        lambda i: accept(order[i]),
+                        start=self.duration_index.get_start(min_duration),
+                    )
+                ]
+            return [self.get_song(position) for position in chosen]
+
+        songs: list[Song] = []
+        for position in iter_random_permutation(self.random, candidates):
+            if accept(position):
+                songs.append(self.get_song(position))
+                if len(songs) == count:
+                    break
+        return songs
+
+    def get_song(self, position: int) -> Song:
+        entry = self.columns.get_entry(position)
+        return Song(
+            **entry.model_dump(),
+            absolute_path=self.root / entry.path,
+            remote_id=self.columns.get_remote_id(position),
+        )
+
+    def get_file(self, song_id: str) -> bytes:
+        song = self.get_song_by_id(song_id)
+        if song is None:
+            raise KeyError(song_id)
+        return song.absolute_path.read_bytes()
+
+    def get_song_by_id(self, song_id: str) -> Optional[Song]:
+        position = self.columns.find(song_id)
+        if position is None:
+            return None
+        return self.get_song(position)
+
+    def __len__(self) -> int:
+        return len(self.columns)
+
+    @staticmethod
+    def from_file(
+        file: Path, random: Optional[Random] = None, snapshot: bool = False
+    ) -> ColumnarSongRepository:
+        return ColumnarSongRepository(
+            columns=load_song_columns(file, snapshot=snapshot),
+            root=file.parent,
+            random=random or Random(),
+        )
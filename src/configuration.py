@@ -1,14 +1,50 @@
-from dataclasses import dataclass
-from functools import cached_property
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import cached_property, partial
 from pathlib import Path
 from random import Random
-from typing import Optional
+from typing import (
+    Awaitable,
+    Callable,
+    Iterable,
+    Literal,
+    Optional,
+    Sequence,
+    TypeVar,
+    Union,
+)
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-from ratings import InMemoryRatingRepository, RatingRepository
-from songs import InMemorySongRepository, SongRepository
-from users import InMemoryUserRepository, UserRepository
+from columnar import ColumnarSongRepository, load_song_columns
+from database import (
+    Database,
+    SqliteRatingRepositoryCache,
+    SqliteSongRepository,
+)
+from metrics import Sample, metrics
+from ratings import (
+    RATING_FILE_NAMES,
+    InMemoryRatingRepository,
+    PlayedSong,
+    PlayLogOptions,
+    RatingRepository,
+    RatingRepositoryCache,
+    SongPlay,
+    WriteBehindOptions,
+)
+from songs import CatalogDiff, InMemorySongRepository, SongFileCache, SongRepository
+from users import CredentialCache, InMemoryUserRepository, UserRepository
+from util import FileSignature, get_file_signature
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
 
 
 class AppSettings(BaseSettings):
@@ -17,38 +53,537 @@ class AppSettings(BaseSettings):
     METADATA_PATH: Path = Path("/songs/metadata.json")
     RATING_DIR_PATH: Path = Path("/ratings/")
     USER_PATH: Path = Path("/users.json")
+    # "columnar" uses less memory for large catalogs, "sqlite" stores the catalog
+    # in the database `DATABASE_PATH` (imported from the metadata file if empty)
+    SONG_REPOSITORY: Literal["memory", "columnar", "sqlite"] = "memory"
+    # load the catalog from a binary snapshot next to the metadata file
+    SONG_SNAPSHOT: bool = False
+    # keep the most downloaded song files in memory, up to this number of bytes
+    # (0 to disable), files larger than `SONG_FILE_CACHE_MAX_FILE_BYTES` (a
+    # quarter of the cache by default) are always read from disk
+    SONG_FILE_CACHE_BYTES: int = 0
+    SONG_FILE_CACHE_MAX_FILE_BYTES: Optional[int] = None
+    # check the metadata file every so often (seconds), and reload it if it has
+    # changed (0 to disable)
+    METADATA_RELOAD_INTERVAL: float = 0.0
+    # the users allowed to reload the catalog with `/catalog/reload/` (none by
+    # default: a reload reads the whole metadata file)
+    ADMIN_USERS: list[str] = []
+    # the endpoints run the blocking work in these thread pools, to keep the
+    # event loop free: disk writes in the first one, parsing and bcrypt in the
+    # second one
+    IO_THREADS: int = 16
+    CPU_THREADS: int = 4
+    RATING_CACHE_SIZE: int = 64
+    # "log" appends the plays to a log, folded into the ratings file from time to
+    # time, "sqlite" stores them in the database `DATABASE_PATH` (see the
+    # `migrate` command)
+    RATING_STORAGE: Literal["snapshot", "log", "sqlite"] = "snapshot"
+    RATING_LOG_FSYNC: bool = False
+    RATING_LOG_COMPACTION_THRESHOLD: int = 1000
+    # "binary" stores the ratings in a `ratings.bin` file, faster to load than
+    # `ratings.json` (see the `convert-ratings` command)
+    RATING_FORMAT: Literal["json", "binary"] = "json"
+    # the plays of a user posted within this delay (seconds) are saved together
+    RATING_COMMIT_DELAY: float = 0.01
+    # acknowledge the plays before saving them, and save them in the background
+    # after this delay (seconds), or once a user has this number of unsaved
+    # plays (0 to save them before acknowledging them)
+    RATING_WRITE_BEHIND_DELAY: float = 0.0
+    RATING_WRITE_BEHIND_MAX_PLAYS: int = 100
+    # shared by the workers, with the "sqlite" repositories
+    DATABASE_PATH: Path = Path("/ratings/vgsserver.db")
+    # successful logins are remembered for this duration (seconds), to skip bcrypt
+    CREDENTIAL_CACHE_TTL: float = 300.0
+    CREDENTIAL_CACHE_SIZE: int = 1024
+    # publish metrics in the Prometheus format on `/metrics`
+    METRICS: bool = False
+    # load the catalog, the users and the ratings of the `WARM_UP_RATINGS` users
+    # who played most recently when the application starts: before accepting
+    # requests ("startup") or while accepting them ("background"), see
+    # `/health/ready`
+    WARM_UP: Literal["none", "startup", "background"] = "startup"
+    WARM_UP_RATINGS: int = 0
+
+
+@dataclass
+class WarmUpState:
+    status: Literal["pending", "loading", "ready", "failed"] = "pending"
+    # seconds, by part ("catalog", "users", "ratings" and "total")
+    timings: dict[str, float] = field(default_factory=dict)
+    errors: dict[str, str] = field(default_factory=dict)
 
 
 @dataclass
 class AppConfiguration:
     settings: AppSettings
     random_seed: Optional[int] = None
+    _users: Optional[UserRepository] = field(default=None, init=False, repr=False)
+    _users_signature: Optional[FileSignature] = field(
+        default=None, init=False, repr=False
+    )
+    _users_lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+    _songs: Optional[SongRepository] = field(default=None, init=False, repr=False)
+    _songs_signature: Optional[FileSignature] = field(
+        default=None, init=False, repr=False
+    )
+    # the signature of a metadata file that couldn't be loaded, not loaded
+    # again by `check_songs` until it changes
+    _songs_failed_signature: Optional[FileSignature] = field(
+        default=None, init=False, repr=False
+    )
+    _songs_checked_at: float = field(default=0.0, init=False, repr=False)
+    _songs_lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+    warm_up_state: WarmUpState = field(
+        default_factory=WarmUpState, init=False, repr=False
+    )
 
-    @cached_property
+    def __post_init__(self) -> None:
+        if self.settings.METRICS:
+            metrics.enabled = True
+
+    @property
     def songs(self) -> SongRepository:
+        """The song repository, loaded when first needed.
+
+        With `METADATA_RELOAD_INTERVAL`, a new repository is loaded in the
+        background when the metadata file changes, and replaces the current one
+        once ready.
+        """
+        songs = self._songs
+        if songs is None:
+            with self._songs_lock:
+                if self._songs is None:
+                    self._songs_signature = get_file_signature(
+                        self.settings.METADATA_PATH
+                    )
+                    self._songs = self.load_songs()
+                songs = self._songs
+        elif self.settings.METADATA_RELOAD_INTERVAL > 0:
+            self.check_songs()
+        return songs
+
+    def check_songs(self) -> None:
+        now = time.monotonic()
+        if now - self._songs_checked_at < self.settings.METADATA_RELOAD_INTERVAL:
+            return
+        self._songs_checked_at = now
+        signature = get_file_signature(self.settings.METADATA_PATH)
+        if (
+            signature != self._songs_signature
+            and signature != self._songs_failed_signature
+            and not self._songs_lock.locked()
+        ):
+            threading.Thread(
+                target=self._reload_songs_in_background, daemon=True
+            ).start()
+
+    def _reload_songs_in_background(self) -> None:
+        try:
+            self.reload_songs()
+        except Exception:
+            logger.exception("Can't reload the catalog")
+
+    def reload_songs(self) -> Optional[CatalogDiff]:
+        """Load the metadata file again, and replace the song repository.
+
+        The default repository is updated incrementally, and the differences
+        are returned. Other repositories are loaded again.
+        """
+        with self._songs_lock:
+            signature = get_file_signature(self.settings.METADATA_PATH)
+            songs: SongRepository
+            diff = None
+            try:
+                if isinstance(
+                    self._songs, (InMemorySongRepository, SqliteSongRepository)
+                ):
+                    songs, diff = self._songs.update_from_file(
+                        self.settings.METADATA_PATH
+                    )
+                else:
+                    songs = self.load_songs()
+            except Exception:
+                self._songs_failed_signature = signature
+                raise
+            self._songs = songs
+            self._songs_signature = signature
+            return diff
+
+    def load_songs(self) -> SongRepository:
+        with metrics.time("vgsserver_stage_seconds", stage="catalog_load"):
+            return self._load_songs()
+
+    def _load_songs(self) -> SongRepository:
+        if self.settings.SONG_REPOSITORY == "sqlite":
+            return SqliteSongRepository.open(
+                self.database, self.settings.METADATA_PATH, random=self.random
+            )
+        if self.settings.SONG_REPOSITORY == "columnar":
+            return ColumnarSongRepository.from_file(
+                self.settings.METADATA_PATH,
+                random=self.random,
+                snapshot=self.settings.SONG_SNAPSHOT,
+            )
+        if self.settings.SONG_SNAPSHOT:
+            columns = load_song_columns(self.settings.METADATA_PATH, snapshot=True)
+            return InMemorySongRepository(
+                songs=columns.to_songs(self.settings.METADATA_PATH.parent),
+                random=self.random,
+            )
         return InMemorySongRepository.from_file(
             self.settings.METADATA_PATH,
             random=self.random,
         )
 
     def get_ratings_path_for_user(self, username: str) -> Path:
-        return self.settings.RATING_DIR_PATH / username / "ratings.json"
+        file_name = RATING_FILE_NAMES[self.settings.RATING_FORMAT]
+        return self.settings.RATING_DIR_PATH / username / file_name
 
     def get_ratings_for_user(self, username: str) -> RatingRepository:
-        (self.settings.RATING_DIR_PATH / username).mkdir(exist_ok=True, parents=True)
-        path = self.get_ratings_path_for_user(username)
-        if path.exists():
-            return InMemoryRatingRepository.from_file(path)
-        else:
-            return InMemoryRatingRepository(ratings=dict(), file=path)
+        if self.settings.RATING_STORAGE == "sqlite":
+            return self.sqlite_rating_cache.get(username)
+        return self.rating_cache.get(username, self.get_ratings_path_for_user(username))
+
+    def read_ratings_for_user(
+        self, username: str, function: Callable[[RatingRepository], T]
+    ) -> T:
+        if self.settings.RATING_STORAGE == "sqlite":
+            ratings = self.sqlite_rating_cache.get(username)
+            # the samplers are modified while drawing
+            with ratings.lock, self.database.reading():
+                return function(ratings)
+        return self.rating_cache.read(
+            username, self.get_ratings_path_for_user(username), function
+        )
+
+    def add_play_for_user(
+        self,
+        username: str,
+        song_id: str,
+        song_path: Path,
+        timestamp: int,
+        rating: Literal[0, 1, 2, 3, 4, 5],
+    ) -> Optional[float]:
+        if self.settings.RATING_STORAGE == "sqlite":
+            ratings = self.sqlite_rating_cache.get(username)
+            with metrics.time("vgsserver_stage_seconds", stage="save"):
+                with self.database.transaction():
+                    ratings.add_play(song_id, song_path, timestamp, rating)
+                    return ratings.get_rating(song_id)
+        return self.rating_cache.add_play(
+            username,
+            self.get_ratings_path_for_user(username),
+            song_id=song_id,
+            song_path=song_path,
+            timestamp=timestamp,
+            rating=rating,
+        )
+
+    def add_plays_for_user(
+        self, username: str, plays: Sequence[SongPlay]
+    ) -> tuple[list[bool], dict[str, Optional[float]]]:
+        """Add the new plays (see `RatingRepository.add_new_plays`) with a single
+        write, and return whether each play was added and the new ratings."""
+        if self.settings.RATING_STORAGE == "sqlite":
+            ratings = self.sqlite_rating_cache.get(username)
+            with metrics.time("vgsserver_stage_seconds", stage="save"):
+                with self.database.transaction():
+                    added = ratings.add_new_plays(plays)
+                    return added, {
+                        song_id: ratings.get_rating(song_id) for song_id, _, _ in plays
+                    }
+        return self.rating_cache.add_plays(
+            username, self.get_ratings_path_for_user(username), plays
+        )
+
+    def merge_ratings_for_user(
+        self, username: str, played_songs: Iterable[PlayedSong]
+    ) -> int:
+        if self.settings.RATING_STORAGE == "sqlite":
+            return self.sqlite_rating_cache.get(username).merge(played_songs)
+        return self.rating_cache.merge(
+            username, self.get_ratings_path_for_user(username), played_songs
+        )
+
+    def replace_ratings_file_for_user(self, username: str, source: Path) -> None:
+        if self.settings.RATING_STORAGE == "sqlite":
+            self.sqlite_rating_cache.get(username).replace(
+                InMemoryRatingRepository.load_songs_from_file(source)
+            )
+            return
+        self.rating_cache.replace_file(
+            username, self.get_ratings_path_for_user(username), source
+        )
+
+    @cached_property
+    def song_file_cache(self) -> Optional[SongFileCache]:
+        if self.settings.SONG_FILE_CACHE_BYTES <= 0:
+            return None
+        return SongFileCache(
+            max_bytes=self.settings.SONG_FILE_CACHE_BYTES,
+            max_file_bytes=self.settings.SONG_FILE_CACHE_MAX_FILE_BYTES,
+        )
+
+    @cached_property
+    def database(self) -> Database:
+        return Database(self.settings.DATABASE_PATH)
+
+    @cached_property
+    def sqlite_rating_cache(self) -> SqliteRatingRepositoryCache:
+        return SqliteRatingRepositoryCache(
+            self.database, max_size=self.settings.RATING_CACHE_SIZE
+        )
+
+    @cached_property
+    def rating_cache(self) -> RatingRepositoryCache:
+        play_log = None
+        if self.settings.RATING_STORAGE == "log":
+            play_log = PlayLogOptions(
+                fsync=self.settings.RATING_LOG_FSYNC,
+                compaction_threshold=self.settings.RATING_LOG_COMPACTION_THRESHOLD,
+            )
+        write_behind = None
+        if self.settings.RATING_WRITE_BEHIND_DELAY > 0:
+            write_behind = WriteBehindOptions(
+                delay=self.settings.RATING_WRITE_BEHIND_DELAY,
+                max_plays=self.settings.RATING_WRITE_BEHIND_MAX_PLAYS,
+            )
+        return RatingRepositoryCache(
+            max_size=self.settings.RATING_CACHE_SIZE,
+            play_log=play_log,
+            commit_delay=self.settings.RATING_COMMIT_DELAY,
+            write_behind=write_behind,
+            file_format=self.settings.RATING_FORMAT,
+        )
+
+    @cached_property
+    def io_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.settings.IO_THREADS, thread_name_prefix="io"
+        )
+
+    @cached_property
+    def cpu_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.settings.CPU_THREADS, thread_name_prefix="cpu"
+        )
+
+    async def run_io_bound(self, function: Callable[[], T]) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_executor, function)
+
+    async def run_cpu_bound(self, function: Callable[[], T]) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.cpu_executor, function)
 
     @cached_property
     def random(self) -> Random:
         return Random(self.random_seed)
 
-    @cached_property
+    @property
     def users(self) -> UserRepository:
-        return InMemoryUserRepository.from_file(self.settings.USER_PATH)
+        """The users, reloaded (with a new credential cache) if the file changed."""
+        signature = get_file_signature(self.settings.USER_PATH)
+        with self._users_lock:
+            if self._users is None or self._users_signature != signature:
+                self._users = InMemoryUserRepository.from_file(
+                    self.settings.USER_PATH,
+                    credential_cache=CredentialCache(
+                        ttl=self.settings.CREDENTIAL_CACHE_TTL,
+                        max_size=self.settings.CREDENTIAL_CACHE_SIZE,
+                    ),
+                )
+                self._users_signature = signature
+            return self._users
+
+    async def warm_up(self) -> None:
+        """Load the catalog, the users and the ratings of the recent users, in
+        parallel, so that the first requests don't have to.
+
+        The ratings are best-effort: a user whose ratings can't be loaded is
+        reported in the errors (as `ratings:<username>`), but only the catalog
+        and the users make the warm-up fail.
+        """
+        state = self.warm_up_state
+        state.status = "loading"
+        start = time.perf_counter()
+
+        async def load(name: str, awaitable: Awaitable[object]) -> bool:
+            part_start = time.perf_counter()
+            try:
+                await awaitable
+            except Exception as e:
+                logger.exception("Can't load the %s", name)
+                state.errors[name] = str(e)
+                return False
+            finally:
+                state.timings[name] = time.perf_counter() - part_start
+            return True
+
+        async def load_ratings(username: str) -> None:
+            try:
+                await self.run_io_bound(partial(self.get_ratings_for_user, username))
+            except Exception as e:
+                logger.exception("Can't load the ratings of %s", username)
+                state.errors[f"ratings:{username}"] = str(e)
+
+        async def load_all_ratings() -> None:
+            # the ratings directory is listed in the IO pool too
+            usernames = await self.run_io_bound(
+                partial(self.get_recent_usernames, self.settings.WARM_UP_RATINGS)
+            )
+            await asyncio.gather(*(load_ratings(u) for u in usernames))
+
+        loaded = await asyncio.gather(
+            load("catalog", self.run_io_bound(lambda: self.songs)),
+            load("users", self.run_io_bound(lambda: self.users)),
+            load("ratings", load_all_ratings()),
+        )
+        state.timings["total"] = time.perf_counter() - start
+        state.status = "ready" if all(loaded) else "failed"
+
+    def get_recent_usernames(self, count: int) -> list[str]:
+        """Return the users whose ratings file was modified most recently."""
+        if count <= 0 or self.settings.RATING_STORAGE == "sqlite":
+            return []
+        files = []
+        file_name = RATING_FILE_NAMES[self.settings.RATING_FORMAT]
+        for file in self.settings.RATING_DIR_PATH.glob(f"*/{file_name}"):
+            try:
+                files.append((file.stat().st_mtime, file.parent.name))
+            except OSError:
+                continue
+        return [username for _, username in heapq.nlargest(count, files)]
+
+    def get_metric_samples(self) -> list[Sample]:
+        """Return the metrics of the caches and the repositories."""
+        samples: list[Sample] = []
+        if self._songs is not None:
+            samples.append(
+                (
+                    "vgsserver_catalog_songs",
+                    "gauge",
+                    "Number of songs in the catalog.",
+                    {},
+                    len(self._songs),
+                )
+            )
+        file_cache = self.song_file_cache
+        if file_cache is not None:
+            samples += [
+                (
+                    "vgsserver_file_cache_requests_total",
+                    "counter",
+                    "Requests of the song file cache.",
+                    {"result": "hit"},
+                    file_cache.hits,
+                ),
+                (
+                    "vgsserver_file_cache_requests_total",
+                    "counter",
+                    "Requests of the song file cache.",
+                    {"result": "miss"},
+                    file_cache.misses,
+                ),
+                (
+                    "vgsserver_file_cache_requests_total",
+                    "counter",
+                    "Requests of the song file cache.",
+                    {"result": "coalesced"},
+                    file_cache.coalesced,
+                ),
+                (
+                    "vgsserver_file_cache_bytes_saved_total",
+                    "counter",
+                    "Bytes of song files sent from the cache instead of the disk.",
+                    {},
+                    file_cache.bytes_saved,
+                ),
+                (
+                    "vgsserver_file_cache_bytes",
+                    "gauge",
+                    "Bytes of song files in the cache.",
+                    {},
+                    file_cache.size,
+                ),
+            ]
+        # the repositories of the sqlite storage only keep their samplers,
+        # there are no files to save
+        rating_cache: Union[RatingRepositoryCache, SqliteRatingRepositoryCache]
+        if self.settings.RATING_STORAGE == "sqlite":
+            rating_cache = self.sqlite_rating_cache
+        else:
+            rating_cache = self.rating_cache
+        samples += [
+            (
+                "vgsserver_rating_repositories_loaded",
+                "gauge",
+                "Number of rating repositories in memory.",
+                {},
+                len(rating_cache),
+            ),
+            (
+                "vgsserver_rating_cache_requests_total",
+                "counter",
+                "Requests of the rating cache.",
+                {"result": "hit"},
+                rating_cache.hits,
+            ),
+            (
+                "vgsserver_rating_cache_requests_total",
+                "counter",
+                "Requests of the rating cache.",
+                {"result": "miss"},
+                rating_cache.misses,
+            ),
+        ]
+        if isinstance(rating_cache, RatingRepositoryCache):
+            samples += [
+                (
+                    "vgsserver_rating_saves_total",
+                    "counter",
+                    "Writes of the rating files (a write can save several plays).",
+                    {},
+                    rating_cache.saves,
+                ),
+                (
+                    "vgsserver_rating_dirty_users",
+                    "gauge",
+                    "Number of users with plays not saved yet (write-behind mode).",
+                    {},
+                    len(rating_cache.dirty),
+                ),
+            ]
+        users = self._users
+        if isinstance(users, InMemoryUserRepository):
+            cache = users.credential_cache
+            samples += [
+                (
+                    "vgsserver_credential_cache_requests_total",
+                    "counter",
+                    "Requests of the credential cache.",
+                    {"result": "hit"},
+                    cache.hits,
+                ),
+                (
+                    "vgsserver_credential_cache_requests_total",
+                    "counter",
+                    "Requests of the credential cache.",
+                    {"result": "miss"},
+                    cache.misses,
+                ),
+            ]
+        return samples
+
+    def close(self) -> None:
+        """Save the plays that are not saved yet, before exiting."""
+        if "rating_cache" in self.__dict__:
+            self.rating_cache.close()
 
     def __hash__(self) -> int:
         return id(self)
@@ -57,5 +592,5 @@ class AppConfiguration:
 _app_configuration = AppConfiguration(settings=AppSettings())
 
 
-def get_app_configuration() -> AppConfiguration:
+async def get_app_configuration() -> AppConfiguration:
     return _app_configuration
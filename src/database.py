@@ -0,0 +1,920 @@
+"""Song and rating repositories stored in a SQLite database.
+
+Several processes (like the workers of uvicorn) can share the database: it is
+in WAL mode, so that the reads don't wait for the writes. Each thread has its
+own connection.
+"""
+
+from __future__ import annotations
+
+import itertools
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from random import Random
+from typing import Any, Collection, Iterable, Iterator, Literal, Optional, Sequence
+
+import pydantic
+
+from ratings import (
+    InMemoryRatingRepository,
+    Play,
+    PlayedSong,
+    RatingAggregate,
+    RatingRepository,
+    SongPlay,
+    get_weight_terms,
+    make_sampler,
+)
+from sampling import SamplerKeys, WeightedSampler, Weighting
+from songs import (
+    CatalogDiff,
+    MetadataEntry,
+    Song,
+    SongRepository,
+    iter_random_permutation,
+    make_rating_filter,
+    make_song,
+)
+from util import _compute_remote_id
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    -- an alias of the rowid, which is not renumbered by VACUUM: the index of
+    -- the titles refers to it
+    position INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    loop_start INTEGER NOT NULL,
+    loop_end INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT,
+    game_title TEXT,
+    error INTEGER NOT NULL,
+    -- casefolded by python, for the case insensitive searches
+    folded_title TEXT,
+    folded_game_title TEXT
+);
+CREATE INDEX IF NOT EXISTS songs_duration ON songs (duration);
+-- the songs without text match all the searches
+CREATE INDEX IF NOT EXISTS songs_without_title ON songs (position)
+    WHERE folded_title IS NULL;
+CREATE INDEX IF NOT EXISTS songs_without_game_title ON songs (position)
+    WHERE folded_game_title IS NULL;
+
+-- the trigrams of the titles, for the substring searches (see `search_text`),
+-- kept up to date by the triggers
+CREATE VIRTUAL TABLE IF NOT EXISTS songs_text USING fts5 (
+    folded_title,
+    folded_game_title,
+    content = 'songs',
+    content_rowid = 'position',
+    tokenize = 'trigram'
+);
+CREATE TRIGGER IF NOT EXISTS songs_text_insert AFTER INSERT ON songs BEGIN
+    INSERT INTO songs_text (rowid, folded_title, folded_game_title)
+    VALUES (new.position, new.folded_title, new.folded_game_title);
+END;
+CREATE TRIGGER IF NOT EXISTS songs_text_delete AFTER DELETE ON songs BEGIN
+    INSERT INTO songs_text (songs_text, rowid, folded_title, folded_game_title)
+    VALUES ('delete', old.position, old.folded_title, old.folded_game_title);
+END;
+CREATE TRIGGER IF NOT EXISTS songs_text_update
+AFTER UPDATE OF folded_title, folded_game_title ON songs BEGIN
+    INSERT INTO songs_text (songs_text, rowid, folded_title, folded_game_title)
+    VALUES ('delete', old.position, old.folded_title, old.folded_game_title);
+    INSERT INTO songs_text (rowid, folded_title, folded_game_title)
+    VALUES (new.position, new.folded_title, new.folded_game_title);
+END;
+
+-- incremented by each change of the catalog ("catalog") and of the ratings of
+-- a user ("ratings:<username>"), so that the processes know when the data of
+-- their caches (like the weighted samplers) is outdated
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+-- the songs played by each user, in the order of the ratings file, with the
+-- aggregates of their plays (see `RatingAggregate`)
+CREATE TABLE IF NOT EXISTS played_songs (
+    position INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    song_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    plays INTEGER NOT NULL DEFAULT 0,
+    rated_plays INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    last_played INTEGER,
+    rating REAL,
+    UNIQUE (username, song_id)
+);
+CREATE INDEX IF NOT EXISTS played_songs_rating ON played_songs (username, rating);
+CREATE INDEX IF NOT EXISTS played_songs_last_played
+    ON played_songs (username, last_played);
+
+CREATE TABLE IF NOT EXISTS plays (
+    played_song INTEGER NOT NULL REFERENCES played_songs (position),
+    username TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    rating INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plays_played_song ON plays (played_song);
+CREATE INDEX IF NOT EXISTS plays_timestamp ON plays (username, timestamp);
+"""
+
+SONG_COLUMNS = (
+    "id, path, timestamp, loop_start, loop_end, duration, size, title, game_title, "
+    "error"
+)
+SONG_UPDATED_COLUMNS = SONG_COLUMNS.split(", ")[1:] + [
+    "folded_title",
+    "folded_game_title",
+]
+
+
+@dataclass
+class Database:
+    file: Path
+    # seconds to wait for the lock of another writer
+    timeout: float = 10.0
+    _local: threading.local = field(
+        default_factory=threading.local, init=False, repr=False, compare=False
+    )
+
+    def connect(self) -> sqlite3.Connection:
+        """Return the connection of the current thread, creating the schema."""
+        connection: Optional[sqlite3.Connection] = getattr(
+            self._local, "connection", None
+        )
+        if connection is None:
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            # the transactions are explicit (see `transaction` and `reading`)
+            connection = sqlite3.connect(
+                self.file,
+                timeout=self.timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run a write transaction, or join the current one."""
+        connection = self.connect()
+        if connection.in_transaction:
+            yield connection
+            return
+        # take the write lock now, rather than failing to upgrade a read lock
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @contextmanager
+    def reading(self) -> Iterator[sqlite3.Connection]:
+        """Make the queries of the block see the same state of the database."""
+        connection = self.connect()
+        if connection.in_transaction:
+            yield connection
+            return
+        connection.execute("BEGIN")
+        try:
+            yield connection
+        finally:
+            connection.execute("COMMIT")
+
+    def close(self) -> None:
+        """Close the connection of the current thread."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def fold(text: Optional[str]) -> Optional[str]:
+    return text.casefold() if text is not None else None
+
+
+def make_song_row(song: Song) -> tuple[Any, ...]:
+    return (
+        song.remote_id,
+        str(song.path),
+        song.timestamp,
+        song.loop_start,
+        song.loop_end,
+        song.duration,
+        song.size,
+        song.title,
+        song.game_title,
+        int(song.error),
+        fold(song.title),
+        fold(song.game_title),
+    )
+
+
+def get_version(connection: sqlite3.Connection, name: str) -> int:
+    row = connection.execute(
+        "SELECT version FROM versions WHERE name = ?", (name,)
+    ).fetchone()
+    return int(row[0]) if row is not None else 0
+
+
+def increment_version(connection: sqlite3.Connection, name: str) -> int:
+    """Increment a version (in the current transaction) and return it."""
+    connection.execute(
+        "INSERT INTO versions (name, version) VALUES (?, 1) "
+        "ON CONFLICT (name) DO UPDATE SET version = version + 1",
+        (name,),
+    )
+    return get_version(connection, name)
+
+
+def search_text(column: str, needle: str) -> tuple[str, list[Any]]:
+    """Return a condition on the songs `s` whose `column` contains `needle`
+    (casefolded) or is null, and its parameters.
+
+    The songs are found with the trigram index, or by a scan if the needle
+    is too short to have a trigram.
+    """
+    needle = needle.casefold()
+    if len(needle) < 3:
+        return f"(s.{column} IS NULL OR instr(s.{column}, ?) > 0)", [needle]
+    phrase = '"' + needle.replace('"', '""') + '"'
+    return (
+        "s.position IN ("
+        f"SELECT rowid FROM songs_text WHERE songs_text MATCH ? "
+        f"UNION ALL SELECT position FROM songs WHERE {column} IS NULL)",
+        [f"{column} : {phrase}"],
+    )
+
+
+# a query checking a drawn song costs about as much as reading this number of
+# rows (see `is_too_sparse`)
+ROWS_PER_QUERY = 16
+
+
+def is_too_sparse(count: int, candidates: int, matches: int) -> bool:
+    """Tell whether it is faster to read the `matches` songs that pass the
+    filters, than to draw among `candidates` songs until `count` of them pass
+    the filters (checking each drawn song with a query)."""
+    return count * candidates * ROWS_PER_QUERY > matches * matches
+
+
+@dataclass
+class SqliteSongRepository(SongRepository):
+    database: Database
+    # the directory of the song files (the directory of the metadata file)
+    root: Path
+    random: Random = field(default_factory=Random)
+    # the keys of the weighted samplers of the ratings (the ids of all the songs,
+    # by duration), and the version of the catalog they were read from
+    _sampler_keys: Optional[tuple[int, SamplerKeys]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    @classmethod
+    def open(
+        cls, database: Database, file: Path, random: Optional[Random] = None
+    ) -> SqliteSongRepository:
+        """Open the catalog of `database`, importing the metadata `file` if the
+        catalog is empty."""
+        repository = cls(database=database, root=file.parent, random=random or Random())
+        with database.transaction() as connection:
+            if connection.execute("SELECT 1 FROM songs LIMIT 1").fetchone() is None:
+                repository.update_from_file(file)
+        return repository
+
+    def update_from_file(self, file: Path) -> tuple[SqliteSongRepository, CatalogDiff]:
+        """Replace the catalog with the songs of the metadata `file`.
+
+        Only the songs that were added, removed or changed are written.
+        """
+        data = json.loads(file.read_text())
+        entries = pydantic.TypeAdapter(list[MetadataEntry]).validate_python(data)
+        rows = {
+            row[0]: row
+            for row in (make_song_row(make_song(e, file.parent)) for e in entries)
+        }
+        with self.database.transaction() as connection:
+            current = {
+                row[0]: row
+                for row in connection.execute(
+                    f"SELECT {SONG_COLUMNS}, folded_title, folded_game_title "
+                    "FROM songs"
+                )
+            }
+            removed = current.keys() - rows.keys()
+            written = [row for id, row in rows.items() if current.get(id) != row]
+            connection.executemany(
+                "DELETE FROM songs WHERE id = ?", ((id,) for id in removed)
+            )
+            # an update keeps the position of the song (and runs the triggers,
+            # unlike the deletion of a REPLACE)
+            connection.executemany(
+                f"INSERT INTO songs ({SONG_COLUMNS}, folded_title, "
+                "folded_game_title) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET "
+                + ", ".join(
+                    f"{column} = excluded.{column}" for column in SONG_UPDATED_COLUMNS
+                ),
+                written,
+            )
+            if removed or written:
+                increment_version(connection, "catalog")
+        changed = sum(1 for row in written if row[0] in current)
+        self.root = file.parent
+        return self, CatalogDiff(
+            added=len(written) - changed,
+            removed=len(removed),
+            changed=changed,
+            unchanged=len(rows) - len(written),
+        )
+
+    def get_sampler_keys(self, connection: sqlite3.Connection) -> SamplerKeys:
+        """Return the keys of the samplers, read again if the catalog changed."""
+        version = get_version(connection, "catalog")
+        cached = self._sampler_keys
+        if cached is None or cached[0] != version:
+            ids = [
+                row[0]
+                for row in connection.execute(
+                    "SELECT id FROM songs ORDER BY duration, position"
+                )
+            ]
+            cached = self._sampler_keys = (version, SamplerKeys(ids))
+        return cached[1]
+
+    def get_random_songs(
+        self,
+        ratings: RatingRepository,
+        count: int,
+        min_duration: Optional[int] = None,
+        title_contains: Optional[str] = None,
+        game_title_contains: Optional[str] = None,
+        min_rating: Optional[int] = None,
+        only_has_rating: Optional[bool] = None,
+        only_has_no_rating: Optional[bool] = None,
+        excluded_ids: Collection[str] = (),
+        weighting: Optional[Weighting] = None,
+    ) -> list[Song]:
+        """Draw songs without reading the whole catalog: songs are drawn (at
+        random positions, or by the sampler of the ratings) and checked with
+        the filters, one query each. If few songs pass the filters, they are
+        read with the indexes (see `is_too_sparse`) and drawn from instead.
+
+        The rating filters are part of the queries if the ratings are in the
+        same database, else they are checked on the drawn songs.
+        """
+        if count <= 0:
+            return []
+        joined = (
+            isinstance(ratings, SqliteRatingRepository)
+            and ratings.database.file == self.database.file
+        )
+        # the conditions on the songs `s`, except the minimum duration
+        conditions: list[str] = []
+        parameters: list[Any] = []
+        for column, needle in (
+            ("folded_title", title_contains),
+            ("folded_game_title", game_title_contains),
+        ):
+            if needle:
+                condition, condition_parameters = search_text(column, needle)
+                conditions.append(condition)
+                parameters += condition_parameters
+        source = "FROM songs s"
+        if joined and (only_has_rating or only_has_no_rating or min_rating is not None):
+            assert isinstance(ratings, SqliteRatingRepository)
+            source = (
+                "FROM songs s LEFT JOIN played_songs r "
+                "ON r.username = ? AND r.song_id = s.id"
+            )
+            parameters.insert(0, ratings.username)
+            if only_has_rating:
+                conditions.append("r.rating IS NOT NULL")
+            if only_has_no_rating:
+                conditions.append("r.rating IS NULL")
+            if min_rating is not None:
+                conditions.append("(r.rating IS NULL OR r.rating >= ?)")
+                parameters.append(min_rating)
+        duration_conditions = conditions
+        duration_parameters = parameters
+        if min_duration is not None:
+            duration_conditions = [*conditions, "s.duration >= ?"]
+            duration_parameters = [*parameters, min_duration]
+
+        def make_query(select: str, conditions: list[str]) -> str:
+            query = f"SELECT {select} {source}"
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            return query
+
+        rating_filter = None
+        if not joined:
+            rating_filter = make_rating_filter(
+                ratings=ratings,
+                min_rating=min_rating,
+                only_has_rating=only_has_rating,
+                only_has_no_rating=only_has_no_rating,
+            )
+
+        def accept(id: str) -> bool:
+            if id in excluded_ids:
+                return False
+            return rating_filter is None or rating_filter(id)
+
+        with self.database.reading() as connection:
+
+            def matches(id: str) -> bool:
+                """Check the conditions (but the duration) on a song."""
+                if not conditions:
+                    return True
+                query = make_query("1", [*conditions, "s.id = ?"])
+                return (
+                    connection.execute(query, [*parameters, id]).fetchone() is not None
+                )
+
+            def select(ids: Sequence[str]) -> list[str]:
+                """Return the songs `ids` that pass the conditions."""
+                selected = []
+                # the number of parameters of a query is limited
+                for start in range(0, len(ids), 500):
+                    batch = ids[start : start + 500]
+                    query = make_query(
+                        "s.id",
+                        [
+                            *duration_conditions,
+                            f"s.id IN ({', '.join('?' * len(batch))})",
+                        ],
+                    )
+                    selected += [
+                        row[0]
+                        for row in connection.execute(
+                            query, [*duration_parameters, *batch]
+                        )
+                    ]
+                return selected
+
+            def select_all() -> list[str]:
+                query = make_query("s.id", duration_conditions)
+                return [
+                    row[0] for row in connection.execute(query, duration_parameters)
+                ]
+
+            def count_matches() -> int:
+                query = make_query("count(*)", duration_conditions)
+                return int(connection.execute(query, duration_parameters).fetchone()[0])
+
+            # draw from the rated songs if the ratings are not in the database
+            pool = None
+            if only_has_rating and not joined:
+                pool = select(list(ratings.get_rated_song_ids(min_rating)))
+
+            if weighting is None:
+                if pool is None:
+                    # the positions have few gaps (the removed songs)
+                    (last_position,) = connection.execute(
+                        "SELECT coalesce(max(position), 0) FROM songs"
+                    ).fetchone()
+                    if duration_conditions and is_too_sparse(
+                        count, last_position, count_matches()
+                    ):
+                        pool = select_all()
+                if pool is not None:
+                    chosen = list(
+                        itertools.islice(
+                            filter(accept, iter_random_permutation(self.random, pool)),
+                            count,
+                        )
+                    )
+                else:
+                    # probe random positions
+                    query = make_query("s.id", [*duration_conditions, "s.position = ?"])
+                    chosen = []
+                    for position in iter_random_permutation(
+                        self.random, range(1, last_position + 1)
+                    ):
+                        row = connection.execute(
+                            query, [*duration_parameters, position]
+                        ).fetchone()
+                        if row is not None and accept(row[0]):
+                            chosen.append(row[0])
+                            if len(chosen) == count:
+                                break
+                return self._get_songs(connection, chosen)
+
+            keys = self.get_sampler_keys(connection)
+            sampler = ratings.get_sampler(weighting, keys)
+            start = 0
+            if min_duration is not None:
+                (start,) = connection.execute(
+                    "SELECT count(*) FROM songs WHERE duration < ?", (min_duration,)
+                ).fetchone()
+            if (
+                pool is None
+                and conditions
+                and is_too_sparse(count, len(keys) - start, count_matches())
+            ):
+                pool = select_all()
+            if pool is not None:
+                chosen = sampler.sample_from(
+                    self.random, filter(accept, pool), count, lambda id: id
+                )
+            else:
+                chosen = [
+                    keys[i]
+                    for i in sampler.sample(
+                        self.random,
+                        count,
+                        lambda i: accept(keys[i]) and matches(keys[i]),
+                        start=start,
+                    )
+                ]
+            return self._get_songs(connection, chosen)
+
+    def _get_songs(
+        self, connection: sqlite3.Connection, ids: Sequence[str]
+    ) -> list[Song]:
+        """Return the songs `ids`, in this order."""
+        songs: dict[str, Song] = {}
+        # the number of parameters of a query is limited
+        for start in range(0, len(ids), 500):
+            batch = ids[start : start + 500]
+            for row in connection.execute(
+                f"SELECT {SONG_COLUMNS} FROM songs "
+                f"WHERE id IN ({', '.join('?' * len(batch))})",
+                batch,
+            ):
+                songs[row[0]] = self._make_song(row)
+        return [songs[id] for id in ids if id in songs]
+
+    def _make_song(self, row: Sequence[Any]) -> Song:
+        id, path, timestamp, loop_start, loop_end, duration, size = row[:7]
+        title, game_title, error = row[7:]
+        return Song(
+            path=Path(path),
+            timestamp=timestamp,
+            loop_start=loop_start,
+            loop_end=loop_end,
+            duration=duration,
+            size=size,
+            title=title,
+            game_title=game_title,
+            error=bool(error),
+            absolute_path=self.root / path,
+            remote_id=id,
+        )
+
+    def get_file(self, song_id: str) -> bytes:
+        song = self.get_song_by_id(song_id)
+        if song is None:
+            raise KeyError(song_id)
+        return song.absolute_path.read_bytes()
+
+    def get_song_by_id(self, song_id: str) -> Optional[Song]:
+        songs = self._get_songs(self.database.connect(), [song_id])
+        return songs[0] if songs else None
+
+    def __len__(self) -> int:
+        row = self.database.connect().execute("SELECT count(*) FROM songs").fetchone()
+        return int(row[0])
+
+
+@dataclass
+class SqliteRatingRepository(RatingRepository):
+    """The ratings of a user in a database.
+
+    The plays are written by `add_play` (in the current transaction of the
+    database, if any), so `save` does nothing.
+
+    The samplers are kept while the version of the ratings doesn't change (see
+    `SqliteRatingRepositoryCache`), and are updated by the plays added by this
+    repository. `lock` must be held while they are used.
+    """
+
+    database: Database
+    username: str
+    samplers: dict[Weighting, WeightedSampler] = field(
+        default_factory=dict, init=False, compare=False, repr=False
+    )
+    # the version of the ratings of the samplers
+    samplers_version: int = field(default=-1, init=False, compare=False, repr=False)
+    lock: threading.RLock = field(
+        default_factory=threading.RLock, init=False, compare=False, repr=False
+    )
+
+    @property
+    def version_name(self) -> str:
+        return f"ratings:{self.username}"
+
+    def get_rating(self, song_id: str) -> Optional[float]:
+        row = (
+            self.database.connect()
+            .execute(
+                "SELECT rating FROM played_songs WHERE username = ? AND song_id = ?",
+                (self.username, song_id),
+            )
+            .fetchone()
+        )
+        return row[0] if row is not None else None
+
+    def song_has_rating(self, song_id: str) -> bool:
+        return self.get_rating(song_id) is not None
+
+    def song_has_no_rating(self, song_id: str) -> bool:
+        return self.get_rating(song_id) is None
+
+    def get_rated_song_ids(self, min_rating: Optional[int] = None) -> Collection[str]:
+        query = (
+            "SELECT song_id FROM played_songs "
+            "WHERE username = ? AND rating IS NOT NULL"
+        )
+        parameters: tuple[Any, ...] = (self.username,)
+        if min_rating is not None:
+            query += " AND rating >= ?"
+            parameters += (min_rating,)
+        connection = self.database.connect()
+        # ordered, so that the draws from them are reproducible
+        rows = connection.execute(query + " ORDER BY position", parameters)
+        return dict.fromkeys(row[0] for row in rows).keys()
+
+    def get_played_songs(self) -> list[PlayedSong]:
+        with self.database.reading() as connection:
+            played_songs = {
+                position: PlayedSong(path=Path(path), plays=[])
+                for position, path in connection.execute(
+                    "SELECT position, path FROM played_songs "
+                    "WHERE username = ? ORDER BY position",
+                    (self.username,),
+                )
+            }
+            for position, timestamp, rating in connection.execute(
+                "SELECT played_song, timestamp, rating FROM plays "
+                "WHERE username = ? ORDER BY rowid",
+                (self.username,),
+            ):
+                played_songs[position].plays.append(
+                    Play(timestamp=timestamp, rating=rating)
+                )
+        return list(played_songs.values())
+
+    def get_recently_played_song_ids(self, count: int) -> set[str]:
+        if count <= 0:
+            return set()
+        connection = self.database.connect()
+        return {
+            row[0]
+            for row in connection.execute(
+                "SELECT song_id FROM played_songs "
+                "WHERE username = ? AND last_played IS NOT NULL "
+                "ORDER BY last_played DESC LIMIT ?",
+                (self.username, count),
+            )
+        }
+
+    def get_aggregates(self) -> dict[str, RatingAggregate]:
+        connection = self.database.connect()
+        return {
+            row[0]: RatingAggregate(*row[1:])
+            for row in connection.execute(
+                "SELECT song_id, plays, rated_plays, total, last_played "
+                "FROM played_songs WHERE username = ? AND plays > 0",
+                (self.username,),
+            )
+        }
+
+    def get_sampler(self, weighting: Weighting, keys: SamplerKeys) -> WeightedSampler:
+        with self.lock:
+            version = get_version(self.database.connect(), self.version_name)
+            if version != self.samplers_version:
+                self.samplers.clear()
+                self.samplers_version = version
+            sampler = self.samplers.get(weighting)
+            if sampler is None or sampler.keys is not keys:
+                sampler = self.samplers[weighting] = make_sampler(
+                    weighting, keys, self.get_aggregates()
+                )
+            return sampler
+
+    def _update_samplers(
+        self,
+        connection: sqlite3.Connection,
+        song_ids: Optional[Collection[str]] = None,
+    ) -> None:
+        """Increment the version of the ratings after a write (in its
+        transaction), and update the weights of `song_ids` in the samplers (or
+        drop them, if `song_ids` is `None` or the ratings were modified by
+        another repository)."""
+        version = increment_version(connection, self.version_name)
+        with self.lock:
+            if (
+                song_ids is None
+                # the number of parameters of a query is limited
+                or len(song_ids) > 500
+                or self.samplers_version != version - 1
+            ):
+                self.samplers.clear()
+            elif self.samplers:
+                aggregates = {
+                    row[0]: RatingAggregate(*row[1:])
+                    for row in connection.execute(
+                        "SELECT song_id, plays, rated_plays, total, last_played "
+                        "FROM played_songs WHERE username = ? AND song_id IN "
+                        f"({', '.join('?' * len(song_ids))})",
+                        (self.username, *song_ids),
+                    )
+                }
+                for weighting, sampler in self.samplers.items():
+                    for song_id in song_ids:
+                        sampler.update(
+                            song_id,
+                            *get_weight_terms(weighting, aggregates.get(song_id)),
+                        )
+            self.samplers_version = version
+
+    def add_play(
+        self,
+        song_id: str,
+        song_path: Path,
+        timestamp: int,
+        rating: Literal[0, 1, 2, 3, 4, 5],
+    ) -> None:
+        play = Play(timestamp=timestamp, rating=rating)
+        with self.database.transaction() as connection:
+            position = self._get_position(connection, song_id, song_path)
+            self._insert_play(connection, position, play)
+            self._update_samplers(connection, [song_id])
+
+    def save(self) -> None:
+        pass
+
+    def add_new_plays(self, plays: Iterable[SongPlay]) -> list[bool]:
+        added = []
+        song_ids = set()
+        with self.database.transaction() as connection:
+            for song_id, song_path, play in plays:
+                position = self._get_position(connection, song_id, song_path)
+                known = connection.execute(
+                    "SELECT 1 FROM plays WHERE played_song = ? AND timestamp = ?",
+                    (position, play.timestamp),
+                ).fetchone()
+                if known is None:
+                    self._insert_play(connection, position, play)
+                    song_ids.add(song_id)
+                added.append(known is None)
+            if song_ids:
+                self._update_samplers(connection, song_ids)
+        return added
+
+    def merge(self, played_songs: Iterable[PlayedSong]) -> int:
+        """Add the plays of `played_songs` that are not known yet, and return
+        their number (see `InMemoryRatingRepository.merge`)."""
+        count = 0
+        with self.database.transaction() as connection:
+            for played_song in played_songs:
+                song_id = _compute_remote_id(played_song.path)
+                position = self._get_position(connection, song_id, played_song.path)
+                timestamps = {
+                    row[0]
+                    for row in connection.execute(
+                        "SELECT timestamp FROM plays WHERE played_song = ?",
+                        (position,),
+                    )
+                }
+                for play in played_song.plays:
+                    if play.timestamp not in timestamps:
+                        timestamps.add(play.timestamp)
+                        self._insert_play(connection, position, play)
+                        count += 1
+            if count:
+                self._update_samplers(connection)
+        return count
+
+    def replace(self, played_songs: Iterable[PlayedSong]) -> None:
+        """Replace all the ratings of the user."""
+        with self.database.transaction() as connection:
+            connection.execute("DELETE FROM plays WHERE username = ?", (self.username,))
+            connection.execute(
+                "DELETE FROM played_songs WHERE username = ?", (self.username,)
+            )
+            for played_song in played_songs:
+                song_id = _compute_remote_id(played_song.path)
+                position = self._get_position(connection, song_id, played_song.path)
+                for play in played_song.plays:
+                    self._insert_play(connection, position, play)
+            self._update_samplers(connection)
+
+    def _get_position(
+        self, connection: sqlite3.Connection, song_id: str, song_path: Path
+    ) -> int:
+        """Return the position of a played song, adding it if needed."""
+        connection.execute(
+            "INSERT INTO played_songs (username, song_id, path) VALUES (?, ?, ?) "
+            "ON CONFLICT (username, song_id) DO NOTHING",
+            (self.username, song_id, str(song_path)),
+        )
+        row = connection.execute(
+            "SELECT position FROM played_songs WHERE username = ? AND song_id = ?",
+            (self.username, song_id),
+        ).fetchone()
+        return int(row[0])
+
+    def _insert_play(
+        self, connection: sqlite3.Connection, position: int, play: Play
+    ) -> None:
+        connection.execute(
+            "INSERT INTO plays (played_song, username, timestamp, rating) "
+            "VALUES (?, ?, ?, ?)",
+            (position, self.username, play.timestamp, play.rating),
+        )
+        # the expressions use the values before the update
+        connection.execute(
+            "UPDATE played_songs SET"
+            "    plays = plays + 1,"
+            "    rated_plays = rated_plays + :rated,"
+            "    total = total + :rating,"
+            "    last_played = max(coalesce(last_played, :timestamp), :timestamp),"
+            "    rating = CASE WHEN rated_plays + :rated > 0"
+            "        THEN CAST(total + :rating AS REAL) / (rated_plays + :rated) END "
+            "WHERE position = :position",
+            dict(
+                rated=int(play.rating > 0),
+                rating=play.rating,
+                timestamp=play.timestamp,
+                position=position,
+            ),
+        )
+
+
+@dataclass
+class SqliteRatingRepositoryCache:
+    """The rating repositories of the users, kept with their samplers.
+
+    The least recently used repositories are dropped once there are more than
+    `max_size` of them.
+    """
+
+    database: Database
+    max_size: int = 64
+    hits: int = 0
+    misses: int = 0
+    repositories: OrderedDict[str, SqliteRatingRepository] = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def get(self, username: str) -> SqliteRatingRepository:
+        with self.lock:
+            repository = self.repositories.get(username)
+            if repository is None:
+                self.misses += 1
+                repository = self.repositories[username] = SqliteRatingRepository(
+                    self.database, username
+                )
+                while len(self.repositories) > self.max_size:
+                    self.repositories.popitem(last=False)
+            else:
+                self.hits += 1
+                self.repositories.move_to_end(username)
+            return repository
+
+    def __len__(self) -> int:
+        return len(self.repositories)
+
+
+def migrate_from_files(
+    database: Database,
+    metadata_file: Path,
+    rating_dir: Path,
+    rating_file_name: str = "ratings.json",
+) -> tuple[CatalogDiff, int]:
+    """Import the catalog and the ratings files (with their play log) of all
+    the users into `database`, and return the differences of the catalog and
+    the number of users.
+
+    The ratings of the users already in the database are replaced.
+    """
+    repository = SqliteSongRepository(database=database, root=metadata_file.parent)
+    _, diff = repository.update_from_file(metadata_file)
+    users = 0
+    for file in sorted(rating_dir.glob(f"*/{rating_file_name}")):
+        ratings = InMemoryRatingRepository.from_file(file)
+        SqliteRatingRepository(database, file.parent.name).replace(
+            ratings.get_played_songs()
+        )
+        users += 1
+    return diff, users
@@ -1,28 +1,82 @@
-import json
+import dataclasses
+import functools
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
-from typing import Literal, Optional
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    BinaryIO,
+    Iterator,
+    Literal,
+    Optional,
+)
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from pydantic import BaseModel
-from pydantic.v1.json import pydantic_encoder
-from starlette.responses import Response
+from pydantic import BaseModel, TypeAdapter
+from starlette.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.types import Message, Receive, Scope, Send
 
 from configuration import AppConfiguration, get_app_configuration
-from ratings import InMemoryRatingRepository, PlayedSong
+from metrics import metrics
+from rating_columns import RatingColumnsBuilder
+from ratings import Play, PlayedSong, RatingRepository, SongPlay, create_temp_file
+from sampling import Weighting
+from songs import Song
+from streaming import JSONArrayParser, iter_gunzip, iter_gzip, iter_json_array
 from users import User
+from util import _compute_remote_id
 
-api_router = APIRouter()
 
+class TimedJSONResponse(JSONResponse):
+    """A JSON response recording the time spent to encode it."""
 
-def get_current_user(
+    def render(self, content: Any) -> bytes:
+        with metrics.time("vgsserver_stage_seconds", stage="serialization"):
+            return super().render(content)
+
+
+class CountingFileResponse(FileResponse):
+    """A file response recording the time spent and the bytes sent."""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not metrics.enabled:
+            await super().__call__(scope, receive, send)
+            return
+
+        async def counting_send(message: Message) -> None:
+            if message["type"] == "http.response.body":
+                metrics.inc("vgsserver_file_bytes_served_total", len(message["body"]))
+            await send(message)
+
+        with metrics.time("vgsserver_stage_seconds", stage="file"):
+            await super().__call__(scope, receive, counting_send)
+
+
+api_router = APIRouter(default_response_class=TimedJSONResponse)
+metrics_router = APIRouter()
+health_router = APIRouter()
+
+
+async def get_current_user(
     credentials: HTTPBasicCredentials = Depends(HTTPBasic()),
     configuration: AppConfiguration = Depends(get_app_configuration),
 ) -> User:
-    user = configuration.users.get_user(
-        username=credentials.username.encode(),
-        password=credentials.password.encode(),
-    )
+    def get_user() -> Optional[User]:
+        with metrics.time("vgsserver_stage_seconds", stage="authentication"):
+            return configuration.users.get_user(
+                username=credentials.username.encode(),
+                password=credentials.password.encode(),
+            )
+
+    user = await configuration.run_cpu_bound(get_user)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -32,6 +86,18 @@ def get_current_user(
     return user
 
 
+async def get_admin_user(
+    current_user: User = Depends(get_current_user),
+    configuration: AppConfiguration = Depends(get_app_configuration),
+) -> User:
+    if current_user.username not in configuration.settings.ADMIN_USERS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Reserved to the administrators",
+        )
+    return current_user
+
+
 class SongResponse(BaseModel):
     id: str
     title: Optional[str]
@@ -42,45 +108,147 @@ class SongResponse(BaseModel):
     path: Path
 
 
+def make_song_response(song: Song) -> SongResponse:
+    return SongResponse(
+        id=song.remote_id,
+        title=song.title,
+        game_title=song.game_title,
+        duration=song.duration,
+        loop_start=song.loop_start,
+        loop_end=song.loop_end,
+        path=song.path,
+    )
+
+
 @api_router.get("/songs/random/")
-def _(
+async def _(
     min_duration: Optional[int] = None,
     title_contains: Optional[str] = None,
     game_title_contains: Optional[str] = None,
     min_rating: Optional[int] = None,
     only_has_rating: Optional[bool] = None,
+    weighting: Optional[Weighting] = None,
     configuration: AppConfiguration = Depends(get_app_configuration),
     current_user: User = Depends(get_current_user),
 ) -> SongResponse:
-    song = configuration.songs.get_random_song(
-        ratings=configuration.get_ratings_for_user(current_user.username),
-        min_duration=min_duration,
-        title_contains=title_contains,
-        game_title_contains=game_title_contains,
-        min_rating=min_rating,
-        only_has_rating=only_has_rating,
-    )
+    def get_random_song() -> Optional[Song]:
+        songs = configuration.songs
+
+        def get_song(ratings: RatingRepository) -> Optional[Song]:
+            with metrics.time("vgsserver_stage_seconds", stage="random_song"):
+                return songs.get_random_song(
+                    ratings=ratings,
+                    min_duration=min_duration,
+                    title_contains=title_contains,
+                    game_title_contains=game_title_contains,
+                    min_rating=min_rating,
+                    only_has_rating=only_has_rating,
+                    weighting=weighting,
+                )
+
+        return configuration.read_ratings_for_user(current_user.username, get_song)
+
+    song = await configuration.run_cpu_bound(get_random_song)
     if song is None:
         raise HTTPException(404, "No song found")
-    return SongResponse(
-        id=song.remote_id,
-        title=song.title,
-        game_title=song.game_title,
-        duration=song.duration,
-        loop_start=song.loop_start,
-        loop_end=song.loop_end,
-        path=song.path,
-    )
+    return make_song_response(song)
+
+
+@api_router.get("/songs/playlist/")
+async def _(
+    count: int = Query(10, ge=1, le=100),
+    # don't return the last `no_repeat_window` songs played by the user
+    no_repeat_window: int = Query(0, ge=0),
+    min_duration: Optional[int] = None,
+    title_contains: Optional[str] = None,
+    game_title_contains: Optional[str] = None,
+    min_rating: Optional[int] = None,
+    only_has_rating: Optional[bool] = None,
+    weighting: Optional[Weighting] = None,
+    configuration: AppConfiguration = Depends(get_app_configuration),
+    current_user: User = Depends(get_current_user),
+) -> list[SongResponse]:
+    def get_random_songs() -> list[Song]:
+        songs = configuration.songs
+
+        def get_songs(ratings: RatingRepository) -> list[Song]:
+            with metrics.time("vgsserver_stage_seconds", stage="random_song"):
+                return songs.get_random_songs(
+                    ratings=ratings,
+                    count=count,
+                    min_duration=min_duration,
+                    title_contains=title_contains,
+                    game_title_contains=game_title_contains,
+                    min_rating=min_rating,
+                    only_has_rating=only_has_rating,
+                    excluded_ids=ratings.get_recently_played_song_ids(no_repeat_window),
+                    weighting=weighting,
+                )
+
+        return configuration.read_ratings_for_user(current_user.username, get_songs)
+
+    songs = await configuration.run_cpu_bound(get_random_songs)
+    return [make_song_response(song) for song in songs]
+
+
+def get_song_file_headers(song: Song) -> dict[str, str]:
+    """Compute the cache validators of a song file from its metadata."""
+    return {
+        "etag": f'"{song.size:x}-{song.timestamp:x}"',
+        "last-modified": formatdate(song.timestamp, usegmt=True),
+    }
+
+
+def is_not_modified(request: Request, song: Song, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            date = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return song.timestamp <= date.timestamp()
+    return False
 
 
 @api_router.get("/songs/{song_id:str}/file/")
-def _(
+async def _(
     song_id: str,
+    request: Request,
     configuration: AppConfiguration = Depends(get_app_configuration),
     current_user: User = Depends(get_current_user),
 ) -> Response:
-    content = configuration.songs.get_file(song_id)
-    return Response(content=content, media_type="application/octet-stream")
+    song = await configuration.run_cpu_bound(
+        lambda: configuration.songs.get_song_by_id(song_id=song_id)
+    )
+    if song is None:
+        raise HTTPException(status_code=404, detail="Song not found")
+    headers = get_song_file_headers(song)
+    if is_not_modified(request, song, headers["etag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    file_cache = configuration.song_file_cache
+    if file_cache is not None and "range" not in request.headers:
+
+        def get_file() -> Optional[bytes]:
+            with metrics.time("vgsserver_stage_seconds", stage="file"):
+                return file_cache.get_file(configuration.songs, song)
+
+        content = await configuration.run_io_bound(get_file)
+        if content is not None:
+            metrics.inc("vgsserver_file_bytes_served_total", len(content))
+            return Response(
+                content,
+                headers={**headers, "accept-ranges": "bytes"},
+                media_type="application/octet-stream",
+            )
+    # streamed from disk (with sendfile if possible), with support of the Range
+    # and If-Range headers
+    return CountingFileResponse(
+        song.absolute_path, headers=headers, media_type="application/octet-stream"
+    )
 
 
 class SongPlayRequest(BaseModel):
@@ -93,52 +261,297 @@ class SongPlayResponse(BaseModel):
 
 
 @api_router.post("/songs/{song_id:str}/play/")
-def _(
+async def _(
     request: SongPlayRequest,
     song_id: str,
     configuration: AppConfiguration = Depends(get_app_configuration),
     current_user: User = Depends(get_current_user),
 ) -> SongPlayResponse:
-    song = configuration.songs.get_song_by_id(song_id=song_id)
+    song = await configuration.run_cpu_bound(
+        lambda: configuration.songs.get_song_by_id(song_id=song_id)
+    )
     if song is None:
         raise HTTPException(status_code=404, detail="Song not found")
-    ratings = configuration.get_ratings_for_user(current_user.username)
-    ratings.add_play(
-        song_id=song_id,
-        song_path=song.path,
-        timestamp=request.timestamp,
-        rating=request.rating,
+    # serialized with the other plays of the user, and saved with them
+    rating = await configuration.run_io_bound(
+        lambda: configuration.add_play_for_user(
+            current_user.username,
+            song_id=song_id,
+            song_path=song.path,
+            timestamp=request.timestamp,
+            rating=request.rating,
+        )
     )
-    ratings.save()
-    return SongPlayResponse(rating=ratings.get_rating(song_id))
+    return SongPlayResponse(rating=rating)
+
+
+# the maximum number of plays of a batch
+PLAY_BATCH_MAX_SIZE = 10_000
+
+
+class PlayBatchItem(BaseModel):
+    song_id: str
+    timestamp: int
+    rating: Literal[0, 1, 2, 3, 4, 5]
+
+
+class PlayBatchItemResult(BaseModel):
+    song_id: str
+    timestamp: int
+    # "duplicate": the song already has a play with this timestamp
+    status: Literal["added", "duplicate", "unknown_song"]
+
+
+class PlayBatchResponse(BaseModel):
+    results: list[PlayBatchItemResult]
+    # the ratings of the songs of the batch
+    ratings: dict[str, Optional[float]]
 
 
-@api_router.get("/ratings/export/")
-def _(
+@api_router.post("/plays/batch/")
+async def _(
+    request: list[PlayBatchItem] = Body(..., max_length=PLAY_BATCH_MAX_SIZE),
     configuration: AppConfiguration = Depends(get_app_configuration),
     current_user: User = Depends(get_current_user),
-) -> list[PlayedSong]:
-    path = configuration.get_ratings_path_for_user(current_user.username)
-    if path.exists():
-        return InMemoryRatingRepository.load_songs_from_file(path)
-    return []
+) -> PlayBatchResponse:
+    def get_plays() -> list[Optional[SongPlay]]:
+        songs = configuration.songs
+        plays: list[Optional[SongPlay]] = []
+        for item in request:
+            song = songs.get_song_by_id(song_id=item.song_id)
+            if song is None:
+                plays.append(None)
+                continue
+            play = Play(timestamp=item.timestamp, rating=item.rating)
+            plays.append((item.song_id, song.path, play))
+        return plays
 
+    plays = await configuration.run_cpu_bound(get_plays)
+    known_plays = [p for p in plays if p is not None]
+    # all the plays are saved together, the known ones are skipped (so that a
+    # batch can be sent again)
+    added, ratings = await configuration.run_io_bound(
+        lambda: configuration.add_plays_for_user(current_user.username, known_plays)
+    )
+    statuses = iter(added)
+    results = []
+    for item, play in zip(request, plays):
+        status: Literal["added", "duplicate", "unknown_song"] = "unknown_song"
+        if play is not None:
+            status = "added" if next(statuses) else "duplicate"
+        results.append(
+            PlayBatchItemResult(
+                song_id=item.song_id, timestamp=item.timestamp, status=status
+            )
+        )
+    return PlayBatchResponse(results=results, ratings=ratings)
 
-class RatingsImportRequest(BaseModel):
-    songs: list[PlayedSong]
 
+def copy_played_songs(ratings: RatingRepository) -> list[PlayedSong]:
+    """Return the played songs, with a copy of their plays, so that they can be
+    encoded while new plays are added."""
+    return [
+        PlayedSong.model_construct(path=s.path, plays=list(s.plays))
+        for s in ratings.get_played_songs()
+    ]
 
-@api_router.post("/ratings/import/")
-def _(
-    request: RatingsImportRequest,
+
+@api_router.get("/ratings/export/", response_model=list[PlayedSong])
+async def _(
+    gzip: bool = Query(False, description="compress the response with gzip"),
     configuration: AppConfiguration = Depends(get_app_configuration),
     current_user: User = Depends(get_current_user),
 ) -> Response:
-    path = configuration.get_ratings_path_for_user(current_user.username)
-    with path.open("w") as fh:
-        json.dump(
-            [s.model_dump() for s in request.songs],
-            fh,
-            default=pydantic_encoder,
+    played_songs = await configuration.run_cpu_bound(
+        lambda: configuration.read_ratings_for_user(
+            current_user.username, copy_played_songs
         )
-    return Response()
+    )
+    chunks = iter_json_array(played_songs)
+    headers = {}
+    if gzip:
+        chunks = iter_gzip(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, media_type="application/json", headers=headers)
+
+
+# the played songs are validated (and written) by batches of this size
+IMPORT_BATCH_SIZE = 500
+
+played_songs_adapter = TypeAdapter(list[PlayedSong])
+
+
+class RatingsImportResponse(BaseModel):
+    songs: int
+    # in "merge" mode, only the plays that were added
+    plays: int
+
+
+async def iter_imported_songs(
+    request: Request, configuration: AppConfiguration
+) -> AsyncIterator[list[PlayedSong]]:
+    """Parse and validate the played songs of an import, by batches.
+
+    The body is a JSON array of played songs, or an object with the array in
+    its `songs` key, and may be compressed with gzip.
+    """
+    chunks: AsyncIterable[bytes] = request.stream()
+    if request.headers.get("content-encoding") == "gzip":
+        chunks = iter_gunzip(chunks)
+    batch: list[Any] = []
+    async for element in JSONArrayParser(chunks, key="songs"):
+        batch.append(element)
+        if len(batch) == IMPORT_BATCH_SIZE:
+            yield await configuration.run_cpu_bound(
+                functools.partial(played_songs_adapter.validate_python, batch)
+            )
+            batch = []
+    if batch:
+        yield await configuration.run_cpu_bound(
+            functools.partial(played_songs_adapter.validate_python, batch)
+        )
+
+
+@api_router.post("/ratings/import/")
+async def _(
+    request: Request,
+    mode: Literal["replace", "merge"] = Query(
+        "replace",
+        description=(
+            "replace the ratings, or add the plays that are not known yet (same "
+            "path and timestamp)"
+        ),
+    ),
+    configuration: AppConfiguration = Depends(get_app_configuration),
+    current_user: User = Depends(get_current_user),
+) -> RatingsImportResponse:
+    username = current_user.username
+    songs = plays = 0
+
+    # the songs are written to a temporary file as they are validated, so that
+    # the ratings are only modified once the whole body is valid: as JSON lines
+    # to be merged, else in the format of the ratings file that it replaces
+    path = configuration.get_ratings_path_for_user(username)
+    columns = None
+    if mode == "replace" and configuration.settings.RATING_FORMAT == "binary":
+        columns = RatingColumnsBuilder()
+
+    def encode(batch: list[PlayedSong], first: bool) -> bytes:
+        if mode == "merge":
+            return b"".join(s.model_dump_json().encode() + b"\n" for s in batch)
+        if columns is not None:
+            for s in batch:
+                columns.add(
+                    _compute_remote_id(s.path),
+                    str(s.path),
+                    ((p.timestamp, p.rating) for p in s.plays),
+                )
+            return b""
+        content = b",".join(s.model_dump_json().encode() for s in batch)
+        return (b"[" if first else b",") + content
+
+    def end() -> bytes:
+        if mode == "merge":
+            return b""
+        if columns is not None:
+            return columns.build().to_bytes()
+        return b"]" if songs else b"[]"
+
+    def open_temp_file() -> tuple[Path, BinaryIO]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = create_temp_file(path)
+        return temp_file, temp_file.open("wb")
+
+    def write(content: bytes) -> None:
+        fh.write(content)
+
+    def install() -> int:
+        if mode == "merge":
+            return configuration.merge_ratings_for_user(
+                username, iter_played_songs(temp_file)
+            )
+        configuration.replace_ratings_file_for_user(username, temp_file)
+        return plays
+
+    temp_file, fh = await configuration.run_io_bound(open_temp_file)
+    try:
+        try:
+            async for batch in iter_imported_songs(request, configuration):
+                content = await configuration.run_cpu_bound(
+                    functools.partial(encode, batch, not songs)
+                )
+                await configuration.run_io_bound(functools.partial(write, content))
+                songs += len(batch)
+                plays += sum(len(s.plays) for s in batch)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        content = await configuration.run_cpu_bound(end)
+        await configuration.run_io_bound(functools.partial(write, content))
+        await configuration.run_io_bound(fh.close)
+        plays = await configuration.run_io_bound(install)
+    finally:
+        fh.close()
+        temp_file.unlink(missing_ok=True)
+    return RatingsImportResponse(songs=songs, plays=plays)
+
+
+def iter_played_songs(file: Path) -> Iterator[PlayedSong]:
+    """Read the played songs of a file of JSON lines."""
+    with file.open("rb") as fh:
+        for line in fh:
+            yield PlayedSong.model_validate_json(line)
+
+
+class CatalogReloadResponse(BaseModel):
+    # `None` if the catalog was loaded from scratch
+    added: Optional[int] = None
+    removed: Optional[int] = None
+    changed: Optional[int] = None
+    unchanged: Optional[int] = None
+
+
+@api_router.post("/catalog/reload/")
+async def _(
+    configuration: AppConfiguration = Depends(get_app_configuration),
+    current_user: User = Depends(get_admin_user),
+) -> CatalogReloadResponse:
+    try:
+        diff = await configuration.run_cpu_bound(configuration.reload_songs)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=500, detail=f"Can't reload the catalog: {e}")
+    if diff is None:
+        return CatalogReloadResponse()
+    return CatalogReloadResponse(**dataclasses.asdict(diff))
+
+
+@metrics_router.get("/metrics")
+async def _(
+    configuration: AppConfiguration = Depends(get_app_configuration),
+) -> Response:
+    if not configuration.settings.METRICS:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(
+        metrics.render(configuration.get_metric_samples()),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+class ReadinessResponse(BaseModel):
+    status: Literal["pending", "loading", "ready", "failed"]
+    # seconds
+    timings: dict[str, float]
+    errors: dict[str, str]
+
+
+@health_router.get("/health/ready", response_model=ReadinessResponse)
+async def _(
+    configuration: AppConfiguration = Depends(get_app_configuration),
+) -> Response:
+    """Tell whether the catalog, the users and the ratings are loaded (see the
+    `WARM_UP` setting): 503 until they are."""
+    state = configuration.warm_up_state
+    content = ReadinessResponse(**dataclasses.asdict(state))
+    return JSONResponse(
+        content.model_dump(),
+        status_code=200 if state.status == "ready" else 503,
+    )
@@ -0,0 +1,205 @@
+"""Metrics of the server, published in the Prometheus text format.
+
+The metrics are recorded in a module-level registry (`metrics`), so that they
+can be recorded anywhere (in the rating cache, in the response classes, ...).
+It is disabled by default: recording then costs a single attribute check.
+"""
+
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Literal
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+MetricType = Literal["counter", "gauge", "histogram"]
+
+# name, type, help, labels, value
+Sample = tuple[str, MetricType, str, dict[str, str], float]
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+DESCRIPTIONS: dict[str, tuple[MetricType, str]] = {
+    "vgsserver_request_seconds": ("histogram", "Duration of the requests, by route."),
+    "vgsserver_stage_seconds": (
+        "histogram",
+        "Time spent in each stage of the requests.",
+    ),
+    "vgsserver_file_bytes_served_total": ("counter", "Bytes of song files sent."),
+    "vgsserver_rating_flush_seconds": (
+        "histogram",
+        "Duration of the background saves of the ratings (write-behind mode).",
+    ),
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+
+@dataclass
+class Histogram:
+    # by bucket of `DEFAULT_BUCKETS`, the last count is for the values above
+    counts: list[int] = field(default_factory=lambda: [0] * (len(DEFAULT_BUCKETS) + 1))
+    sum: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(DEFAULT_BUCKETS, value)] += 1
+        self.sum += value
+
+
+class _Timer:
+    def __init__(self, metrics: Metrics, name: str, labels: Labels) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args: Any) -> None:
+        self.metrics.observe(self.name, time.perf_counter() - self.start, self.labels)
+
+
+class Metrics:
+    """A registry of counters and histograms."""
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.counters: dict[tuple[str, Labels], float] = {}
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def time(self, name: str, **labels: str) -> AbstractContextManager[None]:
+        """Record the duration of a block in the histogram `name`."""
+        if not self.enabled:
+            return nullcontext()
+        return _Timer(self, name, tuple(sorted(labels.items())))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self, samples: Iterable[Sample] = ()) -> str:
+        """Return the metrics, and the additional `samples`, in the text format."""
+        lines: list[str] = []
+        described: set[str] = set()
+
+        def describe(name: str, type: MetricType, help: str) -> None:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type}")
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum)) for key, h in self.histograms.items()
+            )
+        for (name, labels), value in counters:
+            describe(name, *DESCRIPTIONS.get(name, ("counter", name)))
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        for (name, labels), (counts, total) in histograms:
+            describe(name, *DESCRIPTIONS.get(name, ("histogram", name)))
+            cumulated = 0
+            for bucket, count in zip((*DEFAULT_BUCKETS, float("inf")), counts):
+                cumulated += count
+                le = (("le", format_value(bucket)),)
+                lines.append(f"{name}_bucket{format_labels(labels + le)} {cumulated}")
+            lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulated}")
+        for name, type, help, sample_labels, value in samples:
+            describe(name, type, help)
+            labels = tuple(sorted(sample_labels.items()))
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsMiddleware:
+    """Record the duration of the requests, by route template."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            metrics.observe(
+                "vgsserver_request_seconds",
+                time.perf_counter() - start,
+                (
+                    ("method", scope["method"]),
+                    ("route", getattr(route, "path", "unknown")),
+                    ("status", str(status)),
+                ),
+            )
+
+
+metrics = Metrics()
@@ -0,0 +1,150 @@
+"""A binary format of the ratings files, faster to load than JSON.
+
+The plays are stored in columns (an array of timestamps and an array of
+ratings), grouped by song: the plays of the song `i` are the items
+`play_offsets[i]` to `play_offsets[i + 1]` of the columns. The ids of the
+songs are stored (as binary md5 digests) so that they are not computed again,
+and the paths in a single UTF-8 buffer, separated by NUL characters.
+
+The file starts with a magic number, the version of the format, the number of
+songs and plays and the size of the paths. All the numbers are little-endian.
+"""
+
+from __future__ import annotations
+
+import struct
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+MAGIC = b"VGSRAT\x00\x01"
+VERSION = 1
+# magic, version, number of songs, number of plays, size of the paths
+HEADER = struct.Struct("<8sIQQQ")
+DIGEST_SIZE = 16  # md5
+MAX_RATING = 5
+
+
+@dataclass
+class RatingColumns:
+    song_ids: bytes  # binary digests
+    paths: list[str]
+    play_offsets: array[int]
+    timestamps: array[int]
+    ratings: array[int]
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def get_song_ids(self) -> list[str]:
+        """Return the ids of the songs, as hexadecimal strings."""
+        digits = self.song_ids.hex()
+        size = 2 * DIGEST_SIZE
+        return [digits[i : i + size] for i in range(0, len(digits), size)]
+
+    def iter_songs(self) -> Iterator[tuple[str, str, int, int]]:
+        """Yield the id, the path and the range of the plays of each song."""
+        offsets = self.play_offsets
+        for i, (song_id, path) in enumerate(zip(self.get_song_ids(), self.paths)):
+            yield song_id, path, offsets[i], offsets[i + 1]
+
+    @staticmethod
+    def build(
+        songs: Iterable[tuple[str, str, Iterable[tuple[int, int]]]]
+    ) -> RatingColumns:
+        """Build the columns from the id, the path and the plays (timestamp,
+        rating) of each song."""
+        builder = RatingColumnsBuilder()
+        for song_id, path, plays in songs:
+            builder.add(song_id, path, plays)
+        return builder.build()
+
+    def to_bytes(self) -> bytes:
+        paths = "\0".join(self.paths).encode()
+        columns = [array(c.typecode, c) for c in (self.play_offsets, self.timestamps)]
+        if sys.byteorder == "big":
+            for column in columns:
+                column.byteswap()
+        header = HEADER.pack(
+            MAGIC, VERSION, len(self), len(self.timestamps), len(paths)
+        )
+        return b"".join(
+            [header, self.song_ids, paths, *columns, self.ratings.tobytes()]
+        )
+
+    @staticmethod
+    def is_binary(data: bytes) -> bool:
+        return data.startswith(MAGIC)
+
+    @staticmethod
+    def from_bytes(data: bytes) -> RatingColumns:
+        """Read the columns written by `to_bytes`, raise a `ValueError` if they
+        are invalid."""
+        if len(data) < HEADER.size:
+            raise ValueError("Truncated ratings file")
+        magic, version, songs, plays, paths_size = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a binary ratings file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported version of the ratings file: {version}")
+        sizes = [DIGEST_SIZE * songs, paths_size, 8 * (songs + 1), 8 * plays, plays]
+        if len(data) != HEADER.size + sum(sizes):
+            raise ValueError("Truncated ratings file")
+        view = memoryview(data)
+        parts = []
+        offset = HEADER.size
+        for size in sizes:
+            parts.append(view[offset : offset + size])
+            offset += size
+        song_ids, paths, *columns = parts
+        play_offsets, timestamps, ratings = array("q"), array("q"), array("b")
+        for column, part in zip((play_offsets, timestamps, ratings), columns):
+            column.frombytes(part)
+        if sys.byteorder == "big":
+            play_offsets.byteswap()
+            timestamps.byteswap()
+        path_list = str(paths, "utf-8").split("\0") if songs else []
+        if (
+            len(path_list) != songs
+            or play_offsets[0] != 0
+            or play_offsets[-1] != plays
+            or any(a > b for a, b in zip(play_offsets, play_offsets[1:]))
+            or (plays and not 0 <= min(ratings) <= max(ratings) <= MAX_RATING)
+        ):
+            raise ValueError("Invalid ratings file")
+        return RatingColumns(
+            song_ids=bytes(song_ids),
+            paths=path_list,
+            play_offsets=play_offsets,
+            timestamps=timestamps,
+            ratings=ratings,
+        )
+
+
+class RatingColumnsBuilder:
+    """Build the columns song by song, as they arrive (see `RatingColumns.build`)."""
+
+    def __init__(self) -> None:
+        self.song_ids = bytearray()
+        self.paths: list[str] = []
+        self.play_offsets = array("q", [0])
+        self.timestamps = array("q")
+        self.ratings = array("b")
+
+    def add(self, song_id: str, path: str, plays: Iterable[tuple[int, int]]) -> None:
+        self.song_ids += bytes.fromhex(song_id)
+        self.paths.append(path)
+        for timestamp, rating in plays:
+            self.timestamps.append(timestamp)
+            self.ratings.append(rating)
+        self.play_offsets.append(len(self.timestamps))
+
+    def build(self) -> RatingColumns:
+        return RatingColumns(
+            song_ids=bytes(self.song_ids),
+            paths=self.paths,
+            play_offsets=self.play_offsets,
+            timestamps=self.timestamps,
+            ratings=self.ratings,
+        )
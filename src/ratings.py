@@ -1,16 +1,48 @@
 from __future__ import annotations
 
+import hashlib
+import heapq
+import itertools
 import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Literal, Optional
+from typing import (
+    Callable,
+    Collection,
+    Iterable,
+    Iterator,
+    Literal,
+    Mapping,
+    Optional,
+    Sequence,
+    TypeVar,
+    Union,
+)
 
 import pydantic
 from pydantic import BaseModel
 from pydantic.v1.json import pydantic_encoder
 
-from util import _compute_remote_id
+from metrics import metrics
+from rating_columns import RatingColumns
+from sampling import SamplerKeys, WeightedSampler, Weighting
+from util import FileSignature, _compute_remote_id, get_file_signature
+
+# signatures of the ratings file and of the play log
+RatingFilesSignature = tuple[Optional[FileSignature], Optional[FileSignature]]
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
 
 
 class RatingRepository(ABC):
@@ -26,6 +58,25 @@ class RatingRepository(ABC):
     def song_has_no_rating(self, song_id: str) -> bool:
         ...  # pragma:nocover
 
+    @abstractmethod
+    def get_rated_song_ids(self, min_rating: Optional[int] = None) -> Collection[str]:
+        """Return the ids of the songs with a rating (at least `min_rating`)."""
+        ...  # pragma:nocover
+
+    @abstractmethod
+    def get_played_songs(self) -> list[PlayedSong]:
+        ...  # pragma:nocover
+
+    @abstractmethod
+    def get_recently_played_song_ids(self, count: int) -> set[str]:
+        """Return the ids of the `count` songs played most recently."""
+        ...  # pragma:nocover
+
+    @abstractmethod
+    def get_sampler(self, weighting: Weighting, keys: SamplerKeys) -> WeightedSampler:
+        """Return a sampler of the songs `keys`, weighted from their plays."""
+        ...  # pragma:nocover
+
     @abstractmethod
     def add_play(
         self,
@@ -36,6 +87,16 @@ class RatingRepository(ABC):
     ) -> None:
         ...  # pragma:nocover
 
+    @abstractmethod
+    def add_new_plays(self, plays: Iterable[SongPlay]) -> list[bool]:
+        """Add the plays that are not known yet, and return whether each one was
+        added.
+
+        A play is known if the song already has a play with the same timestamp,
+        so that the same plays can be sent again.
+        """
+        ...  # pragma:nocover
+
     @abstractmethod
     def save(self) -> None:
         ...  # pragma:nocover
@@ -58,23 +119,350 @@ class PlayedSong(BaseModel):
         return sum([p.rating for p in plays]) / len(plays)
 
 
+# song id, song path, play
+SongPlay = tuple[str, Path, Play]
+
+RatingFileFormat = Literal["json", "binary"]
+# the name of the ratings file of a user, in each format
+RATING_FILE_NAMES: dict[RatingFileFormat, str] = {
+    "json": "ratings.json",
+    "binary": "ratings.bin",
+}
+
+
+@dataclass
+class RatingAggregate:
+    """Running aggregates of the plays of a song."""
+
+    plays: int = 0
+    rated_plays: int = 0
+    total: int = 0
+    last_played: Optional[int] = None
+
+    @property
+    def rating(self) -> Optional[float]:
+        if not self.rated_plays:
+            return None
+        return self.total / self.rated_plays
+
+    def add(self, play: Play) -> None:
+        self.plays += 1
+        if play.rating:
+            self.rated_plays += 1
+            self.total += play.rating
+        if self.last_played is None or play.timestamp > self.last_played:
+            self.last_played = play.timestamp
+
+
+# the weight of the songs without rating: the middle of the scale
+UNRATED_WEIGHT = 3.0
+
+
+def get_weight_terms(
+    weighting: Weighting, aggregate: Optional[RatingAggregate]
+) -> tuple[float, float]:
+    """Return the terms `(constant, slope)` of the weight of a song (see
+    `WeightedSampler`)."""
+    if weighting == "rating":
+        rating = aggregate.rating if aggregate is not None else None
+        return (rating if rating is not None else UNRATED_WEIGHT, 0.0)
+    if weighting == "play_count":
+        return (1 / (1 + (aggregate.plays if aggregate is not None else 0)), 0.0)
+    # the time since the last play: `now - last_played`
+    last_played = aggregate.last_played if aggregate is not None else None
+    return (-float(last_played or 0), 1.0)
+
+
+def make_sampler(
+    weighting: Weighting, keys: SamplerKeys, aggregates: Mapping[str, RatingAggregate]
+) -> WeightedSampler:
+    """Return a sampler of the songs `keys`, only looking up the played songs."""
+    return WeightedSampler(
+        keys,
+        (
+            (song_id, *get_weight_terms(weighting, aggregate))
+            for song_id, aggregate in aggregates.items()
+        ),
+        default=get_weight_terms(weighting, None),
+    )
+
+
+class RatingBucketsView(Collection[str]):
+    """A read-only union of disjoint sets of ids, without copying them."""
+
+    def __init__(self, buckets: list[dict[str, None]]) -> None:
+        self.buckets = buckets
+
+    def __contains__(self, id: object) -> bool:
+        return any(id in bucket for bucket in self.buckets)
+
+    def __iter__(self) -> Iterator[str]:
+        return itertools.chain.from_iterable(self.buckets)
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets)
+
+
+def backup_file(file: Path, number_of_backup_files: int, keep: bool = False) -> None:
+    """Rename `file` to `file.bak1`, shifting the previous backups.
+
+    With `keep`, `file` is kept (`file.bak1` is a hard link to it), so that it
+    can then be replaced atomically (see `install_file`).
+    """
+    for n in reversed(range(number_of_backup_files)):
+        if n == 0:
+            source = file
+        else:
+            source = Path(str(file) + f".bak{n}")
+        target = Path(str(file) + f".bak{n+1}")
+        if target.exists():
+            target.unlink()
+        if not source.exists():
+            continue
+        if n == 0 and keep:
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+        else:
+            source.rename(target)
+
+
+def create_temp_file(file: Path) -> Path:
+    """Create an empty temporary file, next to `file` that it will replace."""
+    fd, name = tempfile.mkstemp(dir=file.parent, prefix=f".{file.name}.", suffix=".tmp")
+    os.close(fd)
+    return Path(name)
+
+
+def install_file(source: Path, file: Path, number_of_backup_files: int) -> None:
+    """Replace `file` with `source` atomically, after backing it up."""
+    backup_file(file, number_of_backup_files, keep=True)
+    os.replace(source, file)
+
+
+@dataclass(frozen=True)
+class PlayLogOptions:
+    """Options of the append-only play log.
+
+    When a repository has a play log, `save` appends the new plays to a log
+    file next to the ratings file, instead of rewriting it. The log is folded
+    into the ratings file once it has `compaction_threshold` plays.
+    """
+
+    fsync: bool = False
+    compaction_threshold: int = 1000
+
+
+@dataclass(frozen=True)
+class WriteBehindOptions:
+    """Options of the write-behind mode of `RatingRepositoryCache`.
+
+    The plays are acknowledged once they are in memory, and saved by a
+    background thread `delay` seconds after the first unsaved play of the
+    user. A user never has more than `max_plays` unsaved plays: the play
+    that reaches this number is saved before being acknowledged. So at most
+    the plays of the last `delay` seconds (and the time to save them), and at
+    most `max_plays` per user, are lost if the process is killed.
+    """
+
+    delay: float = 1.0
+    max_plays: int = 100
+
+
+@dataclass
+class RatingSave:
+    """A save of the ratings, prepared by `InMemoryRatingRepository.prepare_save`.
+
+    `write` only uses the data copied here, so that it can run without the
+    lock of the repository (while the plays are read, or new ones added).
+    """
+
+    file: Path
+    plays: int  # the number of pending plays that are saved
+    # the content of the ratings file, or None to append `log_lines` to the log
+    content: Optional[bytes] = None
+    log_lines: list[str] = field(default_factory=list, repr=False)
+    new_log: bool = False  # the log is rewritten, starting with its header
+    fsync: bool = False
+    number_of_backup_files: int = 10
+
+    def write(self) -> None:
+        log_file = InMemoryRatingRepository.get_log_file(self.file)
+        if self.content is None:
+            with log_file.open("w" if self.new_log else "a") as fh:
+                fh.writelines(self.log_lines)
+                fh.flush()
+                if self.fsync:
+                    os.fsync(fh.fileno())
+            return
+        temp_file = create_temp_file(self.file)
+        try:
+            temp_file.write_bytes(self.content)
+            install_file(temp_file, self.file, self.number_of_backup_files)
+        except BaseException:
+            temp_file.unlink(missing_ok=True)
+            raise
+        log_file.unlink(missing_ok=True)
+
+
 @dataclass
 class InMemoryRatingRepository(RatingRepository):
+    # built from `columns` when first needed, after loading a binary file (see
+    # `materialize`)
     ratings: dict[str, PlayedSong]
     file: Optional[Path] = None
     number_of_backup_files: int = 10
+    play_log: Optional[PlayLogOptions] = None
+    # the format the ratings file is written in (both are read)
+    file_format: RatingFileFormat = "json"
+    signature: Optional[RatingFilesSignature] = field(default=None, compare=False)
+    # md5 of the ratings file, written in the header of the play log, so that
+    # a log that has already been folded into the ratings file is not replayed
+    snapshot_digest: str = field(default="", compare=False)
+    log_length: int = field(default=0, compare=False)
+    pending_plays: list[tuple[Path, Play]] = field(
+        default_factory=list, compare=False, repr=False
+    )
+    # kept up to date by `add_play`: `ratings` must not be modified directly
+    aggregates: dict[str, RatingAggregate] = field(
+        default_factory=dict, init=False, compare=False, repr=False
+    )
+    # dicts rather than sets, so that the ids are iterated in a reproducible
+    # order (the order of a set of strings depends on the hash seed)
+    rated_song_ids: dict[str, None] = field(
+        default_factory=dict, init=False, compare=False, repr=False
+    )
+    # the rated songs, by the integer part of their rating
+    rating_buckets: dict[int, dict[str, None]] = field(
+        default_factory=dict, init=False, compare=False, repr=False
+    )
+    # built on demand, for the songs of the current catalog
+    samplers: dict[Weighting, WeightedSampler] = field(
+        default_factory=dict, init=False, compare=False, repr=False
+    )
+    # the plays of a binary file, only turned into `PlayedSong` objects when
+    # they are modified or exported: the aggregates are computed from them
+    columns: Optional[RatingColumns] = field(
+        default=None, init=False, compare=False, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        self.build_aggregates()
+
+    def load_columns(self, columns: RatingColumns) -> None:
+        """Replace the ratings with the plays of `columns`, without building
+        a `Play` per play."""
+        self.ratings = dict()
+        self.columns = columns
+        self.build_aggregates()
+        timestamps, ratings = columns.timestamps, columns.ratings
+        for song_id, _, start, stop in columns.iter_songs():
+            if start == stop:
+                continue
+            song_ratings = ratings[start:stop]
+            aggregate = self.aggregates[song_id] = RatingAggregate(
+                plays=stop - start,
+                rated_plays=stop - start - song_ratings.count(0),
+                total=sum(song_ratings),
+                last_played=max(timestamps[start:stop]),
+            )
+            rating = aggregate.rating
+            if rating is not None:
+                self.rating_buckets.setdefault(int(rating), {})[song_id] = None
+                self.rated_song_ids[song_id] = None
+
+    def materialize(self) -> None:
+        """Build `ratings` from the columns of a binary file, if needed."""
+        columns = self.columns
+        if columns is None:
+            return
+        self.columns = None
+        timestamps, ratings = columns.timestamps, columns.ratings
+        for song_id, path, start, stop in columns.iter_songs():
+            self.ratings[song_id] = PlayedSong.model_construct(
+                path=Path(path),
+                plays=[
+                    Play.model_construct(timestamp=t, rating=r)
+                    for t, r in zip(timestamps[start:stop], ratings[start:stop])
+                ],
+            )
+
+    def to_columns(self) -> RatingColumns:
+        if self.columns is not None:
+            return self.columns
+        return RatingColumns.build(
+            (id, str(s.path), ((p.timestamp, p.rating) for p in s.plays))
+            for id, s in self.ratings.items()
+        )
+
+    def build_aggregates(self) -> None:
+        self.aggregates.clear()
+        self.rated_song_ids.clear()
+        self.rating_buckets.clear()
+        self.samplers.clear()
+        for song_id, played_song in self.ratings.items():
+            for play in played_song.plays:
+                self._update_aggregate(song_id, play)
+
+    def _update_aggregate(self, song_id: str, play: Play) -> None:
+        aggregate = self.aggregates.get(song_id)
+        if aggregate is None:
+            aggregate = self.aggregates[song_id] = RatingAggregate()
+        old_rating = aggregate.rating
+        aggregate.add(play)
+        for weighting, sampler in self.samplers.items():
+            sampler.update(song_id, *get_weight_terms(weighting, aggregate))
+        new_rating = aggregate.rating
+        if old_rating == new_rating:
+            return
+        if old_rating is not None:
+            self.rating_buckets[int(old_rating)].pop(song_id, None)
+        if new_rating is not None:
+            self.rating_buckets.setdefault(int(new_rating), {})[song_id] = None
+            self.rated_song_ids[song_id] = None
 
     def get_rating(self, song_id: str) -> Optional[float]:
-        if song_id in self.ratings:
-            played_song = self.ratings[song_id]
-            return played_song.rating
-        return None
+        aggregate = self.aggregates.get(song_id)
+        if aggregate is None:
+            return None
+        return aggregate.rating
 
     def song_has_rating(self, song_id: str) -> bool:
-        return song_id in self.ratings and self.ratings[song_id].rating is not None
+        return song_id in self.rated_song_ids
 
     def song_has_no_rating(self, song_id: str) -> bool:
-        return not self.song_has_rating(song_id)
+        return song_id not in self.rated_song_ids
+
+    def get_rated_song_ids(self, min_rating: Optional[int] = None) -> Collection[str]:
+        if min_rating is None or min_rating <= min(self.rating_buckets, default=0):
+            return self.rated_song_ids.keys()
+        # int(rating) >= min_rating if and only if rating >= min_rating
+        return RatingBucketsView(
+            [ids for bucket, ids in self.rating_buckets.items() if bucket >= min_rating]
+        )
+
+    def get_played_songs(self) -> list[PlayedSong]:
+        self.materialize()
+        return list(self.ratings.values())
+
+    def get_sampler(self, weighting: Weighting, keys: SamplerKeys) -> WeightedSampler:
+        sampler = self.samplers.get(weighting)
+        # the catalog was reloaded
+        if sampler is None or sampler.keys is not keys:
+            sampler = self.samplers[weighting] = make_sampler(
+                weighting, keys, self.aggregates
+            )
+        return sampler
+
+    def get_recently_played_song_ids(self, count: int) -> set[str]:
+        if count <= 0:
+            return set()
+        # O(played songs) rather than O(plays), for the columns too
+        recent = heapq.nlargest(
+            count, self.aggregates.items(), key=lambda item: item[1].last_played or 0
+        )
+        return {id for id, _ in recent}
 
     def add_play(
         self,
@@ -83,8 +471,28 @@ class InMemoryRatingRepository(RatingRepository):
         timestamp: int,
         rating: Literal[0, 1, 2, 3, 4, 5],
     ) -> None:
-        played_song = self.ratings.get(song_id)
         play = Play(timestamp=timestamp, rating=rating)
+        self._add_play(song_id, song_path, play)
+        self.pending_plays.append((song_path, play))
+
+    def add_new_plays(self, plays: Iterable[SongPlay]) -> list[bool]:
+        self.materialize()
+        added = []
+        for song_id, song_path, play in plays:
+            played_song = self.ratings.get(song_id)
+            if played_song is not None and any(
+                p.timestamp == play.timestamp for p in played_song.plays
+            ):
+                added.append(False)
+                continue
+            self._add_play(song_id, song_path, play)
+            self.pending_plays.append((song_path, play))
+            added.append(True)
+        return added
+
+    def _add_play(self, song_id: str, song_path: Path, play: Play) -> None:
+        self.materialize()
+        played_song = self.ratings.get(song_id)
         if played_song is not None:
             played_song.plays.append(play)
         else:
@@ -92,39 +500,582 @@ class InMemoryRatingRepository(RatingRepository):
                 path=song_path,
                 plays=[play],
             )
+        self._update_aggregate(song_id, play)
 
     def save(self) -> None:
-        if self.file is not None:
-            self.backup_file()
-            with self.file.open("w") as fh:
-                json.dump(
-                    [s.model_dump() for s in self.ratings.values()],
-                    fh,
-                    default=pydantic_encoder,
-                )
+        save = self.prepare_save()
+        if save is not None:
+            save.write()
+            self.finish_save(save)
+
+    def prepare_save(self) -> Optional[RatingSave]:
+        """Copy what `save` writes: the pending plays, or all the ratings if the
+        play log is full (or disabled). Return None without a file."""
+        if self.file is None:
+            return None
+        if (
+            self.play_log is not None
+            and self.log_length + len(self.pending_plays)
+            < self.play_log.compaction_threshold
+        ):
+            lines = []
+            if not self.log_length:
+                lines.append(json.dumps(dict(snapshot=self.snapshot_digest)) + "\n")
+            for path, play in self.pending_plays:
+                line = json.dumps(dict(path=str(path), **play.model_dump()))
+                lines.append(line + "\n")
+            return RatingSave(
+                file=self.file,
+                plays=len(self.pending_plays),
+                log_lines=lines,
+                new_log=not self.log_length,
+                fsync=self.play_log.fsync,
+            )
+        return self._prepare_compaction()
+
+    def _prepare_compaction(self) -> RatingSave:
+        assert self.file is not None
+        if self.file_format == "binary":
+            content = self.to_columns().to_bytes()
+        else:
+            self.materialize()
+            content = json.dumps(
+                [s.model_dump() for s in self.ratings.values()],
+                default=pydantic_encoder,
+            ).encode()
+        return RatingSave(
+            file=self.file,
+            plays=len(self.pending_plays),
+            content=content,
+            number_of_backup_files=self.number_of_backup_files,
+        )
+
+    def finish_save(self, save: RatingSave) -> None:
+        """Record that `save` is written: the plays added since it was prepared
+        are still pending."""
+        if save.content is None:
+            self.log_length += save.plays
+        else:
+            self.snapshot_digest = hashlib.md5(save.content).hexdigest()
+            self.log_length = 0
+        del self.pending_plays[: save.plays]
+        self.signature = self.get_signature()
+
+    def compact(self) -> None:
+        """Write all the ratings to the ratings file and remove the play log.
+
+        The ratings are written to a temporary file, that replaces the ratings
+        file once complete.
+        """
+        save = self._prepare_compaction()
+        save.write()
+        self.finish_save(save)
 
     def backup_file(self) -> None:
         assert self.file is not None
-        for n in reversed(range(self.number_of_backup_files)):
-            if n == 0:
-                source = self.file
-            else:
-                source = Path(str(self.file) + f".bak{n}")
-            target = Path(str(self.file) + f".bak{n+1}")
-            if target.exists():
-                target.unlink()
-            if source.exists():
-                source.rename(target)
+        backup_file(self.file, self.number_of_backup_files)
+
+    def merge(self, played_songs: Iterable[PlayedSong]) -> int:
+        """Add the plays of `played_songs` that are not known yet, and return
+        their number.
+
+        A play is known if the song (identified by its path) already has a play
+        with the same timestamp. The ratings must then be saved with `compact`.
+        """
+        self.materialize()
+        count = 0
+        for played_song in played_songs:
+            song_id = _compute_remote_id(played_song.path)
+            existing = self.ratings.get(song_id)
+            if existing is None:
+                existing = self.ratings[song_id] = PlayedSong(
+                    path=played_song.path, plays=[]
+                )
+            timestamps = {p.timestamp for p in existing.plays}
+            for play in played_song.plays:
+                if play.timestamp not in timestamps:
+                    timestamps.add(play.timestamp)
+                    self._add_play(song_id, existing.path, play)
+                    count += 1
+        return count
+
+    def get_signature(self) -> Optional[RatingFilesSignature]:
+        if self.file is None:
+            return None
+        return (
+            get_file_signature(self.file),
+            get_file_signature(self.get_log_file(self.file)),
+        )
+
+    def is_up_to_date(self) -> bool:
+        """Tell whether the files were not modified since they were loaded or saved."""
+        return self.signature == self.get_signature()
+
+    @staticmethod
+    def get_log_file(file: Path) -> Path:
+        return Path(str(file) + ".log")
 
     @classmethod
-    def from_file(cls, file: Path) -> InMemoryRatingRepository:
-        played_songs = cls.load_songs_from_file(file)
-        return InMemoryRatingRepository(
-            ratings={_compute_remote_id(p.path): p for p in played_songs},
-            file=file,
+    def from_file(
+        cls,
+        file: Path,
+        play_log: Optional[PlayLogOptions] = None,
+        file_format: RatingFileFormat = "json",
+    ) -> InMemoryRatingRepository:
+        """Load the ratings from a JSON or binary file (whatever `file_format`)."""
+        repository = InMemoryRatingRepository(
+            ratings=dict(), file=file, play_log=play_log, file_format=file_format
         )
+        signature = repository.get_signature()
+        if file.exists():
+            content = file.read_bytes()
+            if RatingColumns.is_binary(content):
+                repository.load_columns(RatingColumns.from_bytes(content))
+            else:
+                played_songs = cls.parse_songs(content)
+                repository.ratings = {
+                    _compute_remote_id(p.path): p for p in played_songs
+                }
+                repository.build_aggregates()
+            repository.snapshot_digest = hashlib.md5(content).hexdigest()
+        repository.replay_log()
+        repository.signature = signature
+        return repository
+
+    def replay_log(self) -> None:
+        """Add the plays of the log, if it was written after the ratings file.
+
+        A truncated last line (from an interrupted write) is removed.
+        """
+        assert self.file is not None
+        log_file = self.get_log_file(self.file)
+        if not log_file.exists():
+            return
+        with log_file.open("rb+") as fh:
+            header = fh.readline()
+            try:
+                if json.loads(header)["snapshot"] != self.snapshot_digest:
+                    return
+            except (ValueError, KeyError):
+                return
+            offset = fh.tell()
+            for line in fh:
+                try:
+                    data = json.loads(line)
+                    path = Path(data.pop("path"))
+                    play = Play.model_validate(data)
+                except (ValueError, KeyError):
+                    fh.truncate(offset)
+                    break
+                self._add_play(_compute_remote_id(path), path, play)
+                self.log_length += 1
+                offset += len(line)
+
+    @classmethod
+    def open(
+        cls,
+        file: Path,
+        play_log: Optional[PlayLogOptions] = None,
+        file_format: RatingFileFormat = "json",
+    ) -> InMemoryRatingRepository:
+        """Load the ratings from `file`, or start empty ones if it doesn't exist."""
+        file.parent.mkdir(exist_ok=True, parents=True)
+        return cls.from_file(file, play_log=play_log, file_format=file_format)
+
+    @classmethod
+    def load_songs_from_file(cls, file: Path) -> list[PlayedSong]:
+        content = file.read_bytes()
+        if RatingColumns.is_binary(content):
+            repository = InMemoryRatingRepository(ratings=dict())
+            repository.load_columns(RatingColumns.from_bytes(content))
+            return repository.get_played_songs()
+        return cls.parse_songs(content)
 
     @staticmethod
-    def load_songs_from_file(file: Path) -> list[PlayedSong]:
-        data = json.loads(file.read_text())
+    def parse_songs(content: Union[str, bytes]) -> list[PlayedSong]:
+        data = json.loads(content)
         return pydantic.TypeAdapter(list[PlayedSong]).validate_python(data)
+
+
+def convert_ratings_file(
+    source: Path, target: Path, file_format: RatingFileFormat
+) -> None:
+    """Write the ratings of `source` (and of its play log) to `target`, in the
+    format `file_format`. The play log of `target` is removed."""
+    repository = InMemoryRatingRepository.from_file(source)
+    repository.file = target
+    repository.file_format = file_format
+    repository.compact()
+
+
+@dataclass
+class _UserRatings:
+    """The ratings of a user, and the state of their group commit."""
+
+    condition: threading.Condition = field(
+        default_factory=lambda: threading.Condition(threading.RLock())
+    )
+    repository: Optional[InMemoryRatingRepository] = None
+    # the plays are saved in batches: `batch` is the number of the batch that
+    # collects the new plays, `saved_batch` the number of the last one written
+    batch: int = 1
+    saved_batch: int = 0
+    saving: bool = False
+    failure: Optional[tuple[int, Exception]] = None
+
+
+@dataclass
+class RatingRepositoryCache:
+    """A LRU cache of rating repositories, reloaded when their file changes.
+
+    The accesses to the repository of a user (`get`, `read`, `add_play`,
+    `locked`) are serialized by a lock per user. The plays that are added
+    within `commit_delay` seconds of each other are saved together (group
+    commit), unless they are saved later in the background (`write_behind`).
+    """
+
+    max_size: int = 64
+    play_log: Optional[PlayLogOptions] = None
+    commit_delay: float = 0.0
+    write_behind: Optional[WriteBehindOptions] = None
+    file_format: RatingFileFormat = "json"
+    hits: int = 0
+    misses: int = 0
+    saves: int = 0
+    # the users are never removed, so that there is only one lock per user,
+    # but only `max_size` of them have their repository loaded
+    users: dict[str, _UserRatings] = field(default_factory=dict, repr=False)
+    loaded: OrderedDict[str, _UserRatings] = field(
+        default_factory=OrderedDict, repr=False
+    )
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    # the users with unsaved plays (write-behind mode), and the time of their
+    # first unsaved play (`time.monotonic`)
+    dirty: dict[str, float] = field(default_factory=dict, repr=False)
+    flusher: Optional[threading.Thread] = field(default=None, init=False, repr=False)
+    # notified when a user becomes dirty or the cache is closed (uses `lock`)
+    flusher_condition: threading.Condition = field(init=False, repr=False)
+    closed: bool = field(default=False, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.flusher_condition = threading.Condition(self.lock)
+
+    def get(self, key: str, file: Path) -> InMemoryRatingRepository:
+        """Return the repository of a user.
+
+        It must not be modified outside of `locked`: use `add_play` instead.
+        """
+        user = self._get_user(key)
+        with user.condition:
+            return self._load(key, user, file)
+
+    def read(
+        self,
+        key: str,
+        file: Path,
+        function: Callable[[InMemoryRatingRepository], T],
+    ) -> T:
+        """Call `function` with the repository of a user, while no play is added."""
+        user = self._get_user(key)
+        with user.condition:
+            return function(self._load(key, user, file))
+
+    def add_play(
+        self,
+        key: str,
+        file: Path,
+        song_id: str,
+        song_path: Path,
+        timestamp: int,
+        rating: Literal[0, 1, 2, 3, 4, 5],
+    ) -> Optional[float]:
+        """Add a play, wait until it is saved, and return the new rating of the song.
+
+        The first play of a batch waits for `commit_delay`, then saves the
+        batch. The plays that were added meanwhile wait for this save.
+        """
+        user = self._get_user(key)
+        with user.condition:
+            repository = self._load(key, user, file)
+            repository.add_play(
+                song_id=song_id, song_path=song_path, timestamp=timestamp, rating=rating
+            )
+            new_rating = repository.get_rating(song_id)
+            self._commit(key, user, repository)
+        return new_rating
+
+    def add_plays(
+        self, key: str, file: Path, plays: Sequence[SongPlay]
+    ) -> tuple[list[bool], dict[str, Optional[float]]]:
+        """Add the new plays (see `RatingRepository.add_new_plays`), wait until
+        they are saved (with a single write), and return whether each play was
+        added and the new ratings of the songs."""
+        user = self._get_user(key)
+        with user.condition:
+            repository = self._load(key, user, file)
+            added = repository.add_new_plays(plays)
+            ratings = {
+                song_id: repository.get_rating(song_id) for song_id, _, _ in plays
+            }
+            if any(added):
+                self._commit(key, user, repository)
+        return added, ratings
+
+    def _commit(
+        self, key: str, user: _UserRatings, repository: InMemoryRatingRepository
+    ) -> None:
+        """Save the plays added to the repository of a user, with the plays added
+        within `commit_delay`, or leave them to the flusher (write-behind mode).
+        The lock of the user must be held."""
+        if self.write_behind is not None:
+            self._defer_save(key, user, repository)
+            return
+        batch = user.batch
+        while user.saved_batch < batch:
+            if user.saving:
+                user.condition.wait()
+                continue
+            user.saving = True
+            try:
+                if self.commit_delay:
+                    user.condition.wait(self.commit_delay)
+                user.batch += 1
+                # the repository may have been invalidated meanwhile
+                if user.repository is not None:
+                    with metrics.time("vgsserver_stage_seconds", stage="save"):
+                        self._write(user, user.repository)
+                with self.lock:
+                    self.saves += 1
+            except Exception as e:
+                user.failure = (batch, e)
+                raise
+            finally:
+                user.saved_batch = batch
+                user.saving = False
+                user.condition.notify_all()
+        if user.failure is not None and user.failure[0] == batch:
+            raise user.failure[1]
+
+    def _defer_save(
+        self, key: str, user: _UserRatings, repository: InMemoryRatingRepository
+    ) -> None:
+        """Leave the save of a play to the flusher, unless the user has too many
+        unsaved plays or the cache is closed (the plays would never be saved).
+        The lock of the user must be held."""
+        assert self.write_behind is not None
+        if len(repository.pending_plays) < self.write_behind.max_plays:
+            with self.lock:
+                # a user made dirty before `closed` is set is saved by `close`
+                if not self.closed:
+                    if key not in self.dirty:
+                        self.dirty[key] = time.monotonic()
+                        self.flusher_condition.notify()
+                    if self.flusher is None:
+                        self.flusher = threading.Thread(
+                            target=self._run_flusher,
+                            name="ratings-flusher",
+                            daemon=True,
+                        )
+                        self.flusher.start()
+                    return
+        self._wait_for_save(user)
+        user.saving = True
+        try:
+            with metrics.time("vgsserver_stage_seconds", stage="save"):
+                self._write(user, repository)
+        finally:
+            user.saving = False
+            user.condition.notify_all()
+        with self.lock:
+            self.saves += 1
+            self.dirty.pop(key, None)
+
+    def _write(self, user: _UserRatings, repository: InMemoryRatingRepository) -> None:
+        """Save the pending plays of a repository, without holding the lock of
+        the user while the files are written, so that the reads of the ratings
+        don't wait for the disk.
+
+        The lock of the user must be held, and `user.saving` set: the other
+        writers wait for it (see `_wait_for_save`).
+        """
+        save = repository.prepare_save()
+        if save is None:
+            return
+        user.condition.release()
+        try:
+            save.write()
+        finally:
+            user.condition.acquire()
+        repository.finish_save(save)
+
+    @staticmethod
+    def _wait_for_save(user: _UserRatings) -> None:
+        """Wait until the files of a user are not being written. The lock of the
+        user must be held."""
+        while user.saving:
+            user.condition.wait()
+
+    def _run_flusher(self) -> None:
+        """Save the plays of the dirty users, `delay` seconds after they became
+        dirty."""
+        assert self.write_behind is not None
+        delay = self.write_behind.delay
+        while True:
+            with self.lock:
+                while True:
+                    if self.closed:
+                        return
+                    now = time.monotonic()
+                    due = [k for k, since in self.dirty.items() if since + delay <= now]
+                    if due:
+                        break
+                    timeout = None
+                    if self.dirty:
+                        timeout = min(self.dirty.values()) + delay - now
+                    self.flusher_condition.wait(timeout)
+            for key in due:
+                self._flush_user(key)
+
+    def _flush_user(self, key: str) -> None:
+        user = self._get_user(key)
+        with user.condition:
+            self._wait_for_save(user)
+            with self.lock:
+                self.dirty.pop(key, None)
+            repository = user.repository
+            if repository is None or not repository.pending_plays:
+                return
+            user.saving = True
+            try:
+                with metrics.time("vgsserver_rating_flush_seconds"):
+                    self._write(user, repository)
+            except Exception:
+                logger.exception("Can't save the ratings of %s", key)
+                # try again later
+                with self.lock:
+                    self.dirty.setdefault(key, time.monotonic())
+                return
+            finally:
+                user.saving = False
+                user.condition.notify_all()
+            with self.lock:
+                self.saves += 1
+
+    def flush(self) -> None:
+        """Save the plays of all the dirty users now."""
+        with self.lock:
+            keys = list(self.dirty)
+        for key in keys:
+            self._flush_user(key)
+
+    def close(self) -> None:
+        """Stop the flusher, and save the plays that are not saved yet. The
+        plays added afterwards are saved at once."""
+        with self.lock:
+            self.closed = True
+            self.flusher_condition.notify_all()
+            flusher = self.flusher
+        if flusher is not None:
+            flusher.join()
+        self.flush()
+
+    @contextmanager
+    def locked(self, key: str) -> Iterator[None]:
+        """Prevent any access to the repository of a user."""
+        user = self._get_user(key)
+        with user.condition:
+            yield
+
+    def invalidate(self, key: str) -> None:
+        user = self._get_user(key)
+        with user.condition:
+            self._wait_for_save(user)
+            user.repository = None
+            with self.lock:
+                self.loaded.pop(key, None)
+
+    def merge(self, key: str, file: Path, played_songs: Iterable[PlayedSong]) -> int:
+        """Add the new plays of `played_songs` to the ratings of a user, save
+        them, and return the number of plays added."""
+        user = self._get_user(key)
+        with user.condition:
+            self._wait_for_save(user)
+            repository = self._load(key, user, file)
+            count = repository.merge(played_songs)
+            with metrics.time("vgsserver_stage_seconds", stage="save"):
+                repository.compact()
+            with self.lock:
+                self.saves += 1
+            return count
+
+    def replace_file(self, key: str, file: Path, source: Path) -> None:
+        """Replace the ratings file of a user with `source`, and remove the log."""
+        user = self._get_user(key)
+        with user.condition:
+            self._wait_for_save(user)
+            install_file(source, file, InMemoryRatingRepository.number_of_backup_files)
+            InMemoryRatingRepository.get_log_file(file).unlink(missing_ok=True)
+            user.repository = None
+            with self.lock:
+                self.loaded.pop(key, None)
+
+    def _get_user(self, key: str) -> _UserRatings:
+        with self.lock:
+            user = self.users.get(key)
+            if user is None:
+                user = self.users[key] = _UserRatings()
+            return user
+
+    def _load(
+        self, key: str, user: _UserRatings, file: Path
+    ) -> InMemoryRatingRepository:
+        """Return the repository of a user, loading it if needed.
+
+        The lock of the user must be held.
+        """
+        repository = user.repository
+        # the unsaved plays win over a concurrent modification of the files
+        if (
+            repository is not None
+            and repository.file == file
+            and (repository.pending_plays or repository.is_up_to_date())
+        ):
+            with self.lock:
+                self.loaded.move_to_end(key)
+                self.hits += 1
+            return repository
+        with self.lock:
+            self.misses += 1
+
+        with metrics.time("vgsserver_stage_seconds", stage="ratings_load"):
+            repository = InMemoryRatingRepository.open(
+                file, play_log=self.play_log, file_format=self.file_format
+            )
+        user.repository = repository
+
+        with self.lock:
+            self.loaded[key] = user
+            self.loaded.move_to_end(key)
+            self._evict()
+        return repository
+
+    def _evict(self) -> None:
+        """Unload the least recently used repositories that are not in use."""
+        for key, user in list(self.loaded.items()):
+            if len(self.loaded) <= self.max_size:
+                break
+            # the users' locks are taken before the cache lock, so don't wait
+            if not user.condition.acquire(blocking=False):
+                continue
+            try:
+                if user.saving or (
+                    user.repository is not None and user.repository.pending_plays
+                ):
+                    continue
+                user.repository = None
+                del self.loaded[key]
+            finally:
+                user.condition.release()
+
+    def __len__(self) -> int:
+        return len(self.loaded)
@@ -0,0 +1,222 @@
+"""Weighted random sampling of songs, with weights that can be updated.
+
+The weight of each key is `constant + slope * now`, where `now` is the time of
+the draw, so that weights growing with time (like the time since the last
+play) don't have to be recomputed. Both terms are stored in Fenwick trees:
+updating a weight and drawing a key cost O(log n).
+"""
+
+from __future__ import annotations
+
+import heapq
+import time
+from array import array
+from random import Random
+from typing import Callable, Iterable, Literal, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+
+Weighting = Literal["rating", "last_played", "play_count"]
+
+
+class FenwickTree:
+    """Prefix sums of an array of floats, with O(log n) updates."""
+
+    def __init__(self, values: Iterable[float]) -> None:
+        # 1-based: `tree[i]` is the sum of the values in `(i - (i & -i), i]`
+        self.tree = array("d", [0.0])
+        self.tree.extend(values)
+        n = len(self.tree) - 1
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                self.tree[parent] += self.tree[i]
+
+    def __len__(self) -> int:
+        return len(self.tree) - 1
+
+    def add(self, index: int, delta: float) -> None:
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, stop: int) -> float:
+        """Return the sum of the values in `[0, stop)`."""
+        total = 0.0
+        i = stop
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+
+class SamplerKeys:
+    """The keys of the samplers of a catalog, with their positions.
+
+    Built once per catalog and shared by the samplers of all the users, which
+    only store the weights of the keys. `find` returns the position of a key
+    (by default, from a dictionary of the keys).
+    """
+
+    def __init__(
+        self,
+        keys: Sequence[str],
+        find: Optional[Callable[[str], Optional[int]]] = None,
+    ) -> None:
+        self.keys = keys
+        if find is None:
+            find = {key: i for i, key in enumerate(keys)}.get
+        self.find = find
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __getitem__(self, index: int) -> str:
+        return self.keys[index]
+
+
+class WeightedSampler:
+    """Draw keys at random, with a probability proportional to their weight."""
+
+    def __init__(
+        self,
+        keys: SamplerKeys,
+        terms: Iterable[tuple[str, float, float]],
+        default: tuple[float, float] = (0.0, 0.0),
+    ) -> None:
+        """The weights of the keys are given by `terms` (key, constant, slope),
+        the keys not in `terms` have the `default` terms, so that only the keys
+        with a specific weight (like the played songs) are looked up."""
+        self.keys = keys
+        constant, slope = default
+        self.constants = array("d", [constant]) * len(keys)
+        self.slopes = array("d", [slope]) * len(keys)
+        # the weights are not negative after this time
+        self.min_now = 0.0
+        if slope > 0:
+            self.min_now = -constant / slope
+        for key, constant, slope in terms:
+            i = keys.find(key)
+            if i is None:
+                continue
+            self.constants[i] = constant
+            self.slopes[i] = slope
+            if slope > 0:
+                self.min_now = max(self.min_now, -constant / slope)
+        self.constant_tree = FenwickTree(self.constants)
+        # most weightings don't depend on time
+        self.slope_tree: Optional[FenwickTree] = None
+        if any(self.slopes):
+            self.slope_tree = FenwickTree(self.slopes)
+
+    def get_now(self) -> float:
+        return max(time.time(), self.min_now)
+
+    def get_weight(self, key: str, now: float = 0.0) -> float:
+        i = self.keys.find(key)
+        if i is None:
+            return 0.0
+        return self.constants[i] + self.slopes[i] * now
+
+    def update(self, key: str, constant: float, slope: float) -> None:
+        i = self.keys.find(key)
+        if i is None:
+            return
+        self._add(i, constant - self.constants[i], slope - self.slopes[i])
+        self.constants[i] = constant
+        self.slopes[i] = slope
+        if slope > 0:
+            self.min_now = max(self.min_now, -constant / slope)
+
+    def _add(self, i: int, constant: float, slope: float) -> None:
+        self.constant_tree.add(i, constant)
+        if slope:
+            if self.slope_tree is None:
+                self.slope_tree = FenwickTree([0.0] * len(self.keys))
+            self.slope_tree.add(i, slope)
+
+    def _prefix_weight(self, stop: int, now: float) -> float:
+        total = self.constant_tree.prefix_sum(stop)
+        if self.slope_tree is not None:
+            total += self.slope_tree.prefix_sum(stop) * now
+        return total
+
+    def _find(self, target: float, now: float) -> int:
+        """Return the index whose cumulated weight range contains `target`."""
+        n = len(self.keys)
+        constants = self.constant_tree.tree
+        slopes = self.slope_tree.tree if self.slope_tree is not None else None
+        position = 0
+        step = 1 << n.bit_length()
+        while step:
+            i = position + step
+            if i <= n:
+                weight = constants[i] + (slopes[i] * now if slopes else 0.0)
+                if weight <= target:
+                    target -= weight
+                    position = i
+            step >>= 1
+        return min(position, n - 1)
+
+    def sample(
+        self,
+        random: Random,
+        count: int,
+        accept: Callable[[int], bool],
+        start: int = 0,
+        now: Optional[float] = None,
+    ) -> list[int]:
+        """Draw up to `count` distinct indices of keys in `[start, n)`, without
+        replacement, among those that are accepted.
+
+        Each drawn index has its weight temporarily set to 0, so that the cost
+        is O(log n) per drawn index, accepted or not.
+        """
+        if now is None:
+            now = self.get_now()
+        n = len(self.keys)
+        drawn: dict[int, tuple[float, float]] = {}
+        chosen: list[int] = []
+        try:
+            for _ in range(n - start):
+                if len(chosen) == count:
+                    break
+                low = self._prefix_weight(start, now)
+                total = self._prefix_weight(n, now) - low
+                if total <= 0:
+                    break
+                i = self._find(low + random.random() * total, now)
+                # rounding errors may land on a drawn or out of range index
+                if i < start or i in drawn:
+                    continue
+                constant, slope = drawn[i] = (self.constants[i], self.slopes[i])
+                self._add(i, -constant, -slope)
+                if constant + slope * now > 0 and accept(i):
+                    chosen.append(i)
+        finally:
+            for i, (constant, slope) in drawn.items():
+                self._add(i, constant, slope)
+        return chosen
+
+    def sample_from(
+        self,
+        random: Random,
+        pool: Iterable[T],
+        count: int,
+        get_key: Callable[[T], str],
+        now: Optional[float] = None,
+    ) -> list[T]:
+        """Draw up to `count` distinct elements of `pool`, without replacement.
+
+        This is O(len(pool)), and is meant for small pools (Efraimidis-Spirakis:
+        the elements with the largest `random() ** (1 / weight)` are chosen).
+        """
+        if now is None:
+            now = self.get_now()
+        keyed: list[tuple[float, int, T]] = []
+        for n, element in enumerate(pool):
+            weight = self.get_weight(get_key(element), now)
+            if weight > 0:
+                keyed.append((random.random() ** (1 / weight), n, element))
+        return [element for _, _, element in heapq.nlargest(count, keyed)]
@@ -0,0 +1,243 @@
+"""Build the metadata file, by reading the headers of the songs of a library.
+
+Only the headers are read (the loop points and the number of samples), in
+a pool of processes. The songs whose modification time and size haven't
+changed since the previous scan are not read again.
+"""
+
+from __future__ import annotations
+
+import functools
+import json
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, Optional
+
+import pydantic
+
+from ratings import create_temp_file
+from songs import MetadataEntry
+
+
+@dataclass
+class AudioInfo:
+    sample_rate: int
+    samples: int
+    # in samples, `None` if the song doesn't loop
+    loop_start: Optional[int] = None
+    loop_end: Optional[int] = None
+
+    def to_microseconds(self, samples: int) -> int:
+        return samples * 1_000_000 // self.sample_rate
+
+
+def read_brstm_info(fh: BinaryIO) -> AudioInfo:
+    """Read the stream info of the HEAD chunk of a BRSTM file."""
+    header = fh.read(0x14)
+    if len(header) < 0x14 or header[:4] != b"RSTM":
+        raise ValueError("Not a BRSTM file")
+    order = ">" if header[4:6] == b"\xfe\xff" else "<"
+    (head_offset,) = struct.unpack(order + "I", header[0x10:0x14])
+    fh.seek(head_offset)
+    head = fh.read(0x10)
+    if head[:4] != b"HEAD":
+        raise ValueError("No HEAD chunk")
+    # the first reference of the chunk, relative to the start of its data
+    (info_offset,) = struct.unpack(order + "I", head[0x0C:0x10])
+    fh.seek(head_offset + 8 + info_offset)
+    (_, loops, _, _, sample_rate, _, loop_start, samples) = struct.unpack(
+        order + "BBBBHHII", fh.read(0x10)
+    )
+    if not sample_rate:
+        raise ValueError("No sample rate")
+    if not loops:
+        return AudioInfo(sample_rate=sample_rate, samples=samples)
+    return AudioInfo(
+        sample_rate=sample_rate,
+        samples=samples,
+        loop_start=loop_start,
+        loop_end=samples,
+    )
+
+
+def read_wav_info(fh: BinaryIO) -> AudioInfo:
+    """Read the format, the size of the data and the first loop of a WAV file,
+    skipping the samples."""
+    header = fh.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise ValueError("Not a WAV file")
+    sample_rate = block_align = data_size = 0
+    loop: Optional[tuple[int, int]] = None
+    while True:
+        chunk_header = fh.read(8)
+        if len(chunk_header) < 8:
+            break
+        name, size = chunk_header[:4], struct.unpack("<I", chunk_header[4:])[0]
+        if name == b"fmt ":
+            fmt = fh.read(size)
+            sample_rate, _, block_align = struct.unpack("<IIH", fmt[4:14])
+            size = 0
+        elif name == b"smpl":
+            smpl = fh.read(size)
+            (number_of_loops,) = struct.unpack("<I", smpl[28:32])
+            if number_of_loops:
+                # the end is inclusive
+                start, end = struct.unpack("<II", smpl[44:52])
+                loop = (start, end + 1)
+            size = 0
+        elif name == b"data":
+            data_size = size
+        fh.seek(size + size % 2, os.SEEK_CUR)
+    if not sample_rate or not block_align:
+        raise ValueError("No format chunk")
+    samples = data_size // block_align
+    if loop is None:
+        return AudioInfo(sample_rate=sample_rate, samples=samples)
+    return AudioInfo(
+        sample_rate=sample_rate, samples=samples, loop_start=loop[0], loop_end=loop[1]
+    )
+
+
+READERS: dict[str, Callable[[BinaryIO], AudioInfo]] = {
+    ".brstm": read_brstm_info,
+    ".wav": read_wav_info,
+}
+
+
+def scan_file(
+    root: Path, path: str, previous: Optional[MetadataEntry] = None
+) -> Optional[MetadataEntry]:
+    """Read the metadata of the song `root / path`, or return None if the file
+    doesn't exist anymore (it was removed during the scan).
+
+    The titles are kept from the `previous` entry of the song, if any (they
+    may have been edited), else they are made from the path.
+    """
+    file = root / path
+    entry = None
+    try:
+        stat = file.stat()
+        entry = MetadataEntry(
+            path=Path(path),
+            timestamp=int(stat.st_mtime),
+            size=stat.st_size,
+            title=previous.title if previous else file.stem,
+            game_title=previous.game_title if previous else file.parent.name or None,
+        )
+        with file.open("rb") as fh:
+            info = READERS[file.suffix.lower()](fh)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, struct.error):
+        if entry is None:
+            return None
+        entry.error = True
+        return entry
+    entry.duration = info.samples / info.sample_rate
+    if info.loop_start is not None and info.loop_end is not None:
+        entry.loop_start = info.to_microseconds(info.loop_start)
+        entry.loop_end = info.to_microseconds(info.loop_end)
+    return entry
+
+
+def _scan_file(
+    root: Path, item: tuple[str, Optional[MetadataEntry]]
+) -> Optional[MetadataEntry]:
+    return scan_file(root, *item)
+
+
+def iter_song_paths(root: Path) -> Iterable[str]:
+    """Yield the paths of the songs of the library, relative to `root`."""
+    for dir_name, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() in READERS:
+                yield Path(dir_name, file_name).relative_to(root).as_posix()
+
+
+@dataclass
+class ScanReport:
+    songs: int = 0
+    read: int = 0
+    unchanged: int = 0
+    removed: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+
+    @property
+    def songs_per_second(self) -> float:
+        return self.songs / self.seconds if self.seconds else 0.0
+
+    @property
+    def read_per_second(self) -> float:
+        return self.read / self.seconds if self.seconds else 0.0
+
+
+def scan_library(
+    root: Path,
+    previous: Iterable[MetadataEntry] = (),
+    workers: Optional[int] = None,
+) -> tuple[list[MetadataEntry], ScanReport]:
+    """Return the metadata of the songs of the library `root`, sorted by path.
+
+    The `previous` entries of the songs whose modification time and size
+    haven't changed are reused. The other songs are read in `workers`
+    processes (the number of CPUs by default, 0 to read them in this process).
+    """
+    start = time.perf_counter()
+    previous_entries = {e.path.as_posix(): e for e in previous}
+    entries: dict[str, MetadataEntry] = {}
+    to_read: list[tuple[str, Optional[MetadataEntry]]] = []
+    for path in iter_song_paths(root):
+        entry = previous_entries.get(path)
+        if entry is not None:
+            try:
+                stat = (root / path).stat()
+            except FileNotFoundError:
+                continue  # removed since the walk
+            if entry.timestamp == int(stat.st_mtime) and entry.size == stat.st_size:
+                entries[path] = entry
+                continue
+        to_read.append((path, entry))
+
+    read = functools.partial(_scan_file, root)
+    if workers == 0 or len(to_read) < 2:
+        results = list(map(read, to_read))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(read, to_read, chunksize=64))
+    # the songs removed during the scan are skipped
+    scanned = [e for e in results if e is not None]
+    for entry in scanned:
+        entries[entry.path.as_posix()] = entry
+
+    report = ScanReport(
+        songs=len(entries),
+        read=len(scanned),
+        unchanged=len(entries) - len(scanned),
+        removed=len(previous_entries.keys() - entries.keys()),
+        errors=sum(1 for e in entries.values() if e.error),
+        seconds=time.perf_counter() - start,
+    )
+    return [entries[path] for path in sorted(entries)], report
+
+
+def load_metadata(file: Path) -> list[MetadataEntry]:
+    data = json.loads(file.read_text())
+    return pydantic.TypeAdapter(list[MetadataEntry]).validate_python(data)
+
+
+def write_metadata(file: Path, entries: Iterable[MetadataEntry]) -> None:
+    """Write the metadata file (atomically: the server may be reading it)."""
+    temp_file = create_temp_file(file)
+    try:
+        with temp_file.open("w") as fh:
+            json.dump([e.model_dump(mode="json") for e in entries], fh, indent=2)
+        os.replace(temp_file, file)
+    except BaseException:
+        temp_file.unlink(missing_ok=True)
+        raise
@@ -1,18 +1,39 @@
 from __future__ import annotations
 
 import json
+import threading
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, field
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import InitVar, dataclass, field
+from functools import cached_property
 from pathlib import Path
 from random import Random
-from typing import Optional
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Generic,
+    Hashable,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    TypeVar,
+    overload,
+)
 
 import pydantic
 from pydantic import BaseModel
 
 from ratings import RatingRepository
+from sampling import SamplerKeys, Weighting
 from util import _compute_remote_id
 
+T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
+
 
 class MetadataEntry(BaseModel):
     path: Path
@@ -33,6 +54,26 @@ class Song(MetadataEntry):
 
 class SongRepository(ABC):
     @abstractmethod
+    def get_random_songs(
+        self,
+        ratings: RatingRepository,
+        count: int,
+        min_duration: Optional[int] = None,
+        title_contains: Optional[str] = None,
+        game_title_contains: Optional[str] = None,
+        min_rating: Optional[int] = None,
+        only_has_rating: Optional[bool] = None,
+        only_has_no_rating: Optional[bool] = None,
+        excluded_ids: Collection[str] = (),
+        weighting: Optional[Weighting] = None,
+    ) -> list[Song]:
+        """Return up to `count` distinct songs, in a random order.
+
+        By default, the songs are drawn uniformly, else with a probability
+        proportional to their weight (see `get_weight_terms`).
+        """
+        ...  # pragma:nocover
+
     def get_random_song(
         self,
         ratings: RatingRepository,
@@ -42,61 +83,484 @@ class SongRepository(ABC):
         min_rating: Optional[int] = None,
         only_has_rating: Optional[bool] = None,
         only_has_no_rating: Optional[bool] = None,
+        weighting: Optional[Weighting] = None,
     ) -> Optional[Song]:
-        ...  # pragma:nocover
+        songs = self.get_random_songs(
+            ratings=ratings,
+            count=1,
+            min_duration=min_duration,
+            title_contains=title_contains,
+            game_title_contains=game_title_contains,
+            min_rating=min_rating,
+            only_has_rating=only_has_rating,
+            only_has_no_rating=only_has_no_rating,
+            weighting=weighting,
+        )
+        return songs[0] if songs else None
 
     @abstractmethod
     def get_file(self, song_id: str) -> bytes:
         ...  # pragma:nocover
 
+    @abstractmethod
+    def __len__(self) -> int:
+        """Return the number of songs."""
+        ...  # pragma:nocover
+
     @abstractmethod
     def get_song_by_id(self, song_id: str) -> Optional[Song]:
         ...  # pragma:nocover
 
 
+@dataclass
+class SongFileCache:
+    """Keep the bytes of the most recently downloaded songs in memory.
+
+    The least recently used songs are evicted to stay under `max_bytes`. A
+    song is read again when the modification time or the size of its file
+    change. Concurrent misses of a song are coalesced: one thread reads the
+    file, the others wait for it (they are counted in `coalesced`, not in the
+    hits).
+    """
+
+    max_bytes: int
+    # larger files are not cached, so that a single download doesn't evict
+    # the hot songs (a quarter of `max_bytes` by default): `get_file` doesn't
+    # read them, they are streamed from disk
+    max_file_bytes: Optional[int] = None
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    bytes_saved: int = 0
+    size: int = 0  # bytes
+    # by song id: (modification time in ns, size in bytes), content
+    entries: OrderedDict[str, tuple[tuple[int, int], bytes]] = field(
+        default_factory=OrderedDict, repr=False
+    )
+    loading: dict[str, Future[bytes]] = field(default_factory=dict, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.max_file_bytes is None:
+            self.max_file_bytes = self.max_bytes // 4
+
+    def get_file(self, songs: SongRepository, song: Song) -> Optional[bytes]:
+        """Return the content of the `song` file, read with `songs.get_file`
+        if it is not cached, or None if it is too large to be cached."""
+        stat = song.absolute_path.stat()
+        assert self.max_file_bytes is not None
+        if stat.st_size > self.max_file_bytes:
+            return None
+        signature = stat.st_mtime_ns, stat.st_size
+        with self.lock:
+            entry = self.entries.get(song.remote_id)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(song.remote_id)
+                self.hits += 1
+                self.bytes_saved += len(entry[1])
+                return entry[1]
+            future = self.loading.get(song.remote_id)
+            is_reader = future is None
+            if future is None:
+                future = self.loading[song.remote_id] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not is_reader:
+            # read by another thread
+            content = future.result()
+            with self.lock:
+                self.bytes_saved += len(content)
+            return content
+
+        try:
+            content = songs.get_file(song.remote_id)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[song.remote_id]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[song.remote_id]
+            if song.remote_id in self.entries:
+                self._remove(song.remote_id)
+            # the file may have grown since it was checked
+            if len(content) <= self.max_file_bytes:
+                self.entries[song.remote_id] = signature, content
+                self.size += len(content)
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self.entries)))
+        future.set_result(content)
+        return content
+
+    def _remove(self, song_id: str) -> None:
+        _, content = self.entries.pop(song_id)
+        self.size -= len(content)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SequenceView(Sequence[T]):
+    """A read-only window `[start, stop)` over a sequence, without copying it."""
+
+    def __init__(self, sequence: Sequence[T], start: int, stop: int) -> None:
+        self.sequence = sequence
+        self.start = start
+        self.stop = max(start, stop)
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    @overload
+    def __getitem__(self, index: int) -> T:
+        ...  # pragma:nocover
+
+    @overload
+    def __getitem__(self, index: slice) -> Sequence[T]:
+        ...  # pragma:nocover
+
+    def __getitem__(self, index: int | slice) -> T | Sequence[T]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.sequence[self.start + index]
+
+
+def iter_random_permutation(random: Random, pool: Sequence[T]) -> Iterator[T]:
+    """Yield the elements of `pool` in a uniformly random order.
+
+    This is a lazy Fisher-Yates shuffle: only the swapped positions are
+    stored, so taking the first `k` elements costs O(k) instead of O(n).
+    """
+    swapped: dict[int, int] = {}
+    n = len(pool)
+    for i in range(n):
+        j = random.randrange(i, n)
+        chosen = swapped.get(j, j)
+        swapped[j] = swapped.get(i, i)
+        yield pool[chosen]
+
+
+@dataclass
+class DurationIndex(Generic[K]):
+    """Song keys sorted by duration, to select songs with a minimum duration."""
+
+    keys: Sequence[K]
+    durations: Sequence[float]
+
+    @classmethod
+    def build(cls, items: Iterable[tuple[K, float]]) -> DurationIndex[K]:
+        items = sorted(items, key=lambda item: item[1])
+        return cls(
+            keys=[key for key, _ in items],
+            durations=[duration for _, duration in items],
+        )
+
+    def updated(
+        self,
+        removed: Iterable[tuple[K, float]],
+        added: Iterable[tuple[K, float]],
+    ) -> DurationIndex[K]:
+        """Return a copy of the index, without `removed` and with `added`."""
+        keys, durations = list(self.keys), list(self.durations)
+        for key, duration in removed:
+            i = bisect_left(durations, duration)
+            while keys[i] != key:
+                i += 1
+            del keys[i]
+            del durations[i]
+        for key, duration in added:
+            i = bisect_right(durations, duration)
+            keys.insert(i, key)
+            durations.insert(i, duration)
+        return DurationIndex(keys=keys, durations=durations)
+
+    def get_start(self, min_duration: Optional[float] = None) -> int:
+        """Return the position of the first key with at least `min_duration`."""
+        if min_duration is None:
+            return 0
+        return bisect_left(self.durations, min_duration)
+
+    def get_keys(self, min_duration: Optional[float] = None) -> Sequence[K]:
+        return SequenceView(self.keys, self.get_start(min_duration), len(self.keys))
+
+
+@dataclass
+class SubstringIndex(Generic[K]):
+    """An inverted trigram index, to find the songs whose text contains a string.
+
+    The search is case insensitive (texts are casefolded), and songs without
+    text always match, as do the filters of `get_random_song`.
+    """
+
+    texts: dict[K, str] = field(default_factory=dict)
+    trigrams: dict[str, set[K]] = field(default_factory=dict)
+    short_keys: set[K] = field(default_factory=set)  # texts without trigrams
+    keys_without_text: set[K] = field(default_factory=set)
+
+    @classmethod
+    def build(cls, items: Iterable[tuple[K, Optional[str]]]) -> SubstringIndex[K]:
+        index = cls()
+        for key, text in items:
+            index.add(key, text)
+        return index
+
+    def add(self, key: K, text: Optional[str]) -> None:
+        if text is None:
+            self.keys_without_text.add(key)
+            return
+        text = self._add_text(key, text)
+        for trigram in get_trigrams(text):
+            self.trigrams.setdefault(trigram, set()).add(key)
+
+    def _add_text(self, key: K, text: str) -> str:
+        text = text.casefold()
+        self.texts[key] = text
+        if len(text) < 3:
+            self.short_keys.add(key)
+        return text
+
+    def updated(
+        self, removed: Iterable[K], added: Iterable[tuple[K, Optional[str]]]
+    ) -> SubstringIndex[K]:
+        """Return a copy of the index, without `removed` and with `added`.
+
+        The postings of the trigrams that don't change are shared with the copy.
+        """
+        index = SubstringIndex(
+            texts=dict(self.texts),
+            trigrams=dict(self.trigrams),
+            short_keys=set(self.short_keys),
+            keys_without_text=set(self.keys_without_text),
+        )
+        removals: dict[str, set[K]] = dict()
+        additions: dict[str, set[K]] = dict()
+        for key in removed:
+            index.keys_without_text.discard(key)
+            index.short_keys.discard(key)
+            text = index.texts.pop(key, None)
+            for trigram in get_trigrams(text or ""):
+                removals.setdefault(trigram, set()).add(key)
+        for key, text in added:
+            if text is None:
+                index.keys_without_text.add(key)
+                continue
+            for trigram in get_trigrams(index._add_text(key, text)):
+                additions.setdefault(trigram, set()).add(key)
+        for trigram in removals.keys() | additions.keys():
+            posting = self.trigrams.get(trigram, set()) - removals.get(trigram, set())
+            posting |= additions.get(trigram, set())
+            if posting:
+                index.trigrams[trigram] = posting
+            else:
+                index.trigrams.pop(trigram, None)
+        return index
+
+    def search(self, needle: Optional[str]) -> Optional[set[K]]:
+        """Return the keys whose text contains `needle`, or that have no text.
+
+        Return `None` if all the songs match.
+        """
+        if needle is None:
+            return None
+        needle = needle.casefold()
+        if not needle:
+            return None
+        if len(needle) < 3:
+            matches = {k for k in self.short_keys if needle in self.texts[k]}
+            for trigram, keys in self.trigrams.items():
+                if needle in trigram:
+                    matches.update(keys)
+        else:
+            postings = sorted(
+                (
+                    self.trigrams.get(needle[i : i + 3], set())
+                    for i in range(len(needle) - 2)
+                ),
+                key=len,
+            )
+            matches = postings[0].intersection(*postings[1:])
+            if len(needle) > 3:
+                matches = {k for k in matches if needle in self.texts[k]}
+        return matches | self.keys_without_text
+
+
+def get_trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+@dataclass
+class SongIndexes:
+    durations: DurationIndex[str]
+    titles: SubstringIndex[str]
+    game_titles: SubstringIndex[str]
+
+    @staticmethod
+    def build(songs: dict[str, Song]) -> SongIndexes:
+        return SongIndexes(
+            durations=DurationIndex.build(
+                (id, song.duration) for id, song in songs.items()
+            ),
+            titles=SubstringIndex.build((id, song.title) for id, song in songs.items()),
+            game_titles=SubstringIndex.build(
+                (id, song.game_title) for id, song in songs.items()
+            ),
+        )
+
+    @cached_property
+    def sampler_keys(self) -> SamplerKeys:
+        """The keys of the weighted samplers of the ratings, shared by the
+        users."""
+        return SamplerKeys(self.durations.keys)
+
+    def updated(self, removed: list[Song], added: list[Song]) -> SongIndexes:
+        return SongIndexes(
+            durations=self.durations.updated(
+                removed=((s.remote_id, s.duration) for s in removed),
+                added=((s.remote_id, s.duration) for s in added),
+            ),
+            titles=self.titles.updated(
+                removed=(s.remote_id for s in removed),
+                added=((s.remote_id, s.title) for s in added),
+            ),
+            game_titles=self.game_titles.updated(
+                removed=(s.remote_id for s in removed),
+                added=((s.remote_id, s.game_title) for s in added),
+            ),
+        )
+
+
+@dataclass
+class CatalogDiff:
+    added: int = 0
+    removed: int = 0
+    changed: int = 0
+    unchanged: int = 0
+
+
+def make_song(entry: MetadataEntry, root: Path) -> Song:
+    return Song(
+        **entry.model_dump(),
+        absolute_path=Path(root / entry.path),
+        remote_id=_compute_remote_id(entry.path),
+    )
+
+
+def make_rating_filter(
+    ratings: RatingRepository,
+    min_rating: Optional[int] = None,
+    only_has_rating: Optional[bool] = None,
+    only_has_no_rating: Optional[bool] = None,
+) -> Callable[[str], bool]:
+    """Make a function telling whether a song (by id) passes the rating filters."""
+
+    def matches(song_id: str) -> bool:
+        song_rating = ratings.get_rating(song_id)
+        if only_has_rating and song_rating is None:
+            return False
+        if only_has_no_rating and song_rating is not None:
+            return False
+        if (
+            min_rating is not None
+            and song_rating is not None
+            and song_rating < min_rating
+        ):
+            return False
+        return True
+
+    return matches
+
+
 @dataclass
 class InMemorySongRepository(SongRepository):
     songs: dict[str, Song]
     random: Random = field(default_factory=Random)
+    indexes: SongIndexes = field(init=False, repr=False, compare=False)
+    # the indexes of `songs`, if they are already built
+    prebuilt_indexes: InitVar[Optional[SongIndexes]] = None
 
-    def get_random_song(
+    def __post_init__(self, prebuilt_indexes: Optional[SongIndexes]) -> None:
+        self.indexes = prebuilt_indexes or SongIndexes.build(self.songs)
+
+    def get_random_songs(
         self,
         ratings: RatingRepository,
+        count: int,
         min_duration: Optional[int] = None,
         title_contains: Optional[str] = None,
         game_title_contains: Optional[str] = None,
         min_rating: Optional[int] = None,
         only_has_rating: Optional[bool] = None,
         only_has_no_rating: Optional[bool] = None,
-    ) -> Optional[Song]:
-        ids = list(self.songs.keys())
-        self.random.shuffle(ids)
-        for id in ids:
+        excluded_ids: Collection[str] = (),
+        weighting: Optional[Weighting] = None,
+    ) -> list[Song]:
+        if count <= 0:
+            return []
+        title_matches = self.indexes.titles.search(title_contains)
+        game_title_matches = self.indexes.game_titles.search(game_title_contains)
+        rated_ids = None
+        if only_has_rating:
+            rated_ids = ratings.get_rated_song_ids(min_rating)
+
+        # draw from the smallest set of candidates, and check the other filters
+        candidates: Sequence[str] = self.indexes.durations.get_keys(min_duration)
+        narrowed = False
+        for matches in (title_matches, game_title_matches):
+            if matches is not None and len(matches) < len(candidates):
+                # sorted: the order of a set of strings depends on the hash
+                # seed, and the draws must only depend on `random`
+                candidates = sorted(id for id in matches if id in self.songs)
+                narrowed = True
+        if rated_ids is not None and len(rated_ids) < len(candidates):
+            candidates = [id for id in rated_ids if id in self.songs]
+            narrowed = True
+
+        rating_filter = make_rating_filter(
+            ratings=ratings,
+            min_rating=min_rating,
+            only_has_rating=only_has_rating,
+            only_has_no_rating=only_has_no_rating,
+        )
+
+        def accept(id: str) -> bool:
             song = self.songs[id]
             if min_duration is not None and song.duration < min_duration:
-                continue
-            if (
-                title_contains is not None
-                and song.title is not None
-                and title_contains.casefold() not in song.title.casefold()
-            ):
-                continue
-            if (
-                game_title_contains is not None
-                and song.game_title is not None
-                and game_title_contains.casefold() not in song.game_title.casefold()
-            ):
-                continue
-            if only_has_rating and ratings.song_has_no_rating(song.remote_id):
-                continue
-            if only_has_no_rating and ratings.song_has_rating(song.remote_id):
-                continue
-            if min_rating is not None and ratings.song_has_rating(song.remote_id):
-                song_rating = ratings.get_rating(song.remote_id)
-                if song_rating is not None and song_rating < min_rating:
-                    continue
-            return song
-        return None
+                return False
+            if title_matches is not None and id not in title_matches:
+                return False
+            if game_title_matches is not None and id not in game_title_matches:
+                return False
+            if id in excluded_ids:
+                return False
+            return rating_filter(id)
+
+        if weighting is not None:
+            keys = self.indexes.sampler_keys
+            sampler = ratings.get_sampler(weighting, keys)
+            if narrowed:
+                ids = sampler.sample_from(
+                    self.random, filter(accept, candidates), count, lambda id: id
+                )
+            else:
+                positions = sampler.sample(
+                    self.random,
+                    count,
+                    lambda i: accept(keys[i]),
+                    start=self.indexes.durations.get_start(min_duration),
+                )
+                ids = [keys[i] for i in positions]
+            return [self.songs[id] for id in ids]
+
+        songs: list[Song] = []
+        for id in iter_random_permutation(self.random, candidates):
+            if accept(id):
+                songs.append(self.songs[id])
+                if len(songs) == count:
+                    break
+        return songs
 
     @staticmethod
     def from_file(
@@ -104,25 +568,68 @@ class InMemorySongRepository(SongRepository):
     ) -> InMemorySongRepository:
         data = json.loads(file.read_text())
         entries = pydantic.TypeAdapter(list[MetadataEntry]).validate_python(data)
-
-        def make_song(e: MetadataEntry) -> tuple[str, Song]:
-            id = _compute_remote_id(e.path)
-            song = Song(
-                **e.model_dump(),
-                absolute_path=Path(file.parent / e.path),
-                remote_id=_compute_remote_id(e.path),
-            )
-            return id, song
-
         if not random:
             random = Random()
         return InMemorySongRepository(
-            songs=dict(make_song(e) for e in entries),
+            songs={
+                song.remote_id: song
+                for song in (make_song(e, file.parent) for e in entries)
+            },
             random=random,
         )
 
+    def update_from_file(
+        self, file: Path
+    ) -> tuple[InMemorySongRepository, CatalogDiff]:
+        """Load a new version of the metadata file in a new repository.
+
+        The songs whose metadata haven't changed are reused without validation,
+        and the indexes are updated with the differences only (unless most
+        songs have changed).
+        """
+        data = json.loads(file.read_text())
+        adapter = pydantic.TypeAdapter(MetadataEntry)
+        songs = dict()
+        for item in data:
+            song = self._get_unchanged_song(item)
+            if song is None:
+                song = make_song(adapter.validate_python(item), file.parent)
+            songs[song.remote_id] = song
+
+        added = [s for id, s in songs.items() if s is not self.songs.get(id)]
+        removed = [s for id, s in self.songs.items() if s is not songs.get(id)]
+        changed = sum(1 for s in added if s.remote_id in self.songs)
+        diff = CatalogDiff(
+            added=len(added) - changed,
+            removed=len(removed) - changed,
+            changed=changed,
+            unchanged=len(songs) - len(added),
+        )
+        indexes = None
+        if len(added) + len(removed) < len(songs) // 4:
+            indexes = self.indexes.updated(removed=removed, added=added)
+        repository = InMemorySongRepository(
+            songs=songs, random=self.random, prebuilt_indexes=indexes
+        )
+        return repository, diff
+
+    def _get_unchanged_song(self, item: Any) -> Optional[Song]:
+        """Return the current song of a metadata entry, if it is unchanged."""
+        if not isinstance(item, dict) or not isinstance(item.get("path"), str):
+            return None
+        song = self.songs.get(_compute_remote_id(Path(item["path"])))
+        if song is None:
+            return None
+        for name, info in MetadataEntry.model_fields.items():
+            if name != "path" and item.get(name, info.default) != getattr(song, name):
+                return None
+        return song
+
     def get_file(self, song_id: str) -> bytes:
         return self.songs[song_id].absolute_path.read_bytes()
 
     def get_song_by_id(self, song_id: str) -> Optional[Song]:
         return self.songs.get(song_id)
+
+    def __len__(self) -> int:
+        return len(self.songs)
@@ -0,0 +1,150 @@
+"""Read and write large JSON arrays incrementally.
+
+The ratings are exported and imported as JSON arrays of played songs, which
+can be large: they are encoded, compressed and parsed a chunk at a time.
+"""
+
+from __future__ import annotations
+
+import codecs
+import json
+import re
+import zlib
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Iterator, Optional
+
+from pydantic import BaseModel
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+# the characters that may continue a number
+NUMBER_CHARS = frozenset("0123456789.eE+-")
+
+
+def iter_json_array(
+    elements: Iterable[BaseModel], chunk_size: int = 100
+) -> Iterator[bytes]:
+    """Encode `elements` as a JSON array, `chunk_size` elements at a time."""
+    yield b"["
+    chunk: list[str] = []
+    first = True
+    for element in elements:
+        chunk.append(element.model_dump_json())
+        if len(chunk) == chunk_size:
+            yield ((b"" if first else b",") + ",".join(chunk).encode())
+            chunk.clear()
+            first = False
+    if chunk:
+        yield ((b"" if first else b",") + ",".join(chunk).encode())
+    yield b"]"
+
+
+def iter_gzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # with a gzip header
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def iter_gunzip(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    decompressor = zlib.decompressobj(wbits=31)
+    try:
+        async for chunk in chunks:
+            decompressed = decompressor.decompress(chunk)
+            if decompressed:
+                yield decompressed
+        yield decompressor.flush()
+    except zlib.error as e:
+        raise ValueError(f"Invalid gzip data: {e}") from e
+    if not decompressor.eof:
+        raise ValueError("Truncated gzip data")
+
+
+class JSONArrayParser:
+    """Parse the elements of a JSON array, as its chunks arrive.
+
+    The array is either the whole document, or the value of `key` in an object
+    with this single key (like `{"songs": [...]}`). Only the current element
+    is kept in memory. Invalid documents raise a `ValueError`.
+    """
+
+    def __init__(self, chunks: AsyncIterable[bytes], key: Optional[str] = None):
+        self.chunks = chunks.__aiter__()
+        self.key = key
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    async def _fill(self) -> bool:
+        """Read the next chunk, and return False at the end of the document."""
+        if self.eof:
+            return False
+        try:
+            chunk = await self.chunks.__anext__()
+        except StopAsyncIteration:
+            self.eof = True
+            chunk = b""
+        self.text = self.text[self.pos :] + self.decoder.decode(chunk, final=self.eof)
+        self.pos = 0
+        return True
+
+    async def _peek(self) -> str:
+        """Skip the whitespace and return the next character ("" at the end)."""
+        while True:
+            self.pos = WHITESPACE.match(self.text, self.pos).end()  # type: ignore
+            if self.pos < len(self.text) or not await self._fill():
+                return self.text[self.pos : self.pos + 1]
+
+    async def _expect(self, char: str) -> None:
+        found = await self._peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r}, found {found or 'the end'!r}")
+        self.pos += 1
+
+    async def _decode(self) -> Any:
+        await self._peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.text, self.pos)
+                # a number may continue in the next chunk
+                if self.eof or (
+                    end < len(self.text) and self.text[end] not in NUMBER_CHARS
+                ):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            await self._fill()
+
+    async def _iter_array(self) -> AsyncIterator[Any]:
+        await self._expect("[")
+        if await self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield await self._decode()
+            if await self._peek() == ",":
+                self.pos += 1
+                continue
+            await self._expect("]")
+            return
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        if self.key is not None and await self._peek() == "{":
+            self.pos += 1
+            await self._peek()
+            key = await self._decode()
+            if key != self.key:
+                raise ValueError(f"Expected the key {self.key!r}, found {key!r}")
+            await self._expect(":")
+            async for element in self._iter_array():
+                yield element
+            await self._expect("}")
+        else:
+            async for element in self._iter_array():
+                yield element
+        if await self._peek():
+            raise ValueError("Unexpected data after the end of the document")
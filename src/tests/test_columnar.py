@@ -0,0 +1,169 @@
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from random import Random
+
+import pytest
+
+import columnar
+from columnar import (
+    ColumnarSongRepository,
+    SongColumns,
+    StringTableBuilder,
+    get_snapshot_file,
+    load_song_columns,
+)
+from ratings import InMemoryRatingRepository
+from songs import InMemorySongRepository
+
+
+@pytest.fixture
+def repository(testdata_dir: Path) -> ColumnarSongRepository:
+    return ColumnarSongRepository.from_file(
+        testdata_dir / "metadata.json", random=Random(1)
+    )
+
+
+def test_string_table() -> None:
+    builder = StringTableBuilder()
+    assert [builder.add(s) for s in ["abc", None, "dé", "abc", ""]] == [
+        0,
+        -1,
+        1,
+        0,
+        2,
+    ]
+    table = builder.build()
+    assert len(table) == 3
+    assert [table.get(i) for i in (0, -1, 1, 2)] == ["abc", None, "dé", ""]
+
+
+def test_loading_columnar_song_repository(
+    testdata_dir: Path, repository: ColumnarSongRepository
+) -> None:
+    songs = InMemorySongRepository.from_file(testdata_dir / "metadata.json").songs
+    assert len(repository.columns) == 3
+    for id, song in songs.items():
+        assert repository.get_song_by_id(id) == song
+    assert repository.get_song_by_id("0" * 32) is None
+    assert repository.get_song_by_id("unknown") is None
+
+
+def test_get_file(repository: ColumnarSongRepository) -> None:
+    assert repository.get_file("60634790d4629086cc180b012a2083c4") == b"content two"
+
+
+def test_get_random_song(
+    testdata_dir: Path, repository: ColumnarSongRepository
+) -> None:
+    ratings = InMemoryRatingRepository.from_file(testdata_dir / "ratings.json")
+    song = repository.get_random_song(ratings=ratings, min_duration=10)
+    assert song is not None and song.path == Path("abc/two")
+    song = repository.get_random_song(ratings=ratings, title_contains="G TH")
+    assert song is not None and song.path == Path("abc/three")
+    song = repository.get_random_song(ratings=ratings, game_title_contains="e o")
+    assert song is not None and song.path == Path("abc/one")
+    song = repository.get_random_song(ratings=ratings, only_has_no_rating=True)
+    assert song is not None and song.path == Path("abc/three")
+    got = {
+        song.path
+        for song in (
+            repository.get_random_song(ratings=ratings, only_has_rating=True)
+            for _ in range(20)
+        )
+        if song is not None
+    }
+    assert got == {Path("abc/one"), Path("abc/two")}
+    assert repository.get_random_song(ratings=ratings, title_contains="xyz") is None
+
+
+def test_get_random_songs__weighting(
+    testdata_dir: Path, repository: ColumnarSongRepository
+) -> None:
+    ratings = InMemoryRatingRepository.from_file(testdata_dir / "ratings.json")
+    songs = repository.get_random_songs(ratings=ratings, count=5, weighting="rating")
+    assert len({s.path for s in songs}) == 3
+    songs = repository.get_random_songs(
+        ratings=ratings, count=5, min_duration=2, weighting="last_played"
+    )
+    assert {s.path for s in songs} == {Path("abc/two"), Path("abc/three")}
+    songs = repository.get_random_songs(
+        ratings=ratings, count=5, title_contains="G TW", weighting="play_count"
+    )
+    assert [s.path for s in songs] == [Path("abc/two")]
+
+    # the keys are shared by the samplers of the users
+    keys = repository.sampler_keys
+    assert ratings.get_sampler("rating", keys).keys is keys
+    other = InMemoryRatingRepository(ratings={})
+    assert other.get_sampler("rating", keys).keys is keys
+    for rank in range(len(keys)):
+        assert keys.find(keys[rank]) == rank
+    assert keys.find("unknown") is None
+
+
+def test_snapshot(testdata_dir: Path, temp_directory: Path) -> None:
+    file = temp_directory / "metadata.json"
+    shutil.copy2(testdata_dir / "metadata.json", file)
+    snapshot_file = get_snapshot_file(file)
+
+    built = load_song_columns(file, snapshot=True)
+    assert snapshot_file.exists()
+    loaded = SongColumns.load_snapshot(snapshot_file, file)
+    assert loaded is not None
+    assert isinstance(loaded.durations, memoryview)
+    assert loaded.get_buffers() == built.get_buffers()
+    assert (
+        loaded.to_songs(testdata_dir)
+        == InMemorySongRepository.from_file(testdata_dir / "metadata.json").songs
+    )
+
+    # touched, but not modified
+    os.utime(file, ns=(0, 0))
+    assert SongColumns.load_snapshot(snapshot_file, file) is not None
+
+    # modified
+    data = json.loads(file.read_text())
+    file.write_text(json.dumps(data[:2]))
+    assert SongColumns.load_snapshot(snapshot_file, file) is None
+    assert len(load_song_columns(file, snapshot=True)) == 2
+    assert SongColumns.load_snapshot(snapshot_file, file) is not None
+
+
+def test_snapshot__invalid(testdata_dir: Path, temp_directory: Path) -> None:
+    file = temp_directory / "metadata.json"
+    shutil.copy2(testdata_dir / "metadata.json", file)
+    snapshot_file = get_snapshot_file(file)
+    assert SongColumns.load_snapshot(snapshot_file, file) is None
+    snapshot_file.write_bytes(b"")
+    assert SongColumns.load_snapshot(snapshot_file, file) is None
+    snapshot_file.write_bytes(b"VGSCAT\x00\x01" + b"\xff" * 100)
+    assert SongColumns.load_snapshot(snapshot_file, file) is None
+    assert len(load_song_columns(file, snapshot=True)) == 3
+
+
+def test_snapshot__built_once(
+    testdata_dir: Path, temp_directory: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    file = temp_directory / "metadata.json"
+    shutil.copy2(testdata_dir / "metadata.json", file)
+    builds = []
+    build = columnar.build_song_columns
+
+    def build_song_columns(file: Path, snapshot: bool = False) -> SongColumns:
+        builds.append(file)
+        time.sleep(0.1)
+        return build(file, snapshot=snapshot)
+
+    monkeypatch.setattr("columnar.build_song_columns", build_song_columns)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        loaded = list(
+            executor.map(lambda _: load_song_columns(file, snapshot=True), range(4))
+        )
+    assert builds == [file]
+    # all mapped from the snapshot, including the one that built it
+    assert all(isinstance(columns.paths, memoryview) for columns in loaded)
+    assert [p.name for p in temp_directory.iterdir() if p.suffix == ".tmp"] == []
@@ -0,0 +1,300 @@
+import base64
+import json
+import shutil
+from pathlib import Path
+from random import Random
+from typing import Any, Iterator
+
+import pytest
+from starlette.testclient import TestClient
+
+from app import app
+from configuration import AppConfiguration, AppSettings, get_app_configuration
+from database import (
+    Database,
+    SqliteRatingRepository,
+    SqliteRatingRepositoryCache,
+    SqliteSongRepository,
+    migrate_from_files,
+    search_text,
+)
+from ratings import InMemoryRatingRepository, Play, PlayedSong
+from sampling import SamplerKeys
+from songs import CatalogDiff, InMemorySongRepository
+from util import _compute_remote_id
+
+
+@pytest.fixture
+def database(testdata_dir: Path, temp_directory: Path) -> Database:
+    rating_dir = temp_directory / "ratings"
+    (rating_dir / "testuser").mkdir(parents=True)
+    shutil.copy2(testdata_dir / "ratings.json", rating_dir / "testuser")
+    database = Database(temp_directory / "vgsserver.db")
+    diff, users = migrate_from_files(
+        database, testdata_dir / "metadata.json", rating_dir
+    )
+    assert diff == CatalogDiff(added=3)
+    assert users == 1
+    return database
+
+
+@pytest.fixture
+def songs(database: Database, testdata_dir: Path) -> SqliteSongRepository:
+    return SqliteSongRepository.open(
+        database, testdata_dir / "metadata.json", random=Random(1)
+    )
+
+
+def test_migrate(
+    database: Database, songs: SqliteSongRepository, testdata_dir: Path
+) -> None:
+    expected = InMemorySongRepository.from_file(testdata_dir / "metadata.json").songs
+    assert len(songs) == 3
+    for id, song in expected.items():
+        assert songs.get_song_by_id(id) == song
+    assert songs.get_song_by_id("unknown") is None
+    assert songs.get_file("60634790d4629086cc180b012a2083c4") == b"content two"
+
+    json_ratings = InMemoryRatingRepository.from_file(testdata_dir / "ratings.json")
+    ratings = SqliteRatingRepository(database, "testuser")
+    assert ratings.get_played_songs() == json_ratings.get_played_songs()
+    assert ratings.get_aggregates() == json_ratings.aggregates
+    for id in expected:
+        assert ratings.get_rating(id) == json_ratings.get_rating(id)
+    assert SqliteRatingRepository(database, "other").get_played_songs() == []
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        dict(),
+        dict(min_duration=2),
+        dict(title_contains="G TH"),
+        dict(game_title_contains="e o"),
+        dict(title_contains="xyz"),
+        dict(min_rating=2),
+        dict(only_has_rating=True),
+        dict(only_has_no_rating=True),
+        dict(only_has_rating=True, min_rating=3, min_duration=2),
+    ],
+)
+def test_get_random_songs(
+    database: Database,
+    songs: SqliteSongRepository,
+    testdata_dir: Path,
+    filters: dict[str, Any],
+) -> None:
+    json_ratings = InMemoryRatingRepository.from_file(testdata_dir / "ratings.json")
+    expected = {
+        s.remote_id
+        for s in InMemorySongRepository.from_file(
+            testdata_dir / "metadata.json"
+        ).get_random_songs(ratings=json_ratings, count=10, **filters)
+    }
+    # with the rating filters in the query, or not
+    for ratings in (SqliteRatingRepository(database, "testuser"), json_ratings):
+        got = songs.get_random_songs(ratings=ratings, count=10, **filters)
+        assert {s.remote_id for s in got} == expected
+        assert len(got) == len(expected)
+    got = songs.get_random_songs(
+        ratings=json_ratings, count=10, excluded_ids=expected, **filters
+    )
+    assert got == []
+
+
+def test_get_random_songs__weighting(
+    database: Database, songs: SqliteSongRepository
+) -> None:
+    ratings = SqliteRatingRepository(database, "testuser")
+    got = songs.get_random_songs(ratings=ratings, count=5, weighting="rating")
+    assert len({s.path for s in got}) == 3
+    got = songs.get_random_songs(
+        ratings=ratings, count=5, min_duration=2, weighting="last_played"
+    )
+    assert {s.path for s in got} == {Path("abc/two"), Path("abc/three")}
+    got = songs.get_random_songs(
+        ratings=ratings, count=5, title_contains="G TW", weighting="play_count"
+    )
+    assert [s.path for s in got] == [Path("abc/two")]
+
+
+def test_update_from_file(
+    songs: SqliteSongRepository, testdata_dir: Path, temp_directory: Path
+) -> None:
+    data = json.loads((testdata_dir / "metadata.json").read_text())
+    data[0]["title"] = "new title"
+    del data[1]
+    data.append(dict(path="abc/four", timestamp=1, title="song four"))
+    file = temp_directory / "metadata.json"
+    file.write_text(json.dumps(data))
+    _, diff = songs.update_from_file(file)
+    assert diff == CatalogDiff(added=1, removed=1, changed=1, unchanged=1)
+    assert len(songs) == 3
+    assert songs.get_song_by_id(_compute_remote_id("abc/two")) is None
+    song = songs.get_song_by_id(_compute_remote_id("abc/one"))
+    assert song is not None and song.title == "new title"
+    got = songs.get_random_song(
+        ratings=SqliteRatingRepository(songs.database, "testuser"),
+        title_contains="FOUR",
+    )
+    assert got is not None and got.absolute_path == temp_directory / "abc/four"
+    # the index of the titles is up to date
+    connection = songs.database.connect()
+    for query, expected in [("song", 2), ("new title", 1), ("two", 0)]:
+        assert connection.execute(
+            "SELECT count(*) FROM songs_text WHERE songs_text MATCH ?", [query]
+        ).fetchone() == (expected,)
+
+
+def test_search_text(songs: SqliteSongRepository) -> None:
+    ratings = SqliteRatingRepository(songs.database, "testuser")
+    for needle, expected in [("ng t", 2), ("g", 3), ('"', 0), ("NG TWO", 1)]:
+        got = songs.get_random_songs(ratings=ratings, count=5, title_contains=needle)
+        assert len(got) == expected
+    condition, parameters = search_text("folded_title", "two")
+    plan = songs.database.connect().execute(
+        f"EXPLAIN QUERY PLAN SELECT s.id FROM songs s WHERE {condition}", parameters
+    )
+    assert any("songs_text" in row[-1] for row in plan)
+
+
+def test_ratings(database: Database) -> None:
+    ratings = SqliteRatingRepository(database, "testuser")
+    one = _compute_remote_id("abc/one")
+    three = _compute_remote_id("abc/three")
+    assert list(ratings.get_rated_song_ids()) == [one, _compute_remote_id("abc/two")]
+    assert ratings.get_rated_song_ids(min_rating=2) == {_compute_remote_id("abc/two")}
+    assert ratings.get_recently_played_song_ids(1) == {_compute_remote_id("abc/two")}
+
+    ratings.add_play(three, Path("abc/three"), timestamp=1000, rating=4)
+    ratings.add_play(three, Path("abc/three"), timestamp=1001, rating=0)
+    ratings.add_play(one, Path("abc/one"), timestamp=1002, rating=5)
+    assert ratings.get_rating(three) == 4.0
+    assert ratings.song_has_rating(three)
+    assert ratings.get_rating(one) == pytest.approx(8 / 3)
+    assert ratings.get_recently_played_song_ids(2) == {one, three}
+    assert ratings.get_rated_song_ids(min_rating=4) == {
+        three,
+        _compute_remote_id("abc/two"),
+    }
+    sampler = ratings.get_sampler("play_count", SamplerKeys([one, three]))
+    assert sampler.get_weight(three) == 1 / 3
+
+    count = ratings.merge(
+        [
+            PlayedSong(
+                path=Path("abc/one"),
+                plays=[Play(timestamp=123, rating=1), Play(timestamp=7, rating=1)],
+            ),
+            PlayedSong(path=Path("abc/four"), plays=[]),
+        ]
+    )
+    assert count == 1
+    played_songs = ratings.get_played_songs()
+    assert [s.path for s in played_songs] == [
+        Path("abc/one"),
+        Path("abc/two"),
+        Path("abc/three"),
+        Path("abc/four"),
+    ]
+    assert [p.timestamp for p in played_songs[0].plays] == [123, 456, 1002, 7]
+
+    ratings.replace(played_songs[1:2])
+    assert ratings.get_played_songs() == played_songs[1:2]
+    assert ratings.get_rating(one) is None
+    assert ratings.get_recently_played_song_ids(10) == {_compute_remote_id("abc/two")}
+
+
+def test_ratings__samplers(
+    database: Database, songs: SqliteSongRepository, testdata_dir: Path
+) -> None:
+    cache = SqliteRatingRepositoryCache(database, max_size=1)
+    ratings = cache.get("testuser")
+    assert cache.get("testuser") is ratings
+    keys = songs.get_sampler_keys(database.connect())
+    songs.update_from_file(testdata_dir / "metadata.json")
+    assert songs.get_sampler_keys(database.connect()) is keys
+
+    three = _compute_remote_id("abc/three")
+    sampler = ratings.get_sampler("play_count", keys)
+    assert sampler.get_weight(three) == 1
+    # updated by the plays of the repository
+    ratings.add_play(three, Path("abc/three"), timestamp=1000, rating=4)
+    assert ratings.get_sampler("play_count", keys) is sampler
+    assert sampler.get_weight(three) == 1 / 2
+    # built again after the plays of another process
+    SqliteRatingRepository(database, "testuser").add_play(
+        three, Path("abc/three"), timestamp=1001, rating=4
+    )
+    sampler = ratings.get_sampler("play_count", keys)
+    assert sampler.get_weight(three) == 1 / 3
+    assert ratings.get_sampler("play_count", keys) is sampler
+
+    cache.get("other")
+    assert len(cache) == 1
+    assert cache.get("testuser") is not ratings
+
+
+@pytest.fixture
+def client(testdata_dir: Path, temp_directory: Path) -> Iterator[TestClient]:
+    configuration = AppConfiguration(
+        settings=AppSettings(
+            METADATA_PATH=testdata_dir / "metadata.json",
+            RATING_DIR_PATH=temp_directory / "ratings",
+            USER_PATH=testdata_dir / "users.json",
+            SONG_REPOSITORY="sqlite",
+            RATING_STORAGE="sqlite",
+            DATABASE_PATH=temp_directory / "vgsserver.db",
+        ),
+        random_seed=1,
+    )
+    app.dependency_overrides[get_app_configuration] = lambda: configuration
+    yield TestClient(app)
+    app.dependency_overrides = {}
+
+
+def test_endpoints(client: TestClient) -> None:
+    headers = {
+        "Authorization": "Basic " + base64.b64encode(b"testuser:password").decode()
+    }
+    res = client.get("/api/songs/random/?min_duration=10", headers=headers)
+    assert res.status_code == 200
+    assert res.json()["path"] == "abc/two"
+
+    data = [dict(path="abc/one", plays=[dict(timestamp=1, rating=2)])]
+    res = client.post("/api/ratings/import/", headers=headers, json=data)
+    assert res.status_code == 200
+    res = client.post(
+        "/api/songs/c976b99015ab6d1fac09679b992d78d0/play/",
+        headers=headers,
+        json=dict(timestamp=2, rating=5),
+    )
+    assert res.status_code == 200
+    assert res.json() == dict(rating=3.5)
+
+    batch = [
+        dict(song_id="c976b99015ab6d1fac09679b992d78d0", timestamp=2, rating=5),
+        dict(song_id="c976b99015ab6d1fac09679b992d78d0", timestamp=3, rating=5),
+    ]
+    res = client.post("/api/plays/batch/", headers=headers, json=batch)
+    assert res.status_code == 200
+    assert [r["status"] for r in res.json()["results"]] == ["duplicate", "added"]
+    assert res.json()["ratings"] == {"c976b99015ab6d1fac09679b992d78d0": 4.0}
+    res = client.post("/api/plays/batch/", headers=headers, json=batch)
+    assert [r["status"] for r in res.json()["results"]] == ["duplicate", "duplicate"]
+
+    res = client.get("/api/ratings/export/", headers=headers)
+    assert res.status_code == 200
+    assert res.json() == [
+        dict(
+            path="abc/one",
+            plays=[
+                dict(timestamp=1, rating=2),
+                dict(timestamp=2, rating=5),
+                dict(timestamp=3, rating=5),
+            ],
+        )
+    ]
+    res = client.get("/api/songs/random/?only_has_rating=true", headers=headers)
+    assert res.status_code == 200
+    assert res.json()["path"] == "abc/one"
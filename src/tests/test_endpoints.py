@@ -1,6 +1,11 @@
+import asyncio
 import base64
+import gzip
 import json
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Iterator
 
@@ -9,7 +14,8 @@ from starlette.testclient import TestClient
 
 from app import app
 from configuration import AppConfiguration, AppSettings, get_app_configuration
-from ratings import InMemoryRatingRepository
+from rating_columns import RatingColumns
+from ratings import InMemoryRatingRepository, convert_ratings_file
 
 
 @pytest.fixture
@@ -63,16 +69,52 @@ def test_get_random_song(client: TestClient, authorization_header: str) -> None:
     )
     assert res.status_code == 200
     assert res.json() == dict(
-        id="60634790d4629086cc180b012a2083c4",
-        title="song two",
-        game_title="game two",
-        loop_start=13,
+        id="c976b99015ab6d1fac09679b992d78d0",
+        title="song one",
+        game_title="game one",
+        loop_start=12,
         loop_end=0,
-        path="abc/two",
-        duration=21.2,
+        path="abc/one",
+        duration=1.2,
     )
 
 
+def test_get_playlist(client: TestClient, authorization_header: str) -> None:
+    res = client.get(
+        "/api/songs/playlist/?count=10",
+        headers={"Authorization": authorization_header},
+    )
+    assert res.status_code == 200
+    assert sorted(s["path"] for s in res.json()) == ["abc/one", "abc/three", "abc/two"]
+
+    # the last play is the one of "abc/two"
+    res = client.get(
+        "/api/songs/playlist/?count=10&no_repeat_window=1&min_duration=2",
+        headers={"Authorization": authorization_header},
+    )
+    assert res.status_code == 200
+    assert [s["path"] for s in res.json()] == ["abc/three"]
+
+    res = client.get(
+        "/api/songs/playlist/?count=10&weighting=rating",
+        headers={"Authorization": authorization_header},
+    )
+    assert res.status_code == 200
+    assert len(res.json()) == 3
+
+    res = client.get(
+        "/api/songs/playlist/?weighting=unknown",
+        headers={"Authorization": authorization_header},
+    )
+    assert res.status_code == 422
+
+    res = client.get(
+        "/api/songs/playlist/?count=0",
+        headers={"Authorization": authorization_header},
+    )
+    assert res.status_code == 422
+
+
 def test_get_song_file__not_authenticated(client: TestClient) -> None:
     res = client.get("/api/songs/60634790d4629086cc180b012a2083c4/file/")
     assert res.status_code == 401
@@ -86,6 +128,96 @@ def test_get_song_file(client: TestClient, authorization_header: str) -> None:
     )
     assert res.status_code == 200
     assert res.content == b"content two"
+    assert res.headers["etag"] == '"de-1c8"'
+    assert res.headers["last-modified"] == "Thu, 01 Jan 1970 00:07:36 GMT"
+
+
+def test_get_song_file__unknown_song(
+    client: TestClient, authorization_header: str
+) -> None:
+    res = client.get(
+        "/api/songs/unknown/file/", headers={"Authorization": authorization_header}
+    )
+    assert res.status_code == 404
+
+
+def test_get_song_file__range(client: TestClient, authorization_header: str) -> None:
+    res = client.get(
+        "/api/songs/60634790d4629086cc180b012a2083c4/file/",
+        headers={"Authorization": authorization_header, "Range": "bytes=8-"},
+    )
+    assert res.status_code == 206
+    assert res.content == b"two"
+    assert res.headers["content-range"] == "bytes 8-10/11"
+
+    res = client.get(
+        "/api/songs/60634790d4629086cc180b012a2083c4/file/",
+        headers={
+            "Authorization": authorization_header,
+            "Range": "bytes=8-",
+            "If-Range": '"outdated"',
+        },
+    )
+    assert res.status_code == 200
+    assert res.content == b"content two"
+
+
+@pytest.mark.parametrize(
+    "headers,exp",
+    [
+        [{"If-None-Match": '"de-1c8"'}, 304],
+        [{"If-None-Match": 'W/"abc", "de-1c8"'}, 304],
+        [{"If-None-Match": '"abc"'}, 200],
+        [{"If-Modified-Since": "Thu, 01 Jan 1970 00:07:36 GMT"}, 304],
+        [{"If-Modified-Since": "Thu, 01 Jan 1970 00:07:35 GMT"}, 200],
+        [{"If-Modified-Since": "invalid"}, 200],
+    ],
+)
+def test_get_song_file__not_modified(
+    client: TestClient, authorization_header: str, headers: dict[str, str], exp: int
+) -> None:
+    res = client.get(
+        "/api/songs/60634790d4629086cc180b012a2083c4/file/",
+        headers={"Authorization": authorization_header, **headers},
+    )
+    assert res.status_code == exp
+
+
+def test_get_song_file__cache(
+    client_with_configuration: tuple[AppConfiguration, TestClient],
+    authorization_header: str,
+) -> None:
+    configuration, client = client_with_configuration
+    configuration.settings.SONG_FILE_CACHE_BYTES = 1024
+    for _ in range(2):
+        res = client.get(
+            "/api/songs/60634790d4629086cc180b012a2083c4/file/",
+            headers={"Authorization": authorization_header},
+        )
+        assert res.status_code == 200
+        assert res.content == b"content two"
+        assert res.headers["etag"] == '"de-1c8"'
+    cache = configuration.song_file_cache
+    assert cache is not None
+    assert (cache.hits, cache.misses, cache.bytes_saved) == (1, 1, 11)
+    # served from disk
+    res = client.get(
+        "/api/songs/60634790d4629086cc180b012a2083c4/file/",
+        headers={"Authorization": authorization_header, "Range": "bytes=8-"},
+    )
+    assert res.status_code == 206
+    assert res.content == b"two"
+    assert cache.hits == 1
+
+    # too large to be cached: streamed from disk
+    cache.max_file_bytes = 10
+    res = client.get(
+        "/api/songs/60634790d4629086cc180b012a2083c4/file/",
+        headers={"Authorization": authorization_header},
+    )
+    assert res.status_code == 200
+    assert res.content == b"content two"
+    assert (cache.hits, cache.misses) == (1, 1)
 
 
 def test_add_play__not_authenticated(client: TestClient) -> None:
@@ -125,6 +257,61 @@ def test_add_play(
     )
 
 
+def test_add_play__binary_format(
+    test_configuration: AppConfiguration, authorization_header: str
+) -> None:
+    test_configuration.settings.RATING_FORMAT = "binary"
+    rating_dir = test_configuration.settings.RATING_DIR_PATH
+    convert_ratings_file(
+        rating_dir / "testuser" / "ratings.json",
+        rating_dir / "testuser" / "ratings.bin",
+        "binary",
+    )
+    app.dependency_overrides[get_app_configuration] = lambda: test_configuration
+    try:
+        client = TestClient(app)
+        res = client.post(
+            "/api/songs/60634790d4629086cc180b012a2083c4/play/",
+            headers={"Authorization": authorization_header},
+            json=dict(timestamp=123, rating=2),
+        )
+        assert res.status_code == 200
+        assert res.json() == {"rating": 11 / 3}
+        path = test_configuration.get_ratings_path_for_user("testuser")
+        assert path.name == "ratings.bin"
+        assert RatingColumns.is_binary(path.read_bytes())
+        res = client.get(
+            "/api/ratings/export/", headers={"Authorization": authorization_header}
+        )
+        assert [len(s["plays"]) for s in res.json()] == [2, 3, 0]
+    finally:
+        app.dependency_overrides = {}
+
+
+def test_add_play__concurrent(
+    client_with_configuration: tuple[AppConfiguration, TestClient],
+    authorization_header: str,
+) -> None:
+    conf, client = client_with_configuration
+
+    def add_play(n: int) -> None:
+        res = client.post(
+            "/api/songs/60634790d4629086cc180b012a2083c4/play/",
+            headers={"Authorization": authorization_header},
+            json=dict(timestamp=n, rating=5),
+        )
+        assert res.status_code == 200
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(add_play, range(200)))
+
+    new_ratings = InMemoryRatingRepository.from_file(
+        conf.settings.RATING_DIR_PATH / "testuser" / "ratings.json"
+    )
+    played_song = new_ratings.ratings["60634790d4629086cc180b012a2083c4"]
+    assert len(played_song.plays) == 2 + 200
+
+
 def test_add_play__invalid_rating(
     client: TestClient,
     authorization_header: str,
@@ -209,3 +396,379 @@ def test_import_ratings(
     assert res.status_code == 200
     got = json.load(configuration.get_ratings_path_for_user("testuser").open())
     assert got == data
+
+
+def test_export_ratings__gzip(client: TestClient, authorization_header: str) -> None:
+    res = client.get(
+        "/api/ratings/export/?gzip=true",
+        headers={"Authorization": authorization_header},
+    )
+    assert res.status_code == 200
+    assert res.headers["content-encoding"] == "gzip"
+    assert [s["path"] for s in res.json()] == ["abc/one", "abc/two", "abc/three"]
+
+
+def test_import_ratings__array(
+    client_with_configuration: tuple[AppConfiguration, TestClient],
+    authorization_header: str,
+) -> None:
+    data = [
+        dict(path="def/hello", plays=[dict(timestamp=987, rating=3)]),
+        dict(path="ghi/bye", plays=[]),
+    ]
+    configuration, client = client_with_configuration
+    path = configuration.get_ratings_path_for_user("testuser")
+    original = path.read_text()
+    res = client.post(
+        "/api/ratings/import/",
+        headers={"Authorization": authorization_header, "Content-Encoding": "gzip"},
+        content=gzip.compress(json.dumps(data).encode()),
+    )
+    assert res.status_code == 200
+    assert res.json() == dict(songs=2, plays=1)
+    assert json.loads(path.read_text()) == data
+    assert Path(str(path) + ".bak1").read_text() == original
+    assert sorted(p.name for p in path.parent.iterdir()) == [
+        "ratings.json",
+        "ratings.json.bak1",
+    ]
+
+
+def test_import_ratings__binary_format(
+    client_with_configuration: tuple[AppConfiguration, TestClient],
+    authorization_header: str,
+) -> None:
+    data = [
+        dict(path="def/hello", plays=[dict(timestamp=987, rating=3)]),
+        dict(path="ghi/bye", plays=[]),
+    ]
+    configuration, client = client_with_configuration
+    configuration.settings.RATING_FORMAT = "binary"
+    headers = {"Authorization": authorization_header}
+    res = client.post("/api/ratings/import/", headers=headers, json=data)
+    assert res.status_code == 200
+    assert res.json() == dict(songs=2, plays=1)
+    path = configuration.get_ratings_path_for_user("testuser")
+    assert RatingColumns.is_binary(path.read_bytes())
+    assert client.get("/api/ratings/export/", headers=headers).json() == data
+
+    res = client.post(
+        "/api/ratings/import/?mode=merge",
+        headers=headers,
+        json=[dict(path="ghi/bye", plays=[dict(timestamp=1, rating=5)])],
+    )
+    assert res.json() == dict(songs=1, plays=1)
+    assert RatingColumns.is_binary(path.read_bytes())
+    ratings = InMemoryRatingRepository.from_file(path)
+    assert [len(s.plays) for s in ratings.get_played_songs()] == [1, 1]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [b"[", b'[{"path": "a", "plays": [{"timestamp": 1, "rating": 9}]}]', b"{}"],
+)
+def test_import_ratings__invalid(
+    client_with_configuration: tuple[AppConfiguration, TestClient],
+    authorization_header: str,
+    body: bytes,
+) -> None:
+    configuration, client = client_with_configuration
+    path = configuration.get_ratings_path_for_user("testuser")
+    original = path.read_text()
+    for mode in ("replace", "merge"):
+        res = client.post(
+            f"/api/ratings/import/?mode={mode}",
+            headers={"Authorization": authorization_header},
+            content=body,
+        )
+        assert res.status_code == 422
+    assert path.read_text() == original
+    assert [p.name for p in path.parent.iterdir()] == ["ratings.json"]
+
+
+def test_import_ratings__merge(
+    client_with_configuration: tuple[AppConfiguration, TestClient],
+    authorization_header: str,
+) -> None:
+    data = [
+        dict(
+            path="abc/one",
+            plays=[dict(timestamp=456, rating=2), dict(timestamp=789, rating=5)],
+        ),
+        dict(path="def/hello", plays=[dict(timestamp=1, rating=3)] * 2),
+    ]
+    configuration, client = client_with_configuration
+    headers = {"Authorization": authorization_header}
+    res = client.get("/api/ratings/export/", headers=headers)
+    assert res.status_code == 200
+    exported = res.json()
+
+    for _ in range(2):
+        res = client.post(
+            "/api/ratings/import/?mode=merge", headers=headers, json=exported
+        )
+        assert res.status_code == 200
+        assert res.json() == dict(songs=3, plays=0)
+
+    res = client.post("/api/ratings/import/?mode=merge", headers=headers, json=data)
+    assert res.status_code == 200
+    assert res.json() == dict(songs=2, plays=2)
+    res = client.get("/api/ratings/export/", headers=headers)
+    assert res.json() == [
+        dict(
+            path="abc/one",
+            plays=[
+                dict(timestamp=123, rating=1),
+                dict(timestamp=456, rating=2),
+                dict(timestamp=789, rating=5),
+            ],
+        ),
+        exported[1],
+        exported[2],
+        dict(path="def/hello", plays=[dict(timestamp=1, rating=3)]),
+    ]
+    path = configuration.get_ratings_path_for_user("testuser")
+    assert json.loads(path.read_text()) == res.json()
+
+
+def test_add_plays__batch(
+    client_with_configuration: tuple[AppConfiguration, TestClient],
+    authorization_header: str,
+) -> None:
+    configuration, client = client_with_configuration
+    one, two = "c976b99015ab6d1fac09679b992d78d0", "60634790d4629086cc180b012a2083c4"
+    data = [
+        dict(song_id=two, timestamp=1000, rating=3),
+        dict(song_id="unknown", timestamp=1000, rating=3),
+        dict(song_id=one, timestamp=123, rating=5),
+        dict(song_id=one, timestamp=1001, rating=5),
+        dict(song_id=two, timestamp=1000, rating=3),
+    ]
+    res = client.post(
+        "/api/plays/batch/", headers={"Authorization": authorization_header}, json=data
+    )
+    assert res.status_code == 200
+    assert [r["status"] for r in res.json()["results"]] == [
+        "added",
+        "unknown_song",
+        "duplicate",
+        "added",
+        "duplicate",
+    ]
+    assert res.json()["ratings"] == {one: 8 / 3, two: 4.0}
+    assert configuration.rating_cache.saves == 1
+    path = configuration.get_ratings_path_for_user("testuser")
+    assert [len(s["plays"]) for s in json.loads(path.read_text())] == [3, 3, 0]
+
+    # sent again
+    res = client.post(
+        "/api/plays/batch/", headers={"Authorization": authorization_header}, json=data
+    )
+    assert res.status_code == 200
+    assert [r["status"] for r in res.json()["results"]] == [
+        "duplicate",
+        "unknown_song",
+        "duplicate",
+        "duplicate",
+        "duplicate",
+    ]
+    assert res.json()["ratings"] == {one: 8 / 3, two: 4.0}
+    assert configuration.rating_cache.saves == 1
+
+    res = client.post(
+        "/api/plays/batch/",
+        headers={"Authorization": authorization_header},
+        json=[dict(song_id=one, timestamp=1, rating=6)],
+    )
+    assert res.status_code == 422
+
+
+def test_add_play__write_behind(
+    test_configuration: AppConfiguration, authorization_header: str
+) -> None:
+    test_configuration.settings.RATING_WRITE_BEHIND_DELAY = 60
+    app.dependency_overrides[get_app_configuration] = lambda: test_configuration
+    path = test_configuration.get_ratings_path_for_user("testuser")
+    try:
+        with TestClient(app) as client:
+            res = client.post(
+                "/api/songs/c976b99015ab6d1fac09679b992d78d0/play/",
+                headers={"Authorization": authorization_header},
+                json=dict(timestamp=1, rating=5),
+            )
+            assert res.status_code == 200
+            assert len(json.loads(path.read_text())[0]["plays"]) == 2
+        # saved when the application shuts down
+        assert len(json.loads(path.read_text())[0]["plays"]) == 3
+    finally:
+        app.dependency_overrides = {}
+
+
+def test_health_ready(test_configuration: AppConfiguration) -> None:
+    test_configuration.settings.WARM_UP_RATINGS = 5
+    app.dependency_overrides[get_app_configuration] = lambda: test_configuration
+    try:
+        res = TestClient(app).get("/health/ready")
+        assert res.status_code == 503
+        assert res.json()["status"] == "pending"
+        # the lifespan runs with the context manager
+        with TestClient(app) as client:
+            assert test_configuration._songs is not None
+            assert test_configuration._users is not None
+            assert len(test_configuration.rating_cache) == 1
+            res = client.get("/health/ready")
+            assert res.status_code == 200
+            assert res.json()["status"] == "ready"
+            assert set(res.json()["timings"]) == {
+                "catalog",
+                "users",
+                "ratings",
+                "total",
+            }
+    finally:
+        app.dependency_overrides = {}
+
+
+@pytest.mark.parametrize("warm_up", ["startup", "background"])
+def test_health_ready__failed(
+    test_configuration: AppConfiguration, temp_directory: Path, warm_up: str
+) -> None:
+    test_configuration.settings.WARM_UP = warm_up  # type: ignore[assignment]
+    test_configuration.settings.METADATA_PATH = temp_directory / "missing.json"
+    app.dependency_overrides[get_app_configuration] = lambda: test_configuration
+    try:
+        with TestClient(app) as client:
+            while test_configuration.warm_up_state.status == "loading":
+                time.sleep(0.01)
+            res = client.get("/health/ready")
+            assert res.status_code == 503
+            assert res.json()["status"] == "failed"
+            assert list(res.json()["errors"]) == ["catalog"]
+    finally:
+        app.dependency_overrides = {}
+
+
+def test_health_ready__ratings_error(test_configuration: AppConfiguration) -> None:
+    test_configuration.settings.WARM_UP_RATINGS = 5
+    file = test_configuration.settings.RATING_DIR_PATH / "broken" / "ratings.json"
+    file.parent.mkdir()
+    file.write_text("{")
+    app.dependency_overrides[get_app_configuration] = lambda: test_configuration
+    try:
+        # the ratings of a user are best-effort
+        with TestClient(app) as client:
+            res = client.get("/health/ready")
+            assert res.status_code == 200
+            assert res.json()["status"] == "ready"
+            assert list(res.json()["errors"]) == ["ratings:broken"]
+            assert len(test_configuration.rating_cache) == 1
+    finally:
+        app.dependency_overrides = {}
+
+
+def test_warm_up__off_the_event_loop(
+    test_configuration: AppConfiguration, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    test_configuration.settings.WARM_UP_RATINGS = 5
+    get_recent_usernames = test_configuration.get_recent_usernames
+    threads = []
+
+    def recording_get_recent_usernames(count: int) -> list[str]:
+        threads.append(threading.current_thread())
+        return get_recent_usernames(count)
+
+    monkeypatch.setattr(
+        test_configuration, "get_recent_usernames", recording_get_recent_usernames
+    )
+    asyncio.run(test_configuration.warm_up())
+    assert test_configuration.warm_up_state.status == "ready"
+    assert threads and threading.main_thread() not in threads
+    assert len(test_configuration.rating_cache) == 1
+
+
+def test_reload_catalog(
+    client_with_configuration: tuple[AppConfiguration, TestClient],
+    authorization_header: str,
+    temp_directory: Path,
+) -> None:
+    configuration, client = client_with_configuration
+    file = temp_directory / "metadata.json"
+    shutil.copy2(configuration.settings.METADATA_PATH, file)
+    configuration.settings.METADATA_PATH = file
+    songs = configuration.songs
+
+    data = json.loads(file.read_text())
+    data[0]["title"] = "new title"
+    file.write_text(json.dumps(data[:2]))
+    res = client.post(
+        "/api/catalog/reload/", headers={"Authorization": authorization_header}
+    )
+    assert res.status_code == 403
+    assert configuration.songs is songs
+
+    configuration.settings.ADMIN_USERS = ["testuser"]
+    res = client.post(
+        "/api/catalog/reload/", headers={"Authorization": authorization_header}
+    )
+    assert res.status_code == 200
+    assert res.json() == dict(added=0, removed=1, changed=1, unchanged=1)
+    assert configuration.songs is not songs
+    song = configuration.songs.get_song_by_id("c976b99015ab6d1fac09679b992d78d0")
+    assert song is not None and song.title == "new title"
+
+    file.write_text("invalid")
+    res = client.post(
+        "/api/catalog/reload/", headers={"Authorization": authorization_header}
+    )
+    assert res.status_code == 500
+
+
+def test_reload_catalog__polling(
+    test_configuration: AppConfiguration, temp_directory: Path
+) -> None:
+    file = temp_directory / "metadata.json"
+    shutil.copy2(test_configuration.settings.METADATA_PATH, file)
+    test_configuration.settings.METADATA_PATH = file
+    test_configuration.settings.METADATA_RELOAD_INTERVAL = 0.01
+    songs = test_configuration.songs
+    assert test_configuration.songs is songs
+
+    file.write_text(json.dumps(json.loads(file.read_text())[:1]))
+    for _ in range(100):
+        time.sleep(0.02)
+        if test_configuration.songs is not songs:
+            break
+    assert (
+        test_configuration.songs.get_song_by_id("60634790d4629086cc180b012a2083c4")
+        is None
+    )
+
+
+def test_reload_catalog__polling_error(
+    test_configuration: AppConfiguration,
+    temp_directory: Path,
+    caplog: pytest.LogCaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    file = temp_directory / "metadata.json"
+    shutil.copy2(test_configuration.settings.METADATA_PATH, file)
+    test_configuration.settings.METADATA_PATH = file
+    test_configuration.settings.METADATA_RELOAD_INTERVAL = 0.01
+    songs = test_configuration.songs
+
+    file.write_text("invalid")
+    for _ in range(100):
+        time.sleep(0.02)
+        test_configuration.songs
+        if "Can't reload the catalog" in caplog.text:
+            break
+    assert "Can't reload the catalog" in caplog.text
+    assert test_configuration.songs is songs
+    # the same file is not loaded again
+    reloads = []
+    monkeypatch.setattr(
+        test_configuration, "_reload_songs_in_background", lambda: reloads.append(1)
+    )
+    time.sleep(0.02)
+    test_configuration.songs
+    assert reloads == []
@@ -0,0 +1,148 @@
+import base64
+import shutil
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from starlette.testclient import TestClient
+
+from app import app
+from configuration import AppConfiguration, AppSettings, get_app_configuration
+from metrics import Metrics, metrics
+
+
+def test_metrics_render() -> None:
+    registry = Metrics(enabled=True)
+    registry.inc("requests_total", route="/a")
+    registry.inc("requests_total", 2, route="/a")
+    with registry.time("duration_seconds", stage='say "hi"'):
+        pass
+    registry.observe("duration_seconds", 20.0, (("stage", 'say "hi"'),))
+    got = registry.render([("songs", "gauge", "Number of songs.", {}, 0.5)])
+    lines = got.splitlines()
+    assert lines[:5] == [
+        "# HELP requests_total requests_total",
+        "# TYPE requests_total counter",
+        'requests_total{route="/a"} 3',
+        "# HELP duration_seconds duration_seconds",
+        "# TYPE duration_seconds histogram",
+    ]
+    assert 'duration_seconds_bucket{stage="say \\"hi\\"",le="0.0005"} 1' in lines
+    assert 'duration_seconds_bucket{stage="say \\"hi\\"",le="10"} 1' in lines
+    assert 'duration_seconds_bucket{stage="say \\"hi\\"",le="+Inf"} 2' in lines
+    assert 'duration_seconds_count{stage="say \\"hi\\""} 2' in lines
+    assert lines[-3:] == [
+        "# HELP songs Number of songs.",
+        "# TYPE songs gauge",
+        "songs 0.5",
+    ]
+
+
+def test_metrics_disabled() -> None:
+    registry = Metrics()
+    registry.inc("requests_total")
+    with registry.time("duration_seconds"):
+        pass
+    assert registry.render() == "\n"
+
+
+def make_client(testdata_dir: Path, temp_directory: Path, enabled: bool) -> TestClient:
+    rating_dir = temp_directory / "ratings"
+    (rating_dir / "testuser").mkdir(parents=True)
+    shutil.copy2(testdata_dir / "ratings.json", rating_dir / "testuser")
+    configuration = AppConfiguration(
+        settings=AppSettings(
+            METADATA_PATH=testdata_dir / "metadata.json",
+            RATING_DIR_PATH=rating_dir,
+            USER_PATH=testdata_dir / "users.json",
+            METRICS=enabled,
+        ),
+        random_seed=1,
+    )
+    app.dependency_overrides[get_app_configuration] = lambda: configuration
+    return TestClient(app)
+
+
+@pytest.fixture
+def client_with_metrics(
+    testdata_dir: Path, temp_directory: Path
+) -> Iterator[TestClient]:
+    yield make_client(testdata_dir, temp_directory, enabled=True)
+    app.dependency_overrides = {}
+    metrics.enabled = False
+    metrics.clear()
+
+
+def test_metrics_endpoint(client_with_metrics: TestClient) -> None:
+    client = client_with_metrics
+    headers = {
+        "Authorization": "Basic " + base64.b64encode(b"testuser:password").decode()
+    }
+    assert client.get("/api/songs/random/", headers=headers).status_code == 200
+    res = client.get(
+        "/api/songs/60634790d4629086cc180b012a2083c4/file/", headers=headers
+    )
+    assert res.status_code == 200
+    res = client.post(
+        "/api/songs/60634790d4629086cc180b012a2083c4/play/",
+        headers=headers,
+        json=dict(timestamp=1, rating=5),
+    )
+    assert res.status_code == 200
+
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain")
+    lines = res.text.splitlines()
+    for stage, count in [
+        ("authentication", 3),
+        ("catalog_load", 1),
+        ("ratings_load", 1),
+        ("random_song", 1),
+        ("serialization", 2),
+        ("file", 1),
+        ("save", 1),
+    ]:
+        assert f'vgsserver_stage_seconds_count{{stage="{stage}"}} {count}' in lines
+    assert (
+        'vgsserver_request_seconds_count{method="GET",'
+        'route="/songs/random/",status="200"} 1'
+    ) in lines
+    assert "vgsserver_file_bytes_served_total 11" in lines
+    assert "vgsserver_catalog_songs 3" in lines
+    assert "vgsserver_rating_repositories_loaded 1" in lines
+    assert 'vgsserver_rating_cache_requests_total{result="miss"} 1' in lines
+    assert 'vgsserver_rating_cache_requests_total{result="hit"} 1' in lines
+    assert "vgsserver_rating_saves_total 1" in lines
+    assert 'vgsserver_credential_cache_requests_total{result="hit"} 2' in lines
+
+
+def test_metrics_endpoint__disabled(testdata_dir: Path, temp_directory: Path) -> None:
+    client = make_client(testdata_dir, temp_directory, enabled=False)
+    assert client.get("/metrics").status_code == 404
+    app.dependency_overrides = {}
+
+
+def test_metric_samples__sqlite(testdata_dir: Path, temp_directory: Path) -> None:
+    configuration = AppConfiguration(
+        settings=AppSettings(
+            METADATA_PATH=testdata_dir / "metadata.json",
+            RATING_DIR_PATH=temp_directory / "ratings",
+            USER_PATH=testdata_dir / "users.json",
+            RATING_STORAGE="sqlite",
+            DATABASE_PATH=temp_directory / "vgsserver.db",
+        ),
+    )
+    configuration.get_ratings_for_user("testuser")
+    configuration.get_ratings_for_user("testuser")
+    samples = {
+        (name, tuple(labels.items())): value
+        for name, _, _, labels, value in configuration.get_metric_samples()
+    }
+    assert samples[("vgsserver_rating_repositories_loaded", ())] == 1
+    assert samples[("vgsserver_rating_cache_requests_total", (("result", "hit"),))] == 1
+    assert (
+        samples[("vgsserver_rating_cache_requests_total", (("result", "miss"),))] == 1
+    )
+    assert ("vgsserver_rating_saves_total", ()) not in samples
+    assert "rating_cache" not in configuration.__dict__
@@ -1,9 +1,27 @@
+import json
 import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from random import Random
+from typing import Optional
 
 import pytest
 
-from ratings import InMemoryRatingRepository, Play, PlayedSong
+from rating_columns import RatingColumns
+from ratings import (
+    InMemoryRatingRepository,
+    Play,
+    PlayedSong,
+    PlayLogOptions,
+    RatingRepositoryCache,
+    RatingSave,
+    WriteBehindOptions,
+    convert_ratings_file,
+)
+from sampling import SamplerKeys
 from util import _compute_remote_id
 
 
@@ -32,6 +50,76 @@ def test_loading_ratings(testdata_dir: Path) -> None:
     }
 
 
+def test_rating_aggregates(testdata_dir: Path) -> None:
+    repository = InMemoryRatingRepository.from_file(testdata_dir / "ratings.json")
+    # in the order of the file, whatever the hash seed
+    assert list(repository.get_rated_song_ids()) == [
+        _compute_remote_id("abc/one"),
+        _compute_remote_id("abc/two"),
+    ]
+    random = Random(1)
+    song_paths = [Path(f"abc/{n}") for n in ("one", "two", "three", "four")]
+    for timestamp in range(200):
+        song_path = random.choice(song_paths)
+        repository.add_play(
+            song_id=_compute_remote_id(song_path),
+            song_path=song_path,
+            timestamp=timestamp,
+            rating=random.choice([0, 0, 1, 2, 3, 4, 5]),
+        )
+
+    for id, played_song in repository.ratings.items():
+        assert repository.get_rating(id) == played_song.rating
+        assert repository.song_has_rating(id) == (played_song.rating is not None)
+    for min_rating in (None, 0, 1, 2, 3, 4, 5, 6):
+        assert set(repository.get_rated_song_ids(min_rating)) == {
+            id
+            for id, s in repository.ratings.items()
+            if s.rating is not None and (min_rating is None or s.rating >= min_rating)
+        }
+
+
+def test_get_sampler(testdata_dir: Path) -> None:
+    repository = InMemoryRatingRepository.from_file(testdata_dir / "ratings.json")
+    ids = [_compute_remote_id(f"abc/{n}") for n in ("one", "two", "three", "four")]
+    keys = SamplerKeys(ids)
+    sampler = repository.get_sampler("play_count", keys)
+    assert [sampler.get_weight(k) for k in ids] == [1 / 3, 1 / 3, 1, 1]
+    ratings = repository.get_sampler("rating", keys)
+    assert [ratings.get_weight(k) for k in ids] == [1.5, 4.5, 3, 3]
+    last_played = repository.get_sampler("last_played", keys)
+    assert [last_played.get_weight(k, now=1000) for k in ids] == [544, 211, 1000, 1000]
+
+    repository.add_play(
+        song_id=ids[2], song_path=Path("abc/three"), timestamp=900, rating=5
+    )
+    assert sampler.get_weight(ids[2]) == 1 / 2
+    assert ratings.get_weight(ids[2]) == 5
+    assert last_played.get_weight(ids[2], now=1000) == 100
+    assert repository.get_sampler("play_count", keys) is sampler
+    # the catalog was reloaded
+    assert repository.get_sampler("play_count", SamplerKeys(ids)) is not sampler
+
+
+def test_get_recently_played_song_ids(testdata_dir: Path) -> None:
+    repository = InMemoryRatingRepository.from_file(testdata_dir / "ratings.json")
+    assert repository.get_recently_played_song_ids(0) == set()
+    assert repository.get_recently_played_song_ids(1) == {_compute_remote_id("abc/two")}
+    assert repository.get_recently_played_song_ids(2) == {
+        _compute_remote_id("abc/one"),
+        _compute_remote_id("abc/two"),
+    }
+    # the songs, not the plays
+    for timestamp in (1000, 1001):
+        repository.add_play(
+            _compute_remote_id("abc/one"), Path("abc/one"), timestamp, rating=3
+        )
+    assert repository.get_recently_played_song_ids(2) == {
+        _compute_remote_id("abc/one"),
+        _compute_remote_id("abc/two"),
+    }
+
+
 @pytest.mark.parametrize(
     "prep,exp",
     [
@@ -84,3 +172,294 @@ def test_backup(
         got[fname] = (temp_directory / fname).read_text()
 
     assert got == exp
+
+
+def test_merge(testdata_dir: Path, temp_directory: Path) -> None:
+    file = temp_directory / "ratings.json"
+    shutil.copy2(testdata_dir / "ratings.json", file)
+    original = file.read_text()
+    rep = InMemoryRatingRepository.from_file(file)
+    count = rep.merge(
+        [
+            PlayedSong(
+                path=Path("abc/two"),
+                plays=[Play(timestamp=101, rating=1), Play(timestamp=102, rating=3)],
+            ),
+            PlayedSong(path=Path("abc/four"), plays=[]),
+        ]
+    )
+    assert count == 1
+    assert rep.get_rating(_compute_remote_id("abc/two")) == 4.0
+    rep.compact()
+
+    assert sorted(os.listdir(temp_directory)) == ["ratings.json", "ratings.json.bak1"]
+    assert (temp_directory / "ratings.json.bak1").read_text() == original
+    assert InMemoryRatingRepository.from_file(file) == rep
+    assert len(rep.ratings) == 4
+
+
+def test_rating_repository_cache(testdata_dir: Path, temp_directory: Path) -> None:
+    path = temp_directory / "user" / "ratings.json"
+    cache = RatingRepositoryCache(max_size=1)
+
+    empty = cache.get("user", path)
+    assert empty.ratings == dict()
+    assert path.parent.is_dir()
+    assert cache.get("user", path) is empty
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    shutil.copy2(testdata_dir / "ratings.json", path)
+    loaded = cache.get("user", path)
+    assert loaded is not empty
+    assert len(loaded.ratings) == 3
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    loaded.add_play(
+        song_id=_compute_remote_id("abc/one"),
+        song_path=Path("abc/one"),
+        timestamp=1,
+        rating=5,
+    )
+    loaded.save()
+    assert cache.get("user", path) is loaded
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    other = cache.get("other", temp_directory / "other" / "ratings.json")
+    assert len(cache) == 1
+    assert cache.get("other", temp_directory / "other" / "ratings.json") is other
+    assert cache.get("user", path) is not loaded
+    assert (cache.hits, cache.misses) == (3, 4)
+
+
+@pytest.mark.parametrize(
+    "play_log",
+    [None, PlayLogOptions(compaction_threshold=500)],
+    ids=["snapshot", "log"],
+)
+def test_rating_repository_cache__concurrent_plays(
+    testdata_dir: Path, temp_directory: Path, play_log: Optional[PlayLogOptions]
+) -> None:
+    path = temp_directory / "user" / "ratings.json"
+    path.parent.mkdir()
+    shutil.copy2(testdata_dir / "ratings.json", path)
+    cache = RatingRepositoryCache(play_log=play_log, commit_delay=0.001)
+    song_paths = [Path("abc/one"), Path("abc/new")]
+
+    def add_play(n: int) -> Optional[float]:
+        song_path = song_paths[n % 2]
+        return cache.add_play(
+            "user",
+            path,
+            song_id=_compute_remote_id(song_path),
+            song_path=song_path,
+            timestamp=n,
+            rating=5,
+        )
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        ratings = list(executor.map(add_play, range(2000)))
+
+    assert all(r is not None for r in ratings)
+    assert cache.saves < 2000
+    got = InMemoryRatingRepository.from_file(path, play_log=play_log)
+    one = got.ratings[_compute_remote_id("abc/one")]
+    new = got.ratings[_compute_remote_id("abc/new")]
+    assert len(one.plays) == 2 + 1000
+    assert sorted(p.timestamp for p in new.plays) == list(range(1, 2000, 2))
+
+
+def test_rating_repository_cache__read_while_saving(
+    testdata_dir: Path, temp_directory: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    path = temp_directory / "user" / "ratings.json"
+    path.parent.mkdir()
+    shutil.copy2(testdata_dir / "ratings.json", path)
+    cache = RatingRepositoryCache()
+    one = _compute_remote_id("abc/one")
+    writing, resume = threading.Event(), threading.Event()
+    write = RatingSave.write
+
+    def slow_write(save: RatingSave) -> None:
+        writing.set()
+        resume.wait(5)
+        write(save)
+
+    monkeypatch.setattr(RatingSave, "write", slow_write)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        added = executor.submit(
+            cache.add_play, "user", path, one, Path("abc/one"), 1, 5
+        )
+        assert writing.wait(5)
+        # the play is in memory, and can be read while the file is written
+        assert cache.read("user", path, lambda r: r.get_rating(one)) == 8 / 3
+        assert not added.done()
+        resume.set()
+        assert added.result() == 8 / 3
+    assert InMemoryRatingRepository.from_file(path).get_rating(one) == 8 / 3
+    assert not cache.get("user", path).pending_plays
+
+
+def test_rating_repository_cache__write_behind(
+    testdata_dir: Path, temp_directory: Path
+) -> None:
+    path = temp_directory / "user" / "ratings.json"
+    path.parent.mkdir()
+    shutil.copy2(testdata_dir / "ratings.json", path)
+    cache = RatingRepositoryCache(
+        write_behind=WriteBehindOptions(delay=0.2, max_plays=3)
+    )
+    one = _compute_remote_id("abc/one")
+
+    def add_play(timestamp: int) -> Optional[float]:
+        return cache.add_play("user", path, one, Path("abc/one"), timestamp, 5)
+
+    def count_saved_plays() -> int:
+        saved = InMemoryRatingRepository.from_file(path)
+        return len(saved.ratings[one].plays)
+
+    # acknowledged before being saved
+    assert add_play(1) == 8 / 3
+    assert count_saved_plays() == 2
+    assert list(cache.dirty) == ["user"]
+    # the flusher saves it after the delay
+    for _ in range(100):
+        if not cache.dirty:
+            break
+        time.sleep(0.02)
+    assert count_saved_plays() == 3
+    assert cache.saves == 1
+
+    # the play that reaches `max_plays` is saved at once
+    add_play(2)
+    add_play(3)
+    assert count_saved_plays() == 3
+    add_play(4)
+    assert count_saved_plays() == 6
+    assert not cache.dirty
+
+    add_play(5)
+    cache.close()
+    assert count_saved_plays() == 7
+    assert cache.flusher is not None and not cache.flusher.is_alive()
+    # without a flusher, the plays added after `close` are saved at once
+    add_play(6)
+    assert count_saved_plays() == 8
+    assert not cache.dirty
+
+
+def test_play_log(testdata_dir: Path, temp_directory: Path) -> None:
+    path = temp_directory / "ratings.json"
+    shutil.copy2(testdata_dir / "ratings.json", path)
+    log_path = InMemoryRatingRepository.get_log_file(path)
+    play_log = PlayLogOptions(compaction_threshold=3)
+    song_id = _compute_remote_id("abc/three")
+
+    rep = InMemoryRatingRepository.from_file(path, play_log=play_log)
+    for timestamp in (1, 2):
+        rep.add_play(
+            song_id=song_id, song_path=Path("abc/three"), timestamp=timestamp, rating=4
+        )
+        rep.save()
+    assert (testdata_dir / "ratings.json").read_text() == path.read_text()
+    assert len(log_path.read_text().splitlines()) == 3
+
+    # an interrupted write leaves a truncated line, which is dropped
+    with log_path.open("a") as fh:
+        fh.write('{"path": "abc/th')
+    got = InMemoryRatingRepository.from_file(path, play_log=play_log)
+    assert got.ratings[song_id].plays == [
+        Play(timestamp=1, rating=4),
+        Play(timestamp=2, rating=4),
+    ]
+    assert got.ratings == rep.ratings
+    assert len(log_path.read_text().splitlines()) == 3
+
+    got.add_play(song_id=song_id, song_path=Path("abc/three"), timestamp=3, rating=1)
+    got.save()
+    assert not log_path.exists()
+    assert (temp_directory / "ratings.json.bak1").exists()
+    assert InMemoryRatingRepository.from_file(path).ratings == got.ratings
+
+
+def test_play_log__already_compacted(testdata_dir: Path, temp_directory: Path) -> None:
+    path = temp_directory / "ratings.json"
+    shutil.copy2(testdata_dir / "ratings.json", path)
+    rep = InMemoryRatingRepository.from_file(path, play_log=PlayLogOptions())
+    rep.add_play(
+        song_id=_compute_remote_id("abc/three"),
+        song_path=Path("abc/three"),
+        timestamp=1,
+        rating=4,
+    )
+    rep.save()
+    log = InMemoryRatingRepository.get_log_file(path).read_text()
+
+    # the log was folded into the ratings file, but not removed
+    rep.compact()
+    InMemoryRatingRepository.get_log_file(path).write_text(log)
+    got = InMemoryRatingRepository.from_file(path, play_log=PlayLogOptions())
+    assert got.ratings == rep.ratings
+
+
+def test_binary_format(testdata_dir: Path, temp_directory: Path) -> None:
+    source = temp_directory / "ratings.json"
+    shutil.copy2(testdata_dir / "ratings.json", source)
+    expected = InMemoryRatingRepository.from_file(source)
+    binary_file = temp_directory / "ratings.bin"
+    convert_ratings_file(source, binary_file, "binary")
+    assert RatingColumns.is_binary(binary_file.read_bytes())
+
+    # the aggregates are computed from the columns
+    got = InMemoryRatingRepository.from_file(binary_file)
+    assert got.columns is not None
+    assert got.aggregates == expected.aggregates
+    assert got.rated_song_ids == expected.rated_song_ids
+    assert got.rating_buckets == expected.rating_buckets
+    assert got.get_recently_played_song_ids(2) == {
+        _compute_remote_id("abc/one"),
+        _compute_remote_id("abc/two"),
+    }
+    assert got.get_played_songs() == expected.get_played_songs()
+    assert got.ratings == expected.ratings
+
+    # the plays are added to the columns, and saved in the binary format
+    got = InMemoryRatingRepository.from_file(binary_file, file_format="binary")
+    got.add_play(_compute_remote_id("abc/three"), Path("abc/three"), 1000, 3)
+    got.save()
+    assert got.columns is None
+    reloaded = InMemoryRatingRepository.from_file(binary_file)
+    assert reloaded.get_rating(_compute_remote_id("abc/three")) == 3
+    assert reloaded.get_played_songs() == got.get_played_songs()
+
+    # lossless
+    convert_ratings_file(binary_file, source, "json")
+    data = json.loads((testdata_dir / "ratings.json").read_text())
+    data[2]["plays"].append(dict(timestamp=1000, rating=3))
+    assert json.loads(source.read_text()) == data
+
+
+def test_binary_format__play_log(testdata_dir: Path, temp_directory: Path) -> None:
+    file = temp_directory / "ratings.bin"
+    convert_ratings_file(testdata_dir / "ratings.json", file, "binary")
+    play_log = PlayLogOptions(compaction_threshold=10)
+    rep = InMemoryRatingRepository.from_file(
+        file, play_log=play_log, file_format="binary"
+    )
+    rep.add_play(_compute_remote_id("abc/one"), Path("abc/one"), 1000, 5)
+    rep.save()
+    assert rep.log_length == 1
+    got = InMemoryRatingRepository.from_file(file, play_log=play_log)
+    assert got.get_played_songs() == rep.get_played_songs()
+
+
+@pytest.mark.parametrize("size", [0, 10, 60, 70, -1])
+def test_binary_format__invalid(size: int) -> None:
+    columns = RatingColumns.build(
+        [(_compute_remote_id("abc/one"), "abc/one", [(123, 1), (456, 2)])]
+    )
+    data = columns.to_bytes()
+    assert RatingColumns.from_bytes(data) == columns
+    with pytest.raises(ValueError):
+        RatingColumns.from_bytes(data[:size])
+    with pytest.raises(ValueError):
+        RatingColumns.from_bytes(data[:-1] + b"\x06")
@@ -0,0 +1,65 @@
+from collections import Counter
+from random import Random
+
+from sampling import FenwickTree, SamplerKeys, WeightedSampler
+
+
+def test_fenwick_tree() -> None:
+    random = Random(1)
+    values = [random.random() for _ in range(37)]
+    tree = FenwickTree(values)
+    for _ in range(100):
+        i = random.randrange(len(values))
+        delta = random.random() - 0.5
+        values[i] += delta
+        tree.add(i, delta)
+    assert len(tree) == len(values)
+    for stop in range(len(values) + 1):
+        assert abs(tree.prefix_sum(stop) - sum(values[:stop])) < 1e-9
+
+
+def test_weighted_sampler() -> None:
+    keys = ["a", "b", "c", "d"]
+    sampler = WeightedSampler(
+        SamplerKeys(keys), [("a", 1, 0), ("c", 3, 0), ("d", 4, 0), ("x", 5, 0)]
+    )
+    random = Random(1)
+    counts = Counter(
+        keys[i] for _ in range(4000) for i in sampler.sample(random, 1, lambda i: i < 3)
+    )
+    assert set(counts) == {"a", "c"}
+    assert 2.5 < counts["c"] / counts["a"] < 3.5
+
+    # without replacement, and the weights are restored
+    assert sorted(sampler.sample(random, 10, lambda i: True)) == [0, 2, 3]
+    assert sampler.sample(random, 10, lambda i: True, start=3) == [3]
+    assert sampler.constant_tree.prefix_sum(4) == 8
+
+    sampler.update("b", 2, 0)
+    sampler.update("unknown", 2, 0)
+    assert sorted(sampler.sample(random, 10, lambda i: True)) == [0, 1, 2, 3]
+
+
+def test_weighted_sampler__time() -> None:
+    # the weight is the time since the last play
+    sampler = WeightedSampler(SamplerKeys(["a", "b"]), [("b", -190, 1)], (-100, 1))
+    assert sampler.get_now() >= 190
+    assert sampler.get_weight("a", now=200) == 100
+    random = Random(1)
+    counts = Counter(
+        sampler.sample(random, 1, lambda i: True, now=200)[0] for _ in range(2000)
+    )
+    assert 8 < counts[0] / counts[1] < 12
+    assert sampler.sample(random, 2, lambda i: True, now=190) == [0]
+
+
+def test_weighted_sampler__sample_from() -> None:
+    sampler = WeightedSampler(SamplerKeys("abc"), [("b", 0, 0), ("c", 3, 0)], (1, 0))
+    random = Random(1)
+    counts = Counter(
+        sampler.sample_from(random, ["a", "b", "c", "x"], 1, lambda k: k)[0]
+        for _ in range(4000)
+    )
+    assert set(counts) == {"a", "c"}
+    assert 2.5 < counts["c"] / counts["a"] < 3.5
+    assert sorted(sampler.sample_from(random, "abc", 3, lambda k: k)) == ["a", "c"]
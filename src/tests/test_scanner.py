@@ -0,0 +1,98 @@
+import os
+import struct
+import wave
+from pathlib import Path
+
+import pytest
+
+from scanner import load_metadata, scan_file, scan_library, write_metadata
+from songs import InMemorySongRepository, MetadataEntry
+
+
+def write_brstm(
+    file: Path, sample_rate: int, samples: int, loop_start: int, loops: bool = True
+) -> None:
+    header = b"RSTM" + b"\xfe\xff" + bytes(10) + struct.pack(">II", 0x40, 0x40)
+    head_data = struct.pack(">BBHI", 1, 0, 0, 0x0C) + bytes(4)
+    info = struct.pack(
+        ">BBBBHHII", 2, int(loops), 2, 0, sample_rate, 0, loop_start, samples
+    )
+    head = b"HEAD" + struct.pack(">I", 8 + len(head_data) + len(info))
+    file.parent.mkdir(parents=True, exist_ok=True)
+    file.write_bytes(header.ljust(0x40, b"\0") + head + head_data + info)
+
+
+def write_wav(file: Path, sample_rate: int, samples: int) -> None:
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with wave.open(str(file), "wb") as fh:
+        fh.setnchannels(2)
+        fh.setsampwidth(2)
+        fh.setframerate(sample_rate)
+        fh.writeframes(bytes(4 * samples))
+
+
+def test_scan_file(temp_directory: Path) -> None:
+    write_brstm(temp_directory / "game/loop.brstm", 32000, 64000, loop_start=16000)
+    entry = scan_file(temp_directory, "game/loop.brstm")
+    assert entry is not None
+    assert entry.path == Path("game/loop.brstm")
+    assert entry.title == "loop"
+    assert entry.game_title == "game"
+    assert entry.loop_start == 500_000
+    assert entry.loop_end == 2_000_000
+    assert entry.duration == 2.0
+    assert entry.size == (temp_directory / "game/loop.brstm").stat().st_size
+    assert not entry.error
+
+    write_brstm(temp_directory / "no_loop.brstm", 32000, 16000, 0, loops=False)
+    entry = scan_file(temp_directory, "no_loop.brstm")
+    assert entry is not None
+    assert (entry.loop_start, entry.loop_end, entry.duration) == (0, 0, 0.5)
+
+    write_wav(temp_directory / "game/song.wav", 44100, 22050)
+    entry = scan_file(temp_directory, "game/song.wav")
+    assert entry is not None
+    assert (entry.loop_start, entry.loop_end, entry.duration) == (0, 0, 0.5)
+
+    (temp_directory / "invalid.brstm").write_bytes(b"RSTM")
+    previous = MetadataEntry(path=Path("invalid.brstm"), timestamp=1, title="kept")
+    entry = scan_file(temp_directory, "invalid.brstm", previous)
+    assert entry is not None
+    assert entry.error
+    assert entry.title == "kept"
+
+    # removed during the scan
+    assert scan_file(temp_directory, "removed.brstm") is None
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_scan_library(temp_directory: Path, workers: int) -> None:
+    for i in range(5):
+        write_brstm(temp_directory / f"game/{i}.brstm", 32000, 32000 * i, 0)
+    (temp_directory / "game/cover.png").write_bytes(b"")
+    file = temp_directory / "metadata.json"
+    entries, report = scan_library(temp_directory, workers=workers)
+    assert [e.path.as_posix() for e in entries] == [f"game/{i}.brstm" for i in range(5)]
+    assert [e.duration for e in entries] == [0, 1, 2, 3, 4]
+    assert (report.songs, report.read, report.unchanged) == (5, 5, 0)
+    write_metadata(file, entries)
+    assert load_metadata(file) == entries
+    assert len(InMemorySongRepository.from_file(file).songs) == 5
+
+    # only the new and modified songs are read
+    write_brstm(temp_directory / "game/1.brstm", 32000, 32000 * 10, 0)
+    os.utime(temp_directory / "game/1.brstm", (2, 2))
+    os.utime(temp_directory / "game/2.brstm", (1, 1))
+    (temp_directory / "game/3.brstm").unlink()
+    write_brstm(temp_directory / "other/5.brstm", 32000, 32000 * 5, 0)
+    entries[1].title = "edited"
+    entries, report = scan_library(temp_directory, entries, workers=workers)
+    assert (report.songs, report.read, report.unchanged, report.removed) == (
+        5,
+        3,
+        2,
+        1,
+    )
+    assert [e.duration for e in entries] == [0, 10, 2, 4, 5]
+    assert entries[1].title == "edited"
+    assert entries[2].timestamp == 1
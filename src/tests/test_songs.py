@@ -1,6 +1,23 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
 from pathlib import Path
+from random import Random
+from typing import Any, Optional
 
-from songs import InMemorySongRepository, Song
+import pytest
+
+from ratings import InMemoryRatingRepository
+from songs import (
+    CatalogDiff,
+    InMemorySongRepository,
+    Song,
+    SongFileCache,
+    SubstringIndex,
+    iter_random_permutation,
+)
 from util import _compute_remote_id
 
 
@@ -48,3 +65,246 @@ def test_loading_song_repository(testdata_dir: Path) -> None:
             remote_id=_compute_remote_id("abc/three"),
         ),
     }
+
+
+def test_iter_random_permutation() -> None:
+    pool = list(range(100))
+    got = list(iter_random_permutation(Random(1), pool))
+    assert sorted(got) == pool
+    assert got != pool
+
+
+def test_get_random_song__min_duration(testdata_dir: Path) -> None:
+    repository = InMemorySongRepository.from_file(
+        testdata_dir / "metadata.json", random=Random(1)
+    )
+    ratings = InMemoryRatingRepository(ratings=dict())
+    for _ in range(10):
+        song = repository.get_random_song(ratings=ratings, min_duration=3)
+        assert song is not None
+        assert song.path in (Path("abc/two"), Path("abc/three"))
+    assert repository.get_random_song(ratings=ratings, min_duration=100) is None
+
+
+def test_get_random_song__only_has_rating(testdata_dir: Path) -> None:
+    repository = InMemorySongRepository.from_file(
+        testdata_dir / "metadata.json", random=Random(1)
+    )
+    ratings = InMemoryRatingRepository.from_file(testdata_dir / "ratings.json")
+    got = {
+        song.path
+        for song in (
+            repository.get_random_song(ratings=ratings, only_has_rating=True)
+            for _ in range(20)
+        )
+        if song is not None
+    }
+    assert got == {Path("abc/one"), Path("abc/two")}
+    song = repository.get_random_song(ratings=ratings, only_has_no_rating=True)
+    assert song is not None and song.path == Path("abc/three")
+    song = repository.get_random_song(ratings=ratings, min_rating=3, min_duration=2)
+    assert song is not None and song.path in (Path("abc/two"), Path("abc/three"))
+
+
+def test_get_random_songs(testdata_dir: Path) -> None:
+    repository = InMemorySongRepository.from_file(
+        testdata_dir / "metadata.json", random=Random(1)
+    )
+    ratings = InMemoryRatingRepository(ratings=dict())
+    songs = repository.get_random_songs(ratings=ratings, count=10)
+    assert sorted(s.path for s in songs) == [
+        Path("abc/one"),
+        Path("abc/three"),
+        Path("abc/two"),
+    ]
+    songs = repository.get_random_songs(ratings=ratings, count=2, min_duration=2)
+    assert {s.path for s in songs} == {Path("abc/two"), Path("abc/three")}
+    songs = repository.get_random_songs(
+        ratings=ratings,
+        count=10,
+        excluded_ids={_compute_remote_id("abc/one"), _compute_remote_id("abc/two")},
+    )
+    assert [s.path for s in songs] == [Path("abc/three")]
+    assert repository.get_random_songs(ratings=ratings, count=0) == []
+
+
+def test_get_random_songs__weighting(testdata_dir: Path) -> None:
+    repository = InMemorySongRepository.from_file(
+        testdata_dir / "metadata.json", random=Random(1)
+    )
+    ratings = InMemoryRatingRepository.from_file(testdata_dir / "ratings.json")
+    # the weights are 1.5, 4.5 and 3 (no rating)
+    counts = Counter(
+        song.path
+        for _ in range(3000)
+        for song in repository.get_random_songs(
+            ratings=ratings, count=1, weighting="rating"
+        )
+    )
+    assert counts[Path("abc/two")] > counts[Path("abc/three")] > counts[Path("abc/one")]
+    songs = repository.get_random_songs(ratings=ratings, count=5, weighting="rating")
+    assert len({s.path for s in songs}) == 3
+    songs = repository.get_random_songs(
+        ratings=ratings, count=5, min_duration=2, weighting="rating"
+    )
+    assert {s.path for s in songs} == {Path("abc/two"), Path("abc/three")}
+    songs = repository.get_random_songs(
+        ratings=ratings, count=5, only_has_rating=True, weighting="play_count"
+    )
+    assert {s.path for s in songs} == {Path("abc/one"), Path("abc/two")}
+
+
+@pytest.mark.parametrize(
+    "needle", [None, "", "o", "ON", "ong", "song", "song o", "xyz", "e t", "ß"]
+)
+def test_substring_index(needle: Optional[str]) -> None:
+    texts = {
+        1: "Song One",
+        2: "song two",
+        3: None,
+        4: "on",
+        5: "Straße",
+        6: "",
+    }
+    index = SubstringIndex.build(texts.items())
+    got = index.search(needle)
+    if needle is None or needle == "":
+        assert got is None
+    else:
+        assert got == {
+            k
+            for k, text in texts.items()
+            if text is None or needle.casefold() in text.casefold()
+        }
+
+
+def test_get_random_song__title_contains(testdata_dir: Path) -> None:
+    repository = InMemorySongRepository.from_file(
+        testdata_dir / "metadata.json", random=Random(1)
+    )
+    ratings = InMemoryRatingRepository(ratings=dict())
+    song = repository.get_random_song(ratings=ratings, title_contains="G T")
+    assert song is not None and song.path == Path("abc/three")
+    song = repository.get_random_song(ratings=ratings, game_title_contains="THREE")
+    assert song is not None and song.path == Path("abc/three")
+    song = repository.get_random_song(
+        ratings=ratings, title_contains="two", game_title_contains="three"
+    )
+    assert song is None
+    # the draws only depend on the seed of `random`, not on the hash seed
+    repository.random.seed(2)
+    songs = repository.get_random_songs(ratings=ratings, count=3, title_contains="NG T")
+    assert [s.path for s in songs] == [Path("abc/three"), Path("abc/two")]
+
+
+def test_update_from_file(temp_directory: Path) -> None:
+    def make_entry(i: int, title: str = "title") -> dict[str, Any]:
+        return dict(
+            path=f"dir/{i}",
+            timestamp=i,
+            duration=i % 7,
+            title=f"{title} {i}" if i % 5 else None,
+            game_title=f"game {i % 3}",
+        )
+
+    file = temp_directory / "metadata.json"
+    entries = [make_entry(i) for i in range(40)]
+    file.write_text(json.dumps(entries))
+    repository = InMemorySongRepository.from_file(file)
+
+    entries = entries[1:] + [make_entry(40)]
+    entries[10] = make_entry(11, title="new title")
+    file.write_text(json.dumps(entries))
+    updated, diff = repository.update_from_file(file)
+
+    assert diff == CatalogDiff(added=1, removed=1, changed=1, unchanged=38)
+    expected = InMemorySongRepository.from_file(file)
+    assert updated.songs == expected.songs
+    id = _compute_remote_id("dir/2")
+    assert updated.songs[id] is repository.songs[id]
+    for index in (updated.indexes.durations, expected.indexes.durations):
+        assert list(index.durations) == sorted(index.durations)
+    assert sorted(
+        zip(updated.indexes.durations.durations, updated.indexes.durations.keys)
+    ) == sorted(
+        zip(expected.indexes.durations.durations, expected.indexes.durations.keys)
+    )
+    assert updated.indexes.titles == expected.indexes.titles
+    assert updated.indexes.game_titles == expected.indexes.game_titles
+    assert repository.indexes.titles.search("new") == {
+        _compute_remote_id("dir/0"),
+        _compute_remote_id("dir/5"),
+        _compute_remote_id("dir/10"),
+        _compute_remote_id("dir/15"),
+        _compute_remote_id("dir/20"),
+        _compute_remote_id("dir/25"),
+        _compute_remote_id("dir/30"),
+        _compute_remote_id("dir/35"),
+    }
+
+
+def test_song_file_cache(temp_directory: Path) -> None:
+    for name in "abc":
+        (temp_directory / name).write_bytes(name.encode() * 10)
+    file = temp_directory / "metadata.json"
+    file.write_text(json.dumps([dict(path=name, timestamp=1) for name in "abc"]))
+    repository = InMemorySongRepository.from_file(file)
+    a, b, c = (repository.songs[_compute_remote_id(name)] for name in "abc")
+    cache = SongFileCache(max_bytes=25, max_file_bytes=10)
+    assert cache.get_file(repository, a) == b"a" * 10
+    assert cache.get_file(repository, a) == b"a" * 10
+    assert (cache.hits, cache.misses, cache.bytes_saved) == (1, 1, 10)
+
+    # the least recently used song is evicted
+    cache.get_file(repository, b)
+    cache.get_file(repository, a)
+    cache.get_file(repository, c)
+    assert list(cache.entries) == [_compute_remote_id("a"), _compute_remote_id("c")]
+    assert cache.size == 20
+
+    # read again when the file changes
+    (temp_directory / "a").write_bytes(b"A" * 5)
+    os.utime(temp_directory / "a", (1, 1))
+    assert cache.get_file(repository, a) == b"A" * 5
+    assert cache.size == 15
+    assert cache.misses == 4
+
+    # too large to be cached: not read
+    (temp_directory / "b").write_bytes(b"b" * 11)
+    assert cache.get_file(repository, b) is None
+    assert len(cache) == 2
+    assert cache.misses == 4
+
+
+def test_song_file_cache__concurrent_misses(temp_directory: Path) -> None:
+    (temp_directory / "a").write_bytes(b"content")
+    file = temp_directory / "metadata.json"
+    file.write_text(json.dumps([dict(path="a", timestamp=1)]))
+    repository = InMemorySongRepository.from_file(file)
+    song = repository.songs[_compute_remote_id("a")]
+    reads = 0
+    get_file = repository.get_file
+
+    def slow_get_file(song_id: str) -> bytes:
+        nonlocal reads
+        reads += 1
+        time.sleep(0.1)
+        return get_file(song_id)
+
+    repository.get_file = slow_get_file  # type: ignore[method-assign]
+    cache = SongFileCache(max_bytes=100)
+    results: list[Optional[bytes]] = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_file(repository, song))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [b"content"] * 4
+    assert reads == 1
+    assert (cache.hits, cache.misses, cache.coalesced) == (0, 1, 3)
+    assert cache.bytes_saved == 21
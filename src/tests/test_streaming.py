@@ -0,0 +1,64 @@
+import asyncio
+import json
+import zlib
+from pathlib import Path
+from typing import Any, AsyncIterator, Optional
+
+import pytest
+
+from ratings import Play, PlayedSong
+from streaming import JSONArrayParser, iter_gunzip, iter_gzip, iter_json_array
+
+
+async def split(content: bytes, size: int) -> AsyncIterator[bytes]:
+    for i in range(0, len(content), size):
+        yield content[i : i + size]
+
+
+def parse(content: bytes, size: int = 1, key: Optional[str] = None) -> list[Any]:
+    async def collect() -> list[Any]:
+        return [e async for e in JSONArrayParser(split(content, size), key=key)]
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_json_array_parser(size: int) -> None:
+    data = [dict(path="é/ü", plays=[dict(timestamp=12345, rating=3)]), 1.5, "a,]", []]
+    content = json.dumps(data, indent=1).encode()
+    assert parse(content, size) == data
+    assert parse(b' { "songs" : ' + content + b"}\n", size, key="songs") == data
+    assert parse(b" [ ] ", size) == []
+    assert parse(b"[12345]", size) == [12345]
+
+
+@pytest.mark.parametrize(
+    "content",
+    [b"", b"[1,", b"[1 2]", b"[1]]", b"[tru]", b'{"other": []}', b"\xff[]"],
+)
+def test_json_array_parser__invalid(content: bytes) -> None:
+    with pytest.raises(ValueError):
+        parse(content, key="songs")
+
+
+def test_iter_json_array() -> None:
+    songs = [PlayedSong(path=Path("a"), plays=[Play(timestamp=1, rating=2)])] * 5
+    for chunk_size in (1, 2, 5, 10):
+        content = b"".join(iter_json_array(songs, chunk_size=chunk_size))
+        assert json.loads(content) == [s.model_dump(mode="json") for s in songs]
+    assert b"".join(iter_json_array([])) == b"[]"
+
+
+def test_gzip() -> None:
+    chunks = [b"abc" * 1000, b"", b"def"]
+    compressed = b"".join(iter_gzip(chunks))
+    assert zlib.decompress(compressed, wbits=31) == b"".join(chunks)
+
+    async def decompress(content: bytes) -> bytes:
+        return b"".join([c async for c in iter_gunzip(split(content, 7))])
+
+    assert asyncio.run(decompress(compressed)) == b"".join(chunks)
+    with pytest.raises(ValueError):
+        asyncio.run(decompress(compressed[:-5]))
+    with pytest.raises(ValueError):
+        asyncio.run(decompress(b"not gzip"))
@@ -0,0 +1,58 @@
+from pathlib import Path
+
+import bcrypt
+import pytest
+
+import users
+from users import CredentialCache, InMemoryUserRepository, User, UserData
+
+
+@pytest.fixture
+def repository() -> InMemoryUserRepository:
+    return InMemoryUserRepository(
+        users=[
+            UserData(
+                username=b"testuser",
+                password_hash=bcrypt.hashpw(b"password", bcrypt.gensalt(4)),
+            )
+        ]
+    )
+
+
+@pytest.fixture
+def check_password_calls(monkeypatch: pytest.MonkeyPatch) -> list[bytes]:
+    calls: list[bytes] = []
+
+    def check_password(user_password: bytes, password_hash: bytes) -> bool:
+        calls.append(user_password)
+        return bcrypt.checkpw(user_password, password_hash)
+
+    monkeypatch.setattr(users, "check_password", check_password)
+    return calls
+
+
+def test_loading_users(testdata_dir: Path) -> None:
+    got = InMemoryUserRepository.from_file(testdata_dir / "users.json")
+    assert list(got.users_by_name) == [b"testuser"]
+
+
+def test_get_user__credential_cache(
+    repository: InMemoryUserRepository, check_password_calls: list[bytes]
+) -> None:
+    assert repository.get_user(b"testuser", b"password") == User(username="testuser")
+    assert repository.get_user(b"testuser", b"password") == User(username="testuser")
+    assert check_password_calls == [b"password"]
+
+    assert repository.get_user(b"testuser", b"wrong") is None
+    assert repository.get_user(b"testuser", b"wrong") is None
+    assert repository.get_user(b"unknown", b"password") is None
+    assert check_password_calls == [b"password", b"wrong", b"wrong"]
+
+
+def test_get_user__credential_cache_expiration(
+    repository: InMemoryUserRepository, check_password_calls: list[bytes]
+) -> None:
+    repository.credential_cache = CredentialCache(ttl=0)
+    assert repository.get_user(b"testuser", b"password") == User(username="testuser")
+    assert repository.get_user(b"testuser", b"password") == User(username="testuser")
+    assert check_password_calls == [b"password", b"password"]
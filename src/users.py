@@ -1,9 +1,14 @@
 from __future__ import annotations
 
+import hashlib
+import hmac
 import json
 import secrets
+import threading
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional
 
@@ -28,23 +33,78 @@ class UserRepository(ABC):
         ...  # pragma:nocover
 
 
+@dataclass
+class CredentialCache:
+    """Remember the credentials that were recently verified.
+
+    The credentials are stored as a HMAC with a random key that only lives
+    in memory, so that they can't be recovered from the cache.
+    """
+
+    ttl: float = 300.0  # seconds
+    max_size: int = 1024
+    hits: int = 0
+    misses: int = 0
+    key: bytes = field(default_factory=lambda: secrets.token_bytes(32), repr=False)
+    expirations: OrderedDict[bytes, float] = field(
+        default_factory=OrderedDict, repr=False
+    )
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def _digest(self, username: bytes, password: bytes) -> bytes:
+        message = len(username).to_bytes(4, "big") + username + password
+        return hmac.new(self.key, message, hashlib.sha256).digest()
+
+    def check(self, username: bytes, password: bytes) -> bool:
+        digest = self._digest(username, password)
+        with self.lock:
+            expiration = self.expirations.get(digest)
+            if expiration is not None and time.monotonic() < expiration:
+                self.expirations.move_to_end(digest)
+                self.hits += 1
+                return True
+            self.expirations.pop(digest, None)
+            self.misses += 1
+            return False
+
+    def add(self, username: bytes, password: bytes) -> None:
+        digest = self._digest(username, password)
+        with self.lock:
+            self.expirations[digest] = time.monotonic() + self.ttl
+            self.expirations.move_to_end(digest)
+            while len(self.expirations) > self.max_size:
+                self.expirations.popitem(last=False)
+
+
 @dataclass
 class InMemoryUserRepository(UserRepository):
     users: list[UserData]
+    credential_cache: CredentialCache = field(default_factory=CredentialCache)
+    users_by_name: dict[bytes, UserData] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.users_by_name = {user.username: user for user in self.users}
 
     def get_user(self, username: bytes, password: bytes) -> Optional[User]:
-        for user in self.users:
-            if secrets.compare_digest(username, user.username) and check_password(
-                password, user.password_hash
-            ):
-                return User(username=user.username.decode())
-        return None
+        user = self.users_by_name.get(username)
+        if user is None:
+            return None
+        if not self.credential_cache.check(username, password):
+            if not check_password(password, user.password_hash):
+                return None
+            self.credential_cache.add(username, password)
+        return User(username=user.username.decode())
 
     @staticmethod
-    def from_file(file: Path) -> InMemoryUserRepository:
+    def from_file(
+        file: Path, credential_cache: Optional[CredentialCache] = None
+    ) -> InMemoryUserRepository:
         data = json.loads(file.read_text())
         users = pydantic.TypeAdapter(list[UserData]).validate_python(data)
-        return InMemoryUserRepository(users=users)
+        return InMemoryUserRepository(
+            users=users,
+            credential_cache=credential_cache or CredentialCache(),
+        )
 
 
 def hash_password(password: bytes) -> bytes:
@@ -1,6 +1,18 @@
 import hashlib
-from typing import Any
+from pathlib import Path
+from typing import Any, Optional
+
+# (inode, modification time in ns, size in bytes)
+FileSignature = tuple[int, int, int]
 
 
 def _compute_remote_id(data: Any) -> str:
     return hashlib.md5(str(data).encode()).hexdigest()
+
+
+def get_file_signature(file: Path) -> Optional[FileSignature]:
+    try:
+        stat = file.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size